@@ -0,0 +1,260 @@
+"""
+Benchmarks of the dotnet encoder at scale.
+
+Builds synthetic encoder configs (per site WebConfig settings on top of the registry ones) along with matching
+describe json (full and slim shapes) and PS1 fixtures, then measures throughput, latency percentiles and peak memory
+of encode_multi, decode_multi and encode_describe. Decoding a long PS1 adjust log is also measured against the per
+setting line scan decode_multi used before PowershellSettingIndex (see scan_decode_ps1). Results are emitted as json
+that can be compared against a baseline run:
+
+    python -m encoders.bench_dotnet --sites 500 --output bench.json
+    python -m encoders.bench_dotnet --sites 500 --baseline bench.json
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from encoders.dotnet import Encoder, WebConfigRangeSetting, DEFAULT_WEBCONFIG_PATH, SETTING_PATH_DELIMITER, \
+    SettingRuntimeException
+
+WEBCONFIG_SETTINGS = ('WebConfigCacheEnabled', 'WebConfigEnableKernelCache')
+REGISTRY_SETTINGS = ('UriEnableCache', 'UriScavengerPeriod')
+
+# Properties returned by Get-WebConfiguration/Get-ItemProperty that the encoder never reads, see describe_data_json
+# in test_dotnet.py
+CACHING_EXTRA = {
+    "value": "Microsoft.IIs.PowerShell.Framework.ConfigurationSection",
+    "maxCacheSize": 0,
+    "maxResponseSize": 262144,
+    "profiles": {"value": "Microsoft.IIs.PowerShell.Framework.ConfigurationElement", "Collection": ""},
+    "Location": "",
+    "ConfigurationPathType": 10,
+    "ItemXPath": "/system.webServer/caching",
+}
+REGISTRY_EXTRA = {
+    "PSPath": "Microsoft.PowerShell.Core\\Registry::HKEY_LOCAL_MACHINE\\System\\CurrentControlSet\\Services\\Http\\Parameters",
+    "PSParentPath": "Microsoft.PowerShell.Core\\Registry::HKEY_LOCAL_MACHINE\\System\\CurrentControlSet\\Services\\Http",
+    "PSChildName": "Parameters",
+    "PSDrive": {"CurrentLocation": "", "Name": "HKLM", "Provider": "Microsoft.PowerShell.Core\\Registry",
+                "Root": "HKEY_LOCAL_MACHINE", "Description": "The configuration settings for the local computer",
+                "Credential": "System.Management.Automation.PSCredential", "DisplayRoot": None},
+    "PSProvider": {"ImplementingType": "Microsoft.PowerShell.Commands.RegistryProvider",
+                   "HelpFile": "System.Management.Automation.dll-Help.xml", "Name": "Registry",
+                   "PSSnapIn": "Microsoft.PowerShell.Core", "ModuleName": "Microsoft.PowerShell.Core", "Module": None,
+                   "Description": "", "Capabilities": 80, "Home": "", "Drives": "HKLM HKCU"},
+}
+
+
+def site_path(index):
+    return '{}/Site{}'.format(DEFAULT_WEBCONFIG_PATH, index)
+
+
+def make_config(sites):
+    """
+    Encoder config with the registry settings plus every WebConfig setting for the default path and each site.
+    """
+    settings = {name: {} for name in REGISTRY_SETTINGS + WEBCONFIG_SETTINGS}
+    for index in range(sites):
+        for name in WEBCONFIG_SETTINGS:
+            settings['{}{}{}'.format(site_path(index), SETTING_PATH_DELIMITER, name)] = {}
+    return {'name': 'dotnet', 'settings': settings}
+
+
+def make_values(encoder, seed=0):
+    """
+    Values dict for every setting of encoder, varied by seed so that successive candidates differ.
+    """
+    values = {}
+    for offset, (name, setting) in enumerate(sorted(encoder.settings.items())):
+        span = int(min(setting.max - setting.min, 1000) // setting.step) + 1
+        values[name] = setting.min + ((seed + offset) % span) * setting.step
+    return values
+
+
+def make_describe_json(encoder, values, slim=False):
+    """
+    Describe json the (full or slim) describe script of encoder would return on a host holding values.
+    """
+    webconfig = {}
+    data = {'WebConfig': webconfig}
+    for name, setting in encoder.settings.items():
+        if isinstance(setting, WebConfigRangeSetting):
+            section = webconfig.setdefault(setting.path, {}).setdefault(setting.filter, {} if slim else dict(
+                CACHING_EXTRA, PSPath=setting.path))
+            section[setting.name_override or setting.name] = bool(values[name])
+        else:
+            key = data.setdefault(setting.path, {} if slim else dict(REGISTRY_EXTRA))
+            key[setting.name] = values[name]
+    if slim:
+        return json.dumps(data, separators=(',', ':'))
+    return json.dumps(data, indent=4)
+
+
+def make_adjust_log(encoder, values, lines=5000):
+    """
+    PS1 adjust log of about lines lines: the adjust script of values followed by writes to sites encoder does not
+    configure (eg. a log covering a whole farm), which decoding has to go through.
+    """
+    script = encoder.encode_multi(values)
+    setting = next(s for s in encoder.settings.values() if isinstance(s, WebConfigRangeSetting))
+    value = setting.encode_value(setting.min)
+    return script + ''.join(setting.format_value(value, '{}/Unconfigured{}'.format(DEFAULT_WEBCONFIG_PATH, index))
+                            for index in range(max(0, lines - script.count('\n'))))
+
+
+def scan_decode_ps1(encoder, data):
+    """
+    Decodes a PS1 script the way decode_multi did before PowershellSettingIndex: every setting filters every line
+    on the prefix it encodes values with. Kept as the reference the index is benchmarked against.
+    """
+    lines = data.split('\n')
+    decoded = {}
+    for name, setting in encoder.settings.items():
+        found = list(filter(lambda line: line.startswith(setting.format_prefix()), lines))
+        if len(found) > 1:
+            raise SettingRuntimeException('Found more than one value for setting {}'.format(name))
+        value = found[0].split()[-1] if found else setting.system_default
+        decoded[name] = setting.get_value_encoder().decode(value)
+    return decoded
+
+
+def percentile(sorted_samples, fraction):
+    index = min(len(sorted_samples) - 1, max(0, int(round(fraction * len(sorted_samples) + 0.5)) - 1))
+    return sorted_samples[index]
+
+
+def measure(func, iterations, payload_bytes=None):
+    """
+    Times iterations calls of func, then measures its peak traced memory on a separate call (tracing skews timings).
+
+    :return dict: latency percentiles (seconds), throughput (calls per second), peak memory (bytes)
+    """
+    func() # warm up
+    samples = []
+    gc.collect()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    total = sum(samples)
+
+    tracemalloc.start()
+    func()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {
+        'iterations': iterations,
+        'ops_per_sec': iterations / total if total else float('inf'),
+        'mean': total / iterations,
+        'p50': percentile(samples, 0.50),
+        'p90': percentile(samples, 0.90),
+        'p99': percentile(samples, 0.99),
+        'max': samples[-1],
+        'peak_bytes': peak_bytes,
+    }
+    if payload_bytes is not None:
+        result['payload_bytes'] = payload_bytes
+    return result
+
+
+def run_benchmarks(sites=100, iterations=20, log_lines=5000):
+    """
+    :param sites: number of synthetic sites, each adding one WebConfig setting per WebConfig setting class
+    :param iterations: number of timed calls per benchmark case
+    :param log_lines: number of lines of the PS1 adjust log decoded by the decode_multi_ps1_log cases
+    :return dict: machine readable results, see compare() for baseline comparison
+    """
+    config = make_config(sites)
+    encoder = Encoder(config)
+    values = make_values(encoder)
+    other_values = make_values(encoder, seed=1)
+    describe_json = make_describe_json(encoder, values)
+    describe_slim_json = make_describe_json(encoder, values, slim=True)
+    describe_ps1 = encoder.encode_multi(values)
+    adjust_log = make_adjust_log(encoder, values, log_lines)
+
+    cases = {
+        'encoder_init': measure(lambda: Encoder(config), iterations),
+        'encode_multi': measure(lambda: encoder.encode_multi(values), iterations),
+        'encode_multi_delta': measure(lambda: encoder.encode_multi(other_values, current=values), iterations),
+        'encode_describe': measure(encoder.encode_describe, iterations),
+        'encode_describe_slim': measure(lambda: encoder.encode_describe(slim=True), iterations),
+        'encode_describe_parallel': measure(lambda: encoder.encode_describe(parallel=4), iterations),
+        'decode_multi_json': measure(lambda: encoder.decode_multi(describe_json), iterations,
+                                     payload_bytes=len(describe_json)),
+        'decode_multi_json_slim': measure(lambda: encoder.decode_multi(describe_slim_json), iterations,
+                                          payload_bytes=len(describe_slim_json)),
+        'decode_multi_ps1': measure(lambda: encoder.decode_multi(describe_ps1), iterations,
+                                    payload_bytes=len(describe_ps1)),
+        'decode_multi_ps1_log': measure(lambda: encoder.decode_multi(adjust_log), iterations,
+                                        payload_bytes=len(adjust_log)),
+        'decode_multi_ps1_log_scan': measure(lambda: scan_decode_ps1(encoder, adjust_log), iterations,
+                                             payload_bytes=len(adjust_log)),
+    }
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'sites': sites,
+            'settings': len(encoder.settings),
+            'iterations': iterations,
+            'log_lines': log_lines,
+        },
+        'results': cases,
+    }
+
+
+def compare(results, baseline, tolerance=0.1, metrics=('p50', 'peak_bytes')):
+    """
+    Compares results against baseline results (both as returned by run_benchmarks).
+
+    :param tolerance: relative increase of a metric over the baseline considered a regression
+    :return list: (case, metric, baseline value, current value) of each regression
+    """
+    regressions = []
+    for case, current in sorted(results['results'].items()):
+        base = baseline.get('results', {}).get(case)
+        if base is None:
+            continue
+        for metric in metrics:
+            if metric in base and metric in current and current[metric] > base[metric] * (1 + tolerance):
+                regressions.append((case, metric, base[metric], current[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the dotnet encoder on synthetic multi-site configs')
+    parser.add_argument('--sites', type=int, default=100)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--log-lines', type=int, default=5000)
+    parser.add_argument('--output', help='file to write json results to (default: stdout)')
+    parser.add_argument('--baseline', help='json results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(sites=args.sites, iterations=args.iterations, log_lines=args.log_lines)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), tolerance=args.tolerance)
+        for case, metric, base, current in regressions:
+            sys.stderr.write('REGRESSION {} {}: {:.6g} -> {:.6g}\n'.format(case, metric, base, current))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
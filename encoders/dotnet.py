@@ -1,13 +1,58 @@
+import array
+import bisect
+import codecs
+import copy
+import functools
+import hashlib
 import json
+import mmap
+import os
+import pickle
+import re
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+# NOTE: numpy (optional, only needed by the array based (batch) apis), asyncio and concurrent.futures are imported
+#       on first use, they would otherwise make up most of the import time of this module
+numpy = None
 
 from encoders.base import Encoder as BaseEncoder, RangeSetting as BaseRangeSetting, \
     Setting as BaseSetting, \
     EncoderConfigException, EncoderRuntimeException, \
     SettingConfigException, SettingRuntimeException, q
 
+DEFAULT_WEBCONFIG_PATH = 'MACHINE/WEBROOT/APPHOST'
+SETTING_PATH_DELIMITER = '::'
+
+# What it takes for a written setting value to take effect, by increasing cost
+ACTIVATION_NONE = 'none'
+ACTIVATION_APP_POOL_RECYCLE = 'app_pool_recycle'
+ACTIVATION_IIS_RESET = 'iis_reset'
+ACTIVATION_HTTP_RESTART = 'http_restart'
+ACTIVATION_LEVELS = (ACTIVATION_NONE, ACTIVATION_APP_POOL_RECYCLE, ACTIVATION_IIS_RESET, ACTIVATION_HTTP_RESTART)
+
 
 # Value encoders
-class IntToStrValueEncoder:
+class StatelessValueEncoder:
+    """
+    Base of value encoders, which hold no state: every instantiation of a given value encoder class returns the
+    same instance.
+    """
+    __slots__ = ()
+
+    def __new__(cls):
+        instance = cls.__dict__.get('_instance')
+        if instance is None:
+            instance = super().__new__(cls)
+            setattr(cls, '_instance', instance)
+        return instance
+
+
+class IntToStrValueEncoder(StatelessValueEncoder):
+    __slots__ = ()
 
     @staticmethod
     def encode(value):
@@ -17,24 +62,747 @@ class IntToStrValueEncoder:
     def decode(data):
         return int(data)
 
+    @staticmethod
+    def encode_array(values):
+        return values.astype(numpy.int64).astype(str)
+
 
-class IntToBoolValueEncoder:
+class IntToBoolValueEncoder(StatelessValueEncoder):
+    __slots__ = ()
 
     @staticmethod
     def encode(value):
         return str(bool(value))
 
+    @staticmethod
+    def encode_array(values):
+        return numpy.where(values != 0, 'True', 'False')
+
     @staticmethod
     def decode(data):
         if isinstance(data, str):
-            return int(data == 'True')
+            # PowerShell literals are case insensitive and may come in as $true/$false from hand written scripts
+            return int(data.lstrip('$').lower() in ('true', '1'))
         return int(data)
 
 
+def _require_numpy():
+    global numpy # pylint: disable=global-statement
+    if numpy is None:
+        try:
+            import numpy as numpy_module
+        except ImportError:
+            raise SettingRuntimeException('numpy is required for array based encoding in dotnet encoder, please install it')
+        numpy = numpy_module
+
+
+class RangeValues:
+    """
+    Lazy sequence of the legal values of a range setting (min to max by step). Values are computed on access,
+    the range is never materialized as a list; to_array() builds (chunks of) it as a numpy array instead.
+    """
+    def __init__(self, min, max, step):
+        # pylint: disable=redefined-builtin
+        if not step or step <= 0:
+            raise SettingConfigException('Range step must be positive, got {}'.format(q(step)))
+        self.min = min
+        self.max = max
+        self.step = step
+        self._len = int((max - min) // step) + 1 if max >= min else 0
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, stride = index.indices(self._len)
+            if stride < 0:
+                raise IndexError('Descending slices of range values are not supported')
+            first = self.min + start * self.step
+            count = len(range(start, stop, stride))
+            return RangeValues(first, first + (count - 1) * stride * self.step, stride * self.step)
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('Range value index out of range')
+        return self.min + index * self.step
+
+    def __iter__(self):
+        for index in range(self._len):
+            yield self.min + index * self.step
+
+    def __contains__(self, value):
+        if self._len == 0 or value < self.min or value > self.max:
+            return False
+        return ((value - self.min) / self.step).is_integer()
+
+    def __repr__(self):
+        return 'RangeValues(min={!r}, max={!r}, step={!r})'.format(self.min, self.max, self.step)
+
+    def index(self, value):
+        if value not in self:
+            raise ValueError('{} is not a legal range value'.format(value))
+        return int((value - self.min) // self.step)
+
+    def to_array(self, start=0, stop=None):
+        """
+        :return numpy.ndarray: values with index in [start, stop), whole range by default
+        """
+        _require_numpy()
+        start, stop, _ = slice(start, stop).indices(self._len)
+        return self.min + numpy.arange(start, max(start, stop), dtype=numpy.int64) * self.step
+
+
+# PowerShell script parsing
+# NOTE: this is not a full PowerShell parser, it only understands the subset of the language used by scripts produced
+#   by this encoder (and hand written equivalents), for tools interpreting them (see sim_dotnet): commands with
+#   named/positional parameters, quoted strings, hashtables, script blocks/subexpressions, pipelines, comments and line
+#   continuations. Decoding reads setting writes through PowershellSettingIndex instead
+_PS1_TOKEN_RE = re.compile(r'''
+      (?P<ws>[ \t\f]+|`[ \t]*\r?\n)
+    | (?P<comment>\#[^\r\n]*)
+    | (?P<end>\r?\n|;)
+    | (?P<dq>"(?:[^"`]|`.|"")*")
+    | (?P<sq>'(?:[^']|'')*')
+    | (?P<open>@\{|\$\(|@\(|[{(])
+    | (?P<close>[})])
+    | (?P<pipe>\|)
+    | (?P<assign>=)
+    | (?P<param>-[A-Za-z_][\w]*:?)
+    | (?P<comma>,)
+    | (?P<word>[^\s;|"'`{}()=,]+)
+    | (?P<other>.)
+''', re.VERBOSE | re.DOTALL)
+_PS1_ESCAPE_RE = re.compile(r'`(.)', re.DOTALL)
+_PS1_ESCAPES = {'n': '\n', 'r': '\r', 't': '\t', '0': '\0', 'a': '\a', 'b': '\b', 'f': '\f', 'v': '\v'}
+_PS1_VALUE_TOKENS = frozenset(('dq', 'sq', 'word', 'open', 'other'))
+
+PowershellCommand = namedtuple('PowershellCommand', 'name params args')
+PowershellAssignment = namedtuple('PowershellAssignment', 'target value')
+PowershellBlock = namedtuple('PowershellBlock', 'kind statements')
+
+
+def _unquote_ps1(kind, text):
+    inner = text[1:-1]
+    if kind == 'sq':
+        return inner.replace("''", "'")
+    if '`' in inner:
+        inner = _PS1_ESCAPE_RE.sub(lambda m: _PS1_ESCAPES.get(m.group(1), m.group(1)), inner)
+    return inner.replace('""', '"')
+
+
+def format_ps1_list(values):
+    """
+    Formats values as a comma separated list of double quoted powershell strings.
+    """
+    return ','.join('"{}"'.format(v.replace('`', '``').replace('"', '`"').replace('$', '`$')) for v in values)
+
+
+def tokenize_ps1(data):
+    """
+    Splits PowerShell text into (kind, text) tokens. Whitespace, comments and line continuations are dropped.
+
+    :param data: PowerShell script text
+    :return list: List of (kind, text) tuples
+    """
+    return [(m.lastgroup, m.group()) for m in _PS1_TOKEN_RE.finditer(data) if m.lastgroup not in ('ws', 'comment')]
+
+
+class _Ps1Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self, offset=0):
+        pos = self.pos + offset
+        if pos < len(self.tokens):
+            return self.tokens[pos]
+        return (None, None)
+
+    def parse_statements(self, nested=False):
+        statements = []
+        while self.pos < len(self.tokens):
+            kind = self.tokens[self.pos][0]
+            if kind == 'end':
+                self.pos += 1
+            elif kind == 'close':
+                if nested:
+                    return statements
+                self.pos += 1 # stray closing brace, nothing to match it against
+            else:
+                pipeline = self.parse_pipeline()
+                if pipeline:
+                    statements.append(pipeline)
+        return statements
+
+    def parse_pipeline(self):
+        pipeline = []
+        while True:
+            kind, _ = self.peek()
+            if kind is None or kind in ('end', 'close'):
+                return pipeline
+            if kind == 'pipe':
+                self.pos += 1
+                while self.peek()[0] == 'end' and self.peek()[1] != ';': # trailing pipe continues on the next line
+                    self.pos += 1
+                continue
+            start = self.pos
+            pipeline.append(self.parse_element())
+            if self.pos == start: # guard against tokens we could not consume
+                self.pos += 1
+
+    def parse_element(self):
+        kind, text = self.peek()
+        if kind in ('word', 'dq', 'sq') and self.peek(1)[0] == 'assign':
+            target = text if kind == 'word' else _unquote_ps1(kind, text)
+            self.pos += 2
+            return PowershellAssignment(target, self.parse_pipeline())
+        if kind == 'word':
+            self.pos += 1
+            return self.parse_command(text)
+        value = self.parse_operand()
+        # Expression elements (eg. hashtable literal piped into a command) may be followed by operators we don't model
+        while self.peek()[0] in _PS1_VALUE_TOKENS or self.peek()[0] in ('param', 'assign'):
+            if self.peek()[0] in ('param', 'assign'):
+                self.pos += 1
+            else:
+                self.parse_value()
+        return value
+
+    def parse_command(self, name):
+        params = {}
+        args = []
+        while True:
+            kind, text = self.peek()
+            if kind == 'param':
+                self.pos += 1
+                if text.endswith(':'):
+                    params[text[1:-1].lower()] = self.parse_operand()
+                elif self.peek()[0] in _PS1_VALUE_TOKENS:
+                    params[text[1:].lower()] = self.parse_operand()
+                else:
+                    params[text[1:].lower()] = True # switch parameter
+            elif kind in _PS1_VALUE_TOKENS:
+                args.append(self.parse_operand())
+            elif kind == 'assign':
+                self.pos += 1
+            else:
+                return PowershellCommand(name, params, args)
+
+    def parse_operand(self):
+        # Comma separated values (eg. -Property "enabled","enableKernelCache") make up an array
+        value = self.parse_value()
+        if self.peek()[0] != 'comma':
+            return value
+        values = [value]
+        while self.peek()[0] == 'comma':
+            self.pos += 1
+            values.append(self.parse_value())
+        return values
+
+    def parse_value(self):
+        kind, text = self.peek()
+        if kind is None:
+            return None
+        self.pos += 1
+        if kind in ('dq', 'sq'):
+            return _unquote_ps1(kind, text)
+        if kind == 'open':
+            if text == '@{':
+                return self.parse_hashtable()
+            statements = self.parse_statements(nested=True)
+            self.pos += 1 # closing brace/parenthesis
+            return PowershellBlock(text, statements)
+        return text
+
+    def parse_hashtable(self):
+        table = OrderedDict()
+        while True:
+            kind, text = self.peek()
+            if kind is None:
+                return table
+            if kind == 'close':
+                self.pos += 1
+                return table
+            if kind == 'end':
+                self.pos += 1
+                continue
+            key = self.parse_value()
+            if self.peek()[0] != 'assign':
+                continue
+            self.pos += 1
+            pipeline = self.parse_pipeline()
+            value = None
+            if len(pipeline) == 1:
+                value = pipeline[0]
+                # Bare words (eg. False, 10, $true) are parsed as argumentless commands, unwrap them to plain values
+                if isinstance(value, PowershellCommand) and not value.params and not value.args:
+                    value = value.name
+            elif pipeline:
+                value = pipeline
+            table[key] = value
+
+
+def parse_ps1(data):
+    """
+    Parses PowerShell text into a list of statements. Each statement is a pipeline (list) whose elements are
+    PowershellCommand, PowershellAssignment or plain values (str, hashtable OrderedDict, PowershellBlock, list of
+    comma separated values).
+
+    :param data: PowerShell script text
+    :return list: List of statements
+    """
+    return _Ps1Parser(tokenize_ps1(data)).parse_statements()
+
+
+def iter_ps1_commands(statements):
+    """
+    Walks parsed PowerShell statements (see parse_ps1) yielding every PowershellCommand, including those nested in
+    script blocks, subexpressions, hashtables and assignments.
+    """
+    stack = [statements]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, PowershellCommand):
+            yield item
+            stack.extend(reversed(list(item.params.values()) + item.args))
+        elif isinstance(item, PowershellAssignment):
+            stack.append(item.value)
+        elif isinstance(item, PowershellBlock):
+            stack.append(item.statements)
+        elif isinstance(item, dict):
+            stack.extend(reversed(list(item.values())))
+        elif isinstance(item, list):
+            stack.extend(reversed(item))
+
+
+# Setting writes (Set-ItemProperty, Set-WebConfigurationProperty and Set-WebConfiguration statements) are found by
+# _PS1_SETTING_WRITE_RE. It runs over the lowercased script, so that its search is led by the literal "set-" and skips
+# over the rest of the script at C speed. The parameters the index reads are captured in any order by the repeated
+# alternation (a group holds its last capture). Statements written in a way it does not model (positional arguments,
+# line continuations, escapes, expressions...) are measured by _PS1_ARGUMENTS_RE and split by _ps1_arguments instead
+_PS1_STRING = r""""(?:[^"`]|`.|"")*"|'(?:[^']|'')*'"""
+_PS1_ITEM = r"""(?:{string}|@\{{(?:{string}|[^"'}}])*\}}|\((?:{string}|[^"'()])*\)|[^\s;|"'`{{}}()\#,]+)+""".format(
+    string=_PS1_STRING)
+_PS1_SIMPLE_VALUE = r"""(?:"[^"`]*"|'[^']*'|\$?[^\s;|"'`{}()\#,@$]+)"""
+_PS1_SETTING_WRITE_RE = re.compile(r"""
+    set-(?P<cmdlet>itemproperty|webconfiguration(?:property)?)(?=[\s;|}})\#]|$)
+    (?:
+          [ \t]+-(?:
+              (?:ps|literal)?path{sep}(?P<path>{value})
+            | name{sep}(?P<name>{value})
+            | filter{sep}(?P<filter>{value})
+            | value{sep}(?P<value>{value})
+            | (?!(?:ps|literal)?path\b|name\b|filter\b|value\b|location\b)[a-z_]\w*(?:{sep}(?!-[a-z_]){value})?
+          )
+        | [ \t]+(?P<other>[^\s;|}})\#]+)
+    )*
+""".format(value=_PS1_SIMPLE_VALUE, sep=r'(?::[ \t]*|[ \t]+)'), re.VERBOSE)
+_PS1_ARGUMENTS_RE = re.compile(r'(?:[ \t]+|`[ \t]*\r?\n|,|{item})*'.format(item=_PS1_ITEM), re.DOTALL)
+_PS1_ASCII_UPPER_RE = re.compile(r'[A-Z]+')
+_PS1_STRING_RE = re.compile(_PS1_STRING, re.DOTALL)
+# Arguments of a command, for _ps1_arguments
+_PS1_ARGUMENT_RE = re.compile(r"""
+      (?P<param>-[A-Za-z_]\w*:?)
+    | (?P<table>@\{{(?:{string}|[^"'}}])*\}})
+    | (?P<comma>,)
+    | (?P<value>{item})
+""".format(string=_PS1_STRING, item=_PS1_ITEM), re.VERBOSE | re.DOTALL)
+_PS1_TABLE_ENTRY_RE = re.compile(r"""
+    (?P<key>{string}|[^\s;="'@{{}}]+)[ \t]*=[ \t]*(?P<value>{string}|[^;\r\n}}]*)
+""".format(string=_PS1_STRING), re.VERBOSE | re.DOTALL)
+_PS1_LITERAL_RE = re.compile(r'\$?[\w.:/\\+-]+')
+_PS1_STATEMENT_END = frozenset(';\r\n|})#')
+_PS1_STATEMENT_START = frozenset(';{(|=&')
+_PS1_CONSTANTS = frozenset(('$true', '$false', '$null'))
+_PS1_QUOTES = ('"', "'")
+
+
+class PowershellExpression(namedtuple('PowershellExpression', 'text')):
+    """
+    Value of a setting write that is not a literal (eg. (1), $value or 1,2), as written in the script.
+    """
+    __slots__ = ()
+
+
+def _ps1_literal(text):
+    """
+    :return: unquoted string value of text, PowershellExpression when text is not a string or bare word literal
+    """
+    if text[:1] in _PS1_QUOTES and _PS1_STRING_RE.fullmatch(text):
+        return _unquote_ps1('dq' if text[0] == '"' else 'sq', text)
+    # Variables are expressions, except for the $true/$false/$null constants
+    if _PS1_LITERAL_RE.fullmatch(text) and (text[:1] != '$' or text.lower() in _PS1_CONSTANTS):
+        return text
+    return PowershellExpression(text)
+
+
+def _ps1_simple_literal(text):
+    """
+    Faster _ps1_literal for values matched by _PS1_SIMPLE_VALUE, whose strings hold no escapes.
+    """
+    if text[0] in _PS1_QUOTES:
+        return text[1:-1]
+    if text[0] == '$' and text.lower() not in _PS1_CONSTANTS:
+        return PowershellExpression(text)
+    return text
+
+
+def _ps1_table(text):
+    table = OrderedDict()
+    for match in _PS1_TABLE_ENTRY_RE.finditer(text, 2, len(text) - 1):
+        key = _ps1_literal(match.group('key'))
+        if isinstance(key, str):
+            table[key] = _ps1_literal(match.group('value').strip())
+    return table
+
+
+def _ps1_value(text):
+    return _ps1_table(text) if text.startswith('@{') and text.endswith('}') else _ps1_literal(text)
+
+
+def _ps1_arguments(text):
+    """
+    Splits the arguments of a command into its named parameters and positional arguments.
+
+    :return tuple: dict of { lowercased parameter name => value or True for switches }, list of positional values
+    """
+    tokens = [(match.lastgroup, match.group()) for match in _PS1_ARGUMENT_RE.finditer(text)]
+    params = {}
+    args = []
+    pos = 0
+    while pos < len(tokens):
+        kind, token = tokens[pos]
+        pos += 1
+        if kind == 'comma':
+            continue
+        if kind == 'param':
+            if not token.endswith(':') and (pos == len(tokens) or tokens[pos][0] in ('param', 'comma')):
+                params[token[1:].lower()] = True # switch parameter
+                continue
+            name = token[1:].rstrip(':').lower()
+            if pos == len(tokens):
+                params[name] = PowershellExpression('') # -Param: at the end of the statement
+                continue
+            kind, token = tokens[pos]
+            pos += 1
+        else:
+            name = None
+        value = _ps1_value(token)
+        # Comma separated values make up an array
+        if pos < len(tokens) and tokens[pos][0] == 'comma':
+            parts = [token]
+            while pos + 1 < len(tokens) and tokens[pos][0] == 'comma' and tokens[pos + 1][0] != 'param':
+                parts.append(tokens[pos + 1][1])
+                pos += 2
+            value = PowershellExpression(','.join(parts))
+        if name is None:
+            args.append(value)
+        else:
+            params[name] = value
+    return params, args
+
+
+class PowershellSettingIndex:
+    """
+    Index of setting writes (Set-ItemProperty and Set-WebConfigurationProperty) found in a PowerShell script.
+    Setting write statements are picked out by a single regular expression, whatever the parameter order, quoting
+    and line continuations used by the source, and the rest of the script is skipped. Every setting then looks its
+    value up in O(1).
+
+    Keys are built by registry_key() and webconfig_key(), values are the raw (still encoded) string values.
+    """
+    REGISTRY_CMDLET = 'set-itemproperty'
+    WEBCONFIG_CMDLET = 'set-webconfigurationproperty'
+    REGISTRY_POSITIONAL = ('path', 'name', 'value')
+    DEFAULT_WEBCONFIG_KEY_PATH = DEFAULT_WEBCONFIG_PATH.lower()
+
+    def __init__(self, data):
+        self.source = data
+        self.values = {}
+        self.duplicates = set()
+        lowered = data.lower()
+        # Some characters lowercase to several, lowercasing ascii only keeps offsets into data valid. Keys are then
+        # lowercased by registry_key() and webconfig_key() on the slow path
+        fast = len(lowered) == len(data)
+        if not fast:
+            lowered = _PS1_ASCII_UPPER_RE.sub(lambda match: match.group().lower(), data)
+        values = self.values
+        for match in _PS1_SETTING_WRITE_RE.finditer(lowered):
+            start = match.start()
+            if start and lowered[start - 1] != '\n' and not self._statement_start(lowered, start):
+                continue
+            cmdlet, path, name, filter_, value, other = match.group('cmdlet', 'path', 'name', 'filter', 'value', 'other')
+            end = match.end()
+            if not fast or other is not None or value is None or (end < len(data) and data[end] not in _PS1_STATEMENT_END):
+                params, args = _ps1_arguments(_PS1_ARGUMENTS_RE.match(data, match.end('cmdlet')).group())
+                if cmdlet == 'itemproperty':
+                    self._index_registry(params, args)
+                else:
+                    self._index_webconfig(params)
+                continue
+
+            # Key parts are read lowercased, the value as written. Key parts given by variables are not known
+            if name is None or name[0] == '$' or (path is not None and path[0] == '$') \
+                    or (filter_ is not None and filter_[0] == '$'):
+                continue
+            if name[0] in _PS1_QUOTES:
+                name = name[1:-1]
+            if path is not None and path[0] in _PS1_QUOTES:
+                path = path[1:-1]
+            if cmdlet == 'itemproperty':
+                if path is None:
+                    continue
+                key = (self.REGISTRY_CMDLET, path, name)
+            else:
+                if filter_ is None or name == '.':
+                    continue
+                if filter_[0] in _PS1_QUOTES:
+                    filter_ = filter_[1:-1]
+                key = (self.WEBCONFIG_CMDLET, self.DEFAULT_WEBCONFIG_KEY_PATH if path is None else path.rstrip('/'),
+                       filter_.strip('/'), name)
+            if key in values:
+                self.duplicates.add(key)
+            values[key] = _ps1_simple_literal(data[match.start('value'):match.end('value')])
+
+    @staticmethod
+    def _statement_start(lowered, pos):
+        """
+        Tells whether the command at pos starts a statement, rather than being part of a comment, a string or of
+        the arguments of another command.
+        """
+        line = lowered[lowered.rfind('\n', 0, pos) + 1:pos]
+        if not line or line.isspace():
+            return True
+        head = line.rstrip()
+        return head[-1] in _PS1_STATEMENT_START and '#' not in line and not line.count('"') % 2 \
+            and not line.count("'") % 2
+
+    @staticmethod
+    def registry_key(path, name):
+        return (PowershellSettingIndex.REGISTRY_CMDLET, path.lower(), name.lower())
+
+    @staticmethod
+    def webconfig_key(path, filter, name):
+        # pylint: disable=redefined-builtin
+        return (PowershellSettingIndex.WEBCONFIG_CMDLET, path.rstrip('/').lower(), filter.strip('/').lower(), name.lower())
+
+    def _add(self, key, value):
+        if key in self.values:
+            self.duplicates.add(key)
+        self.values[key] = value
+
+    def _index_registry(self, params, args):
+        params = dict(zip(self.REGISTRY_POSITIONAL, args), **params)
+        path = params.get('path') or params.get('literalpath') or params.get('pspath')
+        name = params.get('name')
+        if not isinstance(path, str) or not isinstance(name, str) or 'value' not in params:
+            return
+        self._add(self.registry_key(path, name), params['value'])
+
+    def _index_webconfig(self, params):
+        path = params.get('pspath', DEFAULT_WEBCONFIG_PATH)
+        location = params.get('location')
+        filter_ = params.get('filter')
+        name = params.get('name', '.')
+        value = params.get('value')
+        if not isinstance(path, str) or not isinstance(filter_, str) or not isinstance(name, str) \
+                or 'value' not in params:
+            return
+        if isinstance(location, str) and location:
+            path = '{}/{}'.format(path.rstrip('/'), location.strip('/'))
+        # Coalesced writes (Set-WebConfiguration or Set-WebConfigurationProperty -Name .) set several attributes
+        # of the section at once from a hashtable
+        if name == '.' and isinstance(value, dict):
+            for attribute, attribute_value in value.items():
+                self._add(self.webconfig_key(path, filter_, attribute), attribute_value)
+        elif name != '.':
+            self._add(self.webconfig_key(path, filter_, name), value)
+
+    def lookup(self, key, default=None):
+        """
+        Returns the raw value written for key or default when the script does not write it.
+        Raises SettingRuntimeException when the script writes the same key more than once, or writes it with
+        something else than a literal value.
+        """
+        if key in self.duplicates:
+            raise SettingRuntimeException('Found more than one value for setting {} in the provided powershell '
+                                          'text'.format(q(key[-1])))
+        if key not in self.values:
+            return default
+        value = self.values[key]
+        if not isinstance(value, str):
+            raise SettingRuntimeException('Setting {} is written with {} in the provided powershell text, only '
+                                          'literal values can be decoded'.format(q(key[-1]), q(getattr(value, 'text', value))))
+        return value
+
+
+# Selective JSON decoding
+# Walks describe json text pulling out only the keys of a selection tree: a dict of { key => sub-selection } where a
+# sub-selection of None takes the value as is and a dict descends into the (object) value. Unselected values are
+# skipped over: their objects are never assembled nor kept (see _json_skipper)
+_JSON_WS_RE = re.compile(r'[ \t\n\r]*')
+_JSON_SCALAR_RE = re.compile(r'[^,}\]\s]*')
+_json_decoder = json.JSONDecoder()
+_json_scanstring = json.decoder.scanstring
+
+
+def _discard_json_pairs(pairs):
+    return None
+
+
+# NOTE: the C scanner is an order of magnitude faster at matching brackets (strings may contain some) than any
+#   python/regex level scanning. Discarding every object as soon as its pairs are scanned keeps it from building the tree
+_json_skipper = json.JSONDecoder(object_pairs_hook=_discard_json_pairs)
+
+
+def _skip_json_value(data, idx):
+    char = data[idx]
+    if char == '"':
+        return _json_scanstring(data, idx + 1)[1]
+    if char in '{[':
+        return _json_skipper.raw_decode(data, idx)[1]
+    return _JSON_SCALAR_RE.match(data, idx).end()
+
+
+def _select_json_value(data, idx, selection):
+    if data[idx] != '{':
+        # Selected object is null (or not an object at all), hand it over as is
+        return _json_decoder.raw_decode(data, idx)
+    selected = {}
+    idx = _JSON_WS_RE.match(data, idx + 1).end()
+    if data[idx] == '}':
+        return selected, idx + 1
+    while True:
+        if data[idx] != '"':
+            raise ValueError('Expecting property name enclosed in double quotes at {}'.format(idx))
+        key, idx = _json_scanstring(data, idx + 1)
+        idx = _JSON_WS_RE.match(data, idx).end()
+        if data[idx] != ':':
+            raise ValueError("Expecting ':' delimiter at {}".format(idx))
+        idx = _JSON_WS_RE.match(data, idx + 1).end()
+
+        if key not in selection:
+            idx = _skip_json_value(data, idx)
+        elif selection[key] is None:
+            selected[key], idx = _json_decoder.raw_decode(data, idx)
+        else:
+            selected[key], idx = _select_json_value(data, idx, selection[key])
+
+        idx = _JSON_WS_RE.match(data, idx).end()
+        if data[idx] == '}':
+            return selected, idx + 1
+        if data[idx] != ',':
+            raise ValueError("Expecting ',' delimiter at {}".format(idx))
+        idx = _JSON_WS_RE.match(data, idx + 1).end()
+
+
+BYTES_LIKE_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+_TEXT_BOMS = ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF32_BE, 'utf-32'), (codecs.BOM_UTF32_LE, 'utf-32'),
+              (codecs.BOM_UTF16_BE, 'utf-16'), (codecs.BOM_UTF16_LE, 'utf-16'))
+
+
+def detect_text_encoding(head):
+    """
+    Detects the encoding of json (or powershell) text from its first 4 bytes, as json.detect_encoding (python 3.6+)
+    does: from its BOM or else from the position of the null bytes of its first (ascii) characters.
+
+    :param head: bytes, first 4 bytes of the text (or less)
+    :return str: codec name
+    """
+    for bom, encoding in _TEXT_BOMS:
+        if head.startswith(bom):
+            return encoding
+    if len(head) >= 4 and not head[0] and not head[1] and not head[2]:
+        return 'utf-32-be'
+    if len(head) >= 4 and not head[1] and not head[2] and not head[3]:
+        return 'utf-32-le'
+    if len(head) >= 2 and not head[0]:
+        return 'utf-16-be'
+    if len(head) >= 2 and not head[1]:
+        return 'utf-16-le'
+    return 'utf-8'
+
+
+def fspath(data):
+    """
+    :return: file system path of data when it is a path object (os.PathLike or, on python 3.5 where pathlib paths
+        aren't os.PathLike yet, pathlib path), else None
+    """
+    method = getattr(type(data), '__fspath__', None)
+    if method is not None:
+        return method(data)
+    pathlib = sys.modules.get('pathlib') # data can't be a pathlib path unless pathlib was imported
+    if pathlib is not None and isinstance(data, pathlib.PurePath):
+        return str(data)
+    return None
+
+
+def decode_text(data):
+    """
+    Decodes bytes-like text (bytes, bytearray, memoryview or mmap) as written by powershell: utf-8 or utf-16/32
+    (eg. Out-File default of Windows PowerShell), with or without BOM. The buffer is decoded in place, no
+    intermediate bytes copy of it is made.
+
+    :return str: decoded text, without BOM
+    """
+    return str(data, detect_text_encoding(bytes(data[:4])))
+
+
+def select_json(data, selection):
+    """
+    Decodes only the selected keys of a json object.
+
+    :param data: json text (str, bytes-like or file-like object) whose top level value is an object
+    :param selection: selection tree, dict of { key => None (take value) or nested selection dict }
+    :return dict: decoded object restricted to the selection
+    """
+    if hasattr(data, 'read') and not isinstance(data, mmap.mmap):
+        data = data.read()
+    if isinstance(data, BYTES_LIKE_TYPES):
+        data = decode_text(data)
+    try:
+        idx = _JSON_WS_RE.match(data).end()
+        selected, idx = _select_json_value(data, idx, selection)
+    except IndexError:
+        raise ValueError('Unexpected end of json data')
+    if not isinstance(selected, dict) or _JSON_WS_RE.match(data, idx).end() != len(data):
+        raise ValueError('Extra data after json object at {}'.format(idx))
+    return selected
+
+
 # Dotnet base class
+def _share_class_attr(setting, name, factory):
+    """
+    Computes immutable per class data once, on the first instance, and stores it on the class for every instance
+    to share.
+    """
+    cls = setting.__class__
+    if name not in cls.__dict__:
+        setattr(cls, name, factory())
+
+
+def _restore_setting(setting_class, state):
+    """
+    Unpickles a setting without running __init__ (its state was validated when it was built).
+
+    :param setting_class: setting class, or name of a registered one
+    :param state: instance dict
+    """
+    if isinstance(setting_class, str):
+        name, setting_class = setting_class, get_setting_class(setting_class)
+        if setting_class is None:
+            raise SettingConfigException('Setting {} is not supported in dotnet encoder'.format(q(name)))
+    setting = setting_class.__new__(setting_class)
+    setting.__dict__.update(state)
+    setting._share_class_state() # pylint: disable=protected-access
+    return setting
+
+
 class DotnetRangeSetting(BaseRangeSetting):
     value_encoder = None
     system_default = None
+    activation = ACTIVATION_NONE # one of ACTIVATION_LEVELS, can be overridden by the activation key of setting config
 
     def __init__(self, config=None):
         super().__init__(config)
@@ -45,6 +813,33 @@ class DotnetRangeSetting(BaseRangeSetting):
         if self.system_default is None: # feel free to remove this in the case of dotnet settings with no system defaults
             raise NotImplementedError('You must provide system_default for dotnet setting {} '
                                       'handled by class {}'.format(q(self.name), self.__class__.__name__))
+
+        self._share_class_state()
+
+        # NOTE: instances only hold what differs from their class, keeping thousands of them cheap
+        activation = (config or {}).get('activation')
+        if activation is not None and activation != self.activation:
+            self.activation = activation
+        if self.activation not in ACTIVATION_LEVELS:
+            raise SettingConfigException('Unrecognized activation {} of dotnet setting {}. Supported: {}'.format(
+                q(self.activation), q(self.name), ', '.join(map(q, ACTIVATION_LEVELS))))
+
+    def _share_class_state(self):
+        """
+        Computes the immutable state shared by every instance of the class, see _share_class_attr. Also called on
+        instances restored from a compiled encoder cache, which skip __init__.
+        """
+        # Resolved once per class so that encode calls in the hot path don't redo it
+        _share_class_attr(self, '_resolved_encoder', self.get_value_encoder)
+
+    def __reduce__(self):
+        # Registered classes are restored by name, so that catalog compiled classes can be pickled
+        cls = self.__class__
+        return _restore_setting, (cls.name if SETTING_REGISTRY.get(cls.name) is cls else cls, self.__dict__)
+
+    @property
+    def activation_level(self):
+        return ACTIVATION_LEVELS.index(self.activation)
     
     def describe(self):
         retVal = super().describe()
@@ -53,9 +848,15 @@ class DotnetRangeSetting(BaseRangeSetting):
             retVal[1]['unit'] = self.unit
         return retVal
 
-    def format_value(self, value):
+    def format_prefix(self):
+        """
+        Renders the constant part of the powershell line that sets this setting, up to (not including) the value.
+        """
         raise NotImplementedError()
 
+    def format_value(self, value):
+        return self.value_prefix + value + '\n'
+
     def get_value_encoder(self):
         if callable(self.value_encoder):
             # pylint: disable=not-callable
@@ -69,14 +870,71 @@ class DotnetRangeSetting(BaseRangeSetting):
         :param value: Single primitive value
         :return list: List of multiple primitive values
         """
-        value = self.validate_value(value)
-        encoded_value = self.get_value_encoder().encode(value)
-        return self.format_value(encoded_value)
+        return self.format_value(self.encode_value(value))
+
+    def encode_value(self, value):
+        """
+        Validates single primitive value and encodes it into its powershell literal.
+
+        :param value: Single primitive value
+        :return str: Encoded value
+        """
+        return self._resolved_encoder.encode(self.validate_value(value))
+
+    def legal_values(self):
+        """
+        :return RangeValues: lazy sequence of the values legal for this setting, based on describe()
+        """
+        described = self.describe()[1]
+        return RangeValues(described['min'], described['max'], described['step'])
+
+    def validate_values(self, values):
+        """
+        Validates a whole array of candidate values at once, snapping each of them to the closest step.
+
+        :param values: numpy array (or array like) of primitive values
+        :return numpy.ndarray: snapped values
+        """
+        _require_numpy()
+        values = numpy.asarray(values, dtype=numpy.float64)
+        invalid = ~numpy.isfinite(values)
+        if invalid.any():
+            raise SettingRuntimeException('Value {} of setting {} is not a finite number'.format(
+                values[invalid][0], q(self.name)))
+
+        step = self.step or 1
+        snapped = self.min + numpy.round((values - self.min) / step) * step
+        invalid = (snapped < self.min) | (snapped > self.max)
+        if invalid.any():
+            raise SettingRuntimeException('{} value(s) of setting {} out of range [{}, {}], first: {}'.format(
+                int(invalid.sum()), q(self.name), self.min, self.max, values[invalid][0]))
+        return snapped
+
+    def encode_values(self, values):
+        """
+        Array counterpart of encode_value: validates, snaps and encodes whole arrays of candidate values.
+
+        :param values: numpy array (or array like) of primitive values
+        :return numpy.ndarray: encoded values (str)
+        """
+        return self._resolved_encoder.encode_array(self.validate_values(values))
+
+    def value_differs(self, encoded_value, current):
+        """
+        Tells whether writing encoded_value (as returned by encode_value) would change the setting, given its
+        currently decoded value. An unknown (None) current value is always considered to differ.
+        """
+        if current is None:
+            return True
+        try:
+            return encoded_value != self._resolved_encoder.encode(current)
+        except (TypeError, ValueError):
+            return True
 
     def decode_option(self, data):
         if isinstance(data, dict):
             return self.decode_option_json(data)
-        elif isinstance(data, str):
+        elif isinstance(data, (str, PowershellSettingIndex)):
             return self.decode_option_ps1(data)
         else:
             raise SettingRuntimeException('Unrecognized data type passed on decode_option in dotnet encoder setting: {}. '
@@ -99,11 +957,21 @@ class RegistryRangeSetting(DotnetRangeSetting):
             raise NotImplementedError('You must provide path for registry setting {} '
                                       'handled by class {}'.format(q(self.name), self.__class__.__name__))
 
-    def encode_describe(self):
+    def _share_class_state(self):
+        super()._share_class_state()
+        _share_class_attr(self, 'value_prefix', self.format_prefix)
+
+    def encode_describe(self, properties=None):
+        """
+        :param properties: optional list of registry value names to project the described key onto
+        """
+        if properties:
+            return '"{path}" = (Get-ItemProperty -Path "{path}" | Select-Object -Property {properties})'.format(
+                path=self.path, properties=format_ps1_list(properties))
         return '"{path}" = Get-ItemProperty -Path "{path}"'.format(path=self.path)
 
-    def format_value(self, value):
-        return 'Set-ItemProperty -Path "{path}" -Name "{name}" -Value {value}\n'.format(path=self.path, name=self.name, value=value)
+    def format_prefix(self):
+        return 'Set-ItemProperty -Path "{path}" -Name "{name}" -Value '.format(path=self.path, name=self.name)
 
     def decode_option_json(self, data):
         """
@@ -115,12 +983,16 @@ class RegistryRangeSetting(DotnetRangeSetting):
         # NOTE: because json structure is used during adjust as validation, it is built to be more fail-deadly
         #       as these failures would indicate an out of date describe.ps1
         reg = data.get(self.path, None)
-        if not reg:
+        # NOTE: an empty dict is a key without values (eg. selectively decoded describe), not a missing one
+        if reg is None or not isinstance(reg, dict):
             raise SettingRuntimeException("Registry path {} for setting {} was not found in describe data".format(self.path, self.name))
 
         # NOTE: Until registry options are set, getting the registry path will return no keys but each of the settings does have a system default value
-        #    which will be considered to be in effect in cases where the path in data has no keys
-        value = reg.get(self.name, self.system_default)
+        #    which will be considered to be in effect in cases where the path in data has no keys. Slim describe projects
+        #    the key onto the setting names so unset values come in as null instead
+        value = reg.get(self.name)
+        if value is None:
+            value = self.system_default
         try:
             return self.get_value_encoder().decode(value)
         except ValueError as e:
@@ -128,15 +1000,16 @@ class RegistryRangeSetting(DotnetRangeSetting):
                                             'Error: {}. Arg: {}'.format(q(self.name), str(e), value))
     
     def decode_option_ps1(self, data):
-        lines = data.split('\n')
-        # TODO?: refactor below so that it won't break when parameter order of source is different than expected/not sourced from this encoder
-        setting_line = list(filter(lambda l: l.startswith('Set-ItemProperty -Path "{}" -Name "{}" -Value '.format(self.path, self.name)), lines))
-        if len(setting_line) > 1:
-            raise SettingRuntimeException("Found more than one value for registry setting {} in the provided powershel text:\n{}", q(self.name), data)
-        if len(setting_line) < 1:
-            value = self.system_default # Even if registry settings are not adjusted, the system default value is in effect
-        else:
-            value = setting_line[0].split()[-1]
+        """
+        Decodes setting value written by a powershell script back into single primitive value of the current setting.
+
+        :param data: powershell script text or PowershellSettingIndex built from it
+        :return: Single primitive value
+        """
+        if not isinstance(data, PowershellSettingIndex):
+            data = PowershellSettingIndex(data)
+        # Even if registry settings are not adjusted, the system default value is in effect
+        value = data.lookup(PowershellSettingIndex.registry_key(self.path, self.name), self.system_default)
 
         try:
             return self.get_value_encoder().decode(value)
@@ -156,28 +1029,68 @@ class RegistryBooleanSetting(RegistryRangeSetting):
 
 
 # Webconfig base classes
-# TODO: finish impelementing handling of path param to functions for support of hierarchical settings
 class WebConfigRangeSetting(DotnetRangeSetting):
-    default_path = 'MACHINE/WEBROOT/APPHOST'
+    default_path = DEFAULT_WEBCONFIG_PATH
     filter = None
     name_override = None
+    activation = ACTIVATION_APP_POOL_RECYCLE
 
-    def __init__(self, config=None):
+    def __init__(self, config=None, path=None):
+        """
+        :param config: setting config dict
+        :param path: IIS configuration path (eg. MACHINE/WEBROOT/APPHOST/SiteA) the setting applies to,
+            defaults to default_path. Used as the default of every path argument below.
+        """
         super().__init__(config)
         if self.filter is None:
             raise NotImplementedError('You must provide a filter for web config setting {} '
                                       'handled by class {}'.format(q(self.name), self.__class__.__name__))
+        path = path.rstrip('/') if path else self.default_path
+        if path != self.default_path:
+            self.path = path
+            self.value_prefix = self.format_prefix()
+
+    def _share_class_state(self):
+        super()._share_class_state()
+        # Instances for the default path use the class' path and prefix
+        _share_class_attr(self, 'path', lambda: self.default_path)
+        _share_class_attr(self, 'value_prefix', lambda: self.format_prefix(self.default_path))
 
     # NOTE: only runs once per unique setting filter property (per path)
-    def encode_describe(self, path=None):
+    def encode_describe(self, path=None, properties=None):
+        """
+        :param path: IIS configuration path, defaults to the one of the setting
+        :param properties: optional list of attribute names to project the described section onto
+        """
         if path is None:
-            path = self.default_path 
+            path = self.path
+        if properties:
+            return '(Get-WebConfiguration -pspath "{}" -filter "{}" | Select-Object -Property {})'.format(
+                path, self.filter, format_ps1_list(properties))
         return 'Get-WebConfiguration -pspath "{}" -filter "{}"'.format(path, self.filter)
 
-    def format_value(self, value, path=None):
+    def format_prefix(self, path=None):
         if path is None:
-            path = self.default_path 
-        return 'Set-WebConfigurationProperty -Filter "{filter}" -PSPath "{path}" -Name "{name}" -Value {value}\n'.format(filter=self.filter, path=path, name=self.name_override or self.name, value=value)
+            path = self.path
+        return 'Set-WebConfigurationProperty -Filter "{filter}" -PSPath "{path}" -Name "{name}" -Value '.format(filter=self.filter, path=path, name=self.name_override or self.name)
+
+    def format_section(self, attributes, path=None):
+        """
+        Renders a single powershell line setting several attributes of the section (filter) of this setting.
+
+        :param attributes: dict of { attribute name => encoded value }
+        :param path: IIS configuration path, defaults to the one of the setting
+        """
+        if path is None:
+            path = self.path
+        return 'Set-WebConfiguration -Filter "{filter}" -PSPath "{path}" -Value @{{{attributes}}}\n'.format(
+            filter=self.filter, path=path, attributes='; '.join(
+                '{}={}'.format(format_ps1_list((name,)), format_ps1_list((value,))) for name, value in attributes.items()))
+
+    def format_value(self, value, path=None):
+        if path is None or path == self.path:
+            return self.value_prefix + value + '\n'
+        return self.format_prefix(path) + value + '\n'
 
     def encode_option(self, value, path=None):
         """
@@ -186,16 +1099,12 @@ class WebConfigRangeSetting(DotnetRangeSetting):
         :param value: Single primitive value
         :return list: List of multiple primitive values
         """
-        if path is None:
-            path = self.default_path 
-        value = self.validate_value(value)
-        encoded_value = self.get_value_encoder().encode(value)
-        return self.format_value(encoded_value, path)
+        return self.format_value(self.encode_value(value), path)
 
     def decode_option(self, data, path=None):
         if isinstance(data, dict):
             return self.decode_option_json(data, path)
-        elif isinstance(data, str):
+        elif isinstance(data, (str, PowershellSettingIndex)):
             return self.decode_option_ps1(data, path)
         else:
             raise SettingRuntimeException('Unrecognized data type passed on decode_option in dotnet encoder setting: {}. '
@@ -210,7 +1119,7 @@ class WebConfigRangeSetting(DotnetRangeSetting):
         :return: Single primitive value
         """
         if path is None:
-            path = self.default_path 
+            path = self.path
 
         wc = data.get("WebConfig")
         # NOTE: because json structure is used during adjust as validation, it is built to be more fail-deadly
@@ -225,11 +1134,16 @@ class WebConfigRangeSetting(DotnetRangeSetting):
             raise SettingRuntimeException("WebConfig dict for path:setting {}:{} was found but had no key values".format(path, self.name))
 
         name_locator = self.name_override if self.name_override else self.name
-        try:
-            value = wc[path][self.filter][name_locator]
-        except KeyError:
+        section = wc.get(path)
+        if isinstance(section, dict):
+            section = section.get(self.filter)
+        if not isinstance(section, dict) or name_locator not in section:
             raise SettingRuntimeException("Unable to located value of setting in path '{}' under filter '{}' by name(_override) '{}'"
                     " within the describe data provided".format( path, self.filter, name_locator))
+        # NOTE: as for registry settings, an attribute coming in as null has its system default in effect
+        value = section[name_locator]
+        if value is None:
+            value = self.system_default
         try:
             return self.get_value_encoder().decode(value)
         except ValueError as e:
@@ -237,20 +1151,20 @@ class WebConfigRangeSetting(DotnetRangeSetting):
                                             'Error: {}. Arg: {}'.format(q(self.name), str(e), value))
 
     def decode_option_ps1(self, data, path=None):
-        lines = data.split('\n')
-        # TODO?: refactor below so that it won't break when parameter order of source is different than expected/not sourced from this encoder
-        setting_line = list(filter(
-            lambda l: l.startswith('Set-WebConfigurationProperty -Filter "{}" -PSPath "{}" -Name "{}" -Value '.format(
-                self.filter, 
-                path if path else self.default_path, 
-                self.name_override if self.name_override else self.name)), 
-            lines))
-        if len(setting_line) > 1:
-            raise SettingRuntimeException("Found more than one value for registry setting {} in the provided powershel text:\n{}", q(self.name), data)
-        if len(setting_line) < 1:
-            value = self.system_default # If web config settings are not adjusted, the system default value is in effect so long as the site exists
-        else:
-            value = setting_line[0].split()[-1]
+        """
+        Decodes setting value written by a powershell script back into single primitive value.
+
+        :param data: powershell script text or PowershellSettingIndex built from it
+        :param path: path string from parent WebConfigSetting config_list
+        :return: Single primitive value
+        """
+        if path is None:
+            path = self.path
+        if not isinstance(data, PowershellSettingIndex):
+            data = PowershellSettingIndex(data)
+        # If web config settings are not adjusted, the system default value is in effect so long as the site exists
+        value = data.lookup(PowershellSettingIndex.webconfig_key(path, self.filter, self.name_override or self.name),
+                            self.system_default)
 
         try:
             return self.get_value_encoder().decode(value)
@@ -266,113 +1180,802 @@ class WebConfigBooleanSetting(WebConfigRangeSetting):
     relaxable = False
 
 
-# Derived Settings classes
-## Registry
-class UriEnableCacheSetting(RegistryBooleanSetting):
-    name = 'UriEnableCache'
-    path = r'HKLM:\System\CurrentControlSet\Services\Http\Parameters'
-    system_default = 1
+# Setting catalog
+HTTP_PARAMETERS_PATH = r'HKLM:\System\CurrentControlSet\Services\Http\Parameters'
+IIS_CACHING_FILTER = 'system.webServer/caching'
+
+# Declarative table of the supported settings, compiled into setting classes by register_settings. Columns:
+#   name: setting name as configured (the compiled class is named <name>Setting)
+#   kind: key of SETTING_KINDS, selecting the base class
+#   path (registry) / filter (webconfig): where the value lives
+#   name_override: attribute name when it differs from the setting name (webconfig)
+#   encoder: key of VALUE_ENCODERS, defaults to int
+#   system_default: value in effect when never set
+#   default, min, max, step, unit, relaxable, activation: same as setting class attributes, min/max/step default to
+#       a boolean range
+SETTING_CATALOG = (
+    ## Registry (HTTP.sys)
+    {'name': 'UriEnableCache', 'kind': 'registry', 'path': HTTP_PARAMETERS_PATH, 'system_default': 1,
+     'activation': ACTIVATION_HTTP_RESTART}, # HTTP.sys only reads its parameters on start
+    {'name': 'UriScavengerPeriod', 'kind': 'registry', 'path': HTTP_PARAMETERS_PATH, 'system_default': 120,
+     'unit': 'seconds', 'min': 10, 'max': 0xFFFFFFFF, 'activation': ACTIVATION_HTTP_RESTART},
+    ## Web Configuration (IIS)
+    # name_override: the attribute name wouldn't be descriptive enough in the context of a settings file
+    {'name': 'WebConfigCacheEnabled', 'kind': 'webconfig', 'filter': IIS_CACHING_FILTER, 'name_override': 'enabled',
+     'encoder': 'bool', 'system_default': 1},
+    {'name': 'WebConfigEnableKernelCache', 'kind': 'webconfig', 'filter': IIS_CACHING_FILTER,
+     'name_override': 'enableKernelCache', 'encoder': 'bool', 'system_default': 1},
+    {'name': 'WebConfigMaxResponseSize', 'kind': 'webconfig', 'filter': IIS_CACHING_FILTER,
+     'name_override': 'maxResponseSize', 'system_default': 262144, 'unit': 'bytes', 'min': 0, 'max': 0x7FFFFFFF},
+)
+SETTING_KINDS = {'registry': RegistryRangeSetting, 'webconfig': WebConfigRangeSetting}
+SETTING_KIND_LOCATIONS = {'registry': 'path', 'webconfig': 'filter'}
+VALUE_ENCODERS = {'int': IntToStrValueEncoder(), 'bool': IntToBoolValueEncoder()}
+SETTING_CATALOG_COLUMNS = frozenset(('name', 'kind', 'path', 'filter', 'name_override', 'encoder', 'system_default',
+                                     'default', 'min', 'max', 'step', 'unit', 'relaxable', 'activation'))
+# Third party catalogs: entry points of this group resolve to a catalog (iterable of rows and/or setting classes) or
+# to a callable returning one. They are only loaded when a configured setting is missing from the registry
+SETTING_CATALOG_ENTRY_POINT_GROUP = 'encoders.dotnet.settings'
+
+SETTING_REGISTRY = {} # { setting name => setting class }
+_registry_generation = 0 # bumped on every registration, invalidating encoder states compiled before it
+_entry_points_loaded = False
+_entry_points_lock = threading.Lock()
+
+
+def compile_setting(row):
+    """
+    Compiles a setting catalog row (see SETTING_CATALOG) into a setting class.
+
+    :param row: dict of catalog columns
+    :return type: DotnetRangeSetting subclass
+    """
+    unknown = set(row).difference(SETTING_CATALOG_COLUMNS)
+    if unknown:
+        raise SettingConfigException('Unrecognized column(s) {} in dotnet setting catalog row {}'.format(
+            ', '.join(map(q, sorted(unknown))), q(row.get('name'))))
+    try:
+        name = row['name']
+        kind = row['kind']
+        base = SETTING_KINDS[kind]
+        location = SETTING_KIND_LOCATIONS[kind]
+        attrs = {
+            '__module__': __name__,
+            'name': name,
+            location: row[location],
+            'value_encoder': VALUE_ENCODERS[row.get('encoder', 'int')],
+            'system_default': row['system_default'],
+            'min': row.get('min', 0),
+            'max': row.get('max', 1),
+            'step': row.get('step', 1),
+            'relaxable': row.get('relaxable', False),
+        }
+    except KeyError as e:
+        raise SettingConfigException('Invalid dotnet setting catalog row {}: missing or unrecognized {}'.format(
+            q(row.get('name')), str(e)))
+    for column in ('name_override', 'default', 'unit', 'activation'):
+        if column in row:
+            attrs[column] = row[column]
+    return type('{}Setting'.format(name), (base,), attrs)
+
+
+def register_settings(catalog, replace=False):
+    """
+    Adds settings to the registry used by Encoder to resolve configured setting names.
+
+    :param catalog: iterable of catalog rows (see SETTING_CATALOG) and/or DotnetRangeSetting subclasses
+    :param replace: whether settings already registered under the same name can be replaced
+    :return list: registered setting classes
+    """
+    classes = []
+    for row in catalog:
+        setting_class = row if isinstance(row, type) else compile_setting(row)
+        if not issubclass(setting_class, DotnetRangeSetting):
+            raise SettingConfigException('Setting class {} registered in dotnet encoder must derive from '
+                                         'DotnetRangeSetting'.format(q(setting_class.__name__)))
+        if not replace and setting_class.name in SETTING_REGISTRY:
+            raise SettingConfigException('Setting {} is already registered in dotnet encoder'.format(q(setting_class.name)))
+        classes.append(setting_class)
+    global _registry_generation
+    for setting_class in classes:
+        SETTING_REGISTRY[setting_class.name] = setting_class
+    _registry_generation += 1
+    return classes
+
+
+def _iter_entry_points(group):
+    try:
+        from importlib import metadata
+    except ImportError: # python < 3.8
+        try:
+            import pkg_resources
+        except ImportError:
+            return ()
+        return pkg_resources.iter_entry_points(group)
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return entry_points.select(group=group)
+    return entry_points.get(group, ())
+
+
+def load_setting_entry_points():
+    """
+    Registers the setting catalogs of SETTING_CATALOG_ENTRY_POINT_GROUP entry points, once per process.
+    """
+    global _entry_points_loaded
+    with _entry_points_lock:
+        if _entry_points_loaded:
+            return
+        _entry_points_loaded = True
+        for entry_point in _iter_entry_points(SETTING_CATALOG_ENTRY_POINT_GROUP):
+            try:
+                catalog = entry_point.load()
+                if callable(catalog) and not isinstance(catalog, type):
+                    catalog = catalog()
+            except Exception as e:
+                raise SettingConfigException('Unable to load dotnet setting catalog from entry point {}: {}'.format(
+                    q(entry_point.name), str(e)))
+            register_settings(catalog)
+
+
+def get_setting_class(name):
+    """
+    :return type: setting class registered for name, None when no catalog (built in or plugged in) provides it
+    """
+    setting_class = SETTING_REGISTRY.get(name)
+    if setting_class is None and not _entry_points_loaded:
+        load_setting_entry_points()
+        setting_class = SETTING_REGISTRY.get(name)
+    return setting_class
+
+
+register_settings(SETTING_CATALOG)
+# Names the settings had as hand written classes
+UriEnableCacheSetting = SETTING_REGISTRY['UriEnableCache']
+UriScavengerPeriodSetting = SETTING_REGISTRY['UriScavengerPeriod']
+WebConfigCacheEnabledSetting = SETTING_REGISTRY['WebConfigCacheEnabled']
+WebConfigEnableKernelCacheSetting = SETTING_REGISTRY['WebConfigEnableKernelCache']
+WebConfigMaxResponseSizeSetting = SETTING_REGISTRY['WebConfigMaxResponseSize']
+
+
+# Caching
+def config_fingerprint(config):
+    """
+    :return bytes: short digest identifying an encoder config
+    """
+    canonical = json.dumps(config, sort_keys=True, separators=(',', ':'), default=repr)
+    return hashlib.sha256(canonical.encode('utf-8')).digest()[:16]
+
+
+class LruCache:
+    """
+    Thread safe, size bounded LRU cache with optional time to live of its entries.
+    """
+    def __init__(self, maxsize, ttl=None, clock=time.monotonic):
+        """
+        :param maxsize: maximum number of entries kept
+        :param ttl: seconds after which an entry expires, never when None
+        :param clock: monotonic time source, overridable for tests
+        """
+        if maxsize < 1:
+            raise EncoderConfigException('Cache size must be a positive integer, got {}'.format(q(maxsize)))
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # { key => (value, expires at) }
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[1] is not None and entry[1] <= self.clock():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'expirations': self.expirations, 'size': len(self._entries), 'maxsize': self.maxsize,
+                    'ttl': self.ttl}
+
+
+# Instrumentation
+class Instrumentation:
+    """
+    Opt-in call counts, cumulative and histogram timings of encoder operations by setting (or encoder) class and
+    byte counts of scripts and describe payloads. Enabled through Encoder.enable_instrumentation.
+
+    callback, when provided, is called with (kind, operation, scope, value) on every record where kind is "seconds",
+    "bytes_in" or "bytes_out" and scope is the name of the setting/encoder class.
+    """
+    HISTOGRAM_BOUNDS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0, 10.0) # upper bounds in seconds, plus +Inf bucket
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._timings = {} # { (operation, scope) => [count, total seconds, bucket counts] }
+            self._bytes = {} # { (direction, operation) => [count, total bytes] }
+
+    def record_time(self, operation, scope, seconds):
+        with self._lock:
+            timing = self._timings.get((operation, scope))
+            if timing is None:
+                timing = self._timings[(operation, scope)] = [0, 0.0, [0] * (len(self.HISTOGRAM_BOUNDS) + 1)]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2][bisect.bisect_left(self.HISTOGRAM_BOUNDS, seconds)] += 1
+        if self.callback is not None:
+            self.callback('seconds', operation, scope, seconds)
+
+    def record_bytes(self, direction, operation, scope, size):
+        with self._lock:
+            counter = self._bytes.setdefault((direction, operation), [0, 0])
+            counter[0] += 1
+            counter[1] += size
+        if self.callback is not None:
+            self.callback('bytes_{}'.format(direction), operation, scope, size)
+
+    def snapshot(self):
+        """
+        :return dict: { "timings": { operation => { scope => { "count", "total", "histogram" } } },
+            "bytes": { "in"/"out" => { operation => { "count", "total" } } } }
+        """
+        bounds = ['{:g}'.format(b) for b in self.HISTOGRAM_BOUNDS] + ['+Inf']
+        with self._lock:
+            timings = {}
+            for (operation, scope), (count, total, buckets) in self._timings.items():
+                timings.setdefault(operation, {})[scope] = {
+                    'count': count, 'total': total, 'histogram': dict(zip(bounds, buckets))}
+            transferred = {'in': {}, 'out': {}}
+            for (direction, operation), (count, total) in self._bytes.items():
+                transferred[direction][operation] = {'count': count, 'total': total}
+        return {'timings': timings, 'bytes': transferred}
+
+
+# Setting/encoder methods timed when instrumentation is enabled, by the name of the operation they are reported as.
+# NOTE: encode_option timings are taken on encode_value so that they also cover the encode plan which calls it directly
+INSTRUMENTED_SETTING_METHODS = {
+    'encode_value': 'encode_option',
+    'validate_value': 'validate_value',
+    'decode_option_json': 'decode_option_json',
+    'decode_option_ps1': 'decode_option_ps1',
+    'encode_describe': 'encode_describe',
+}
+INSTRUMENTED_ENCODER_METHODS = {
+    'encode_multi': 'encode_multi',
+    'decode_multi': 'decode_multi',
+    'encode_describe': 'encode_describe',
+}
+
+
+def _timed(func, operation, scope, instrumentation):
+    @functools.wraps(func)
+    def timed(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            instrumentation.record_time(operation, scope, time.perf_counter() - start)
+    return timed
+
+
+def _instrumented_class(cls, methods, instrumentation):
+    """
+    Creates a subclass of cls timing methods into instrumentation. Instances are switched to it (and back) by
+    assigning their __class__, which keeps non instrumented instances free of any overhead.
+    """
+    attrs = {'__slots__': (), '__module__': cls.__module__, 'instrumented_class': cls}
+    for method, operation in methods.items():
+        if hasattr(cls, method):
+            attrs[method] = _timed(getattr(cls, method), operation, cls.__name__, instrumentation)
+    return type(cls.__name__, (cls,), attrs)
+
+
+def _byte_size(data):
+    """
+    :return: size in bytes of text (str, utf-8 encoded as sent to hosts), of a list of lines (as text joined by
+        newlines, see Encoder._format_encoded) or of a bytes-like buffer, else None. Paths are None as decode_multi
+        maps their file and decodes that buffer (counted) in a nested call
+    """
+    if isinstance(data, str):
+        return len(data.encode('utf-8', 'surrogatepass'))
+    if isinstance(data, BYTES_LIKE_TYPES):
+        with memoryview(data) as view:
+            return view.nbytes
+    if isinstance(data, list):
+        if not all(isinstance(line, str) for line in data):
+            return None
+        return sum(len(line.encode('utf-8', 'surrogatepass')) for line in data) + max(len(data) - 1, 0)
+    return None
+
+
+def _counted_bytes(func, direction, instrumentation):
+    @functools.wraps(func)
+    def counted(self, *args, **kwargs):
+        result = func(self, *args, **kwargs)
+        size = _byte_size(result if direction == 'out' else (args[0] if args else kwargs.get('data')))
+        if size is not None:
+            instrumentation.record_bytes(direction, func.__name__, self.instrumented_class.__name__, size)
+        return result
+    return counted
 
-class UriScavengerPeriodSetting(RegistryRangeSetting):
-    value_encoder = IntToStrValueEncoder()
-    name = 'UriScavengerPeriod'
-    path = r'HKLM:\System\CurrentControlSet\Services\Http\Parameters'
-    unit = 'seconds'
-    system_default = 120
-    min = 10
-    max = 0xFFFFFFFF
-    step = 1
-    relaxable = False
 
-## Web Configuration (IIS)
-class WebConfigCacheEnabledSetting(WebConfigBooleanSetting):
-    name = 'WebConfigCacheEnabled'
-    name_override = 'enabled' # <- Wouldn't be descriptive enough in the context of a settings file
-    filter = 'system.webServer/caching'
-    system_default = 1
+# Encoder Class
+EncodePlan = namedtuple('EncodePlan', 'entries names before after')
+WEBADMINISTRATION_IMPORT = 'Import-Module WebAdministration\n'
+WEBCONFIG_COMMIT_DELAY_START = 'Start-WebCommitDelay\n'
+WEBCONFIG_COMMIT_DELAY_STOP = 'Stop-WebCommitDelay -Commit $true\n'
+ENCODE_MANY_CACHE_SIZE = 4096 # encoded (setting, value) pairs kept around by encode_many
+SLIM_DESCRIBE_JSON_DEPTH = 4
+DescribeQuery = namedtuple('DescribeQuery', 'webconfig path filter setting properties')
+ApplyPlan = namedtuple('ApplyPlan', 'script activation changed')
+EncodedScript = namedtuple('EncodedScript', 'script digest')
+EncoderState = namedtuple('EncoderState', 'settings encode_plan describe_selection describe_queries describe_scripts')
+ENCODER_STATE_CACHE_SIZE = 256 # distinct configs whose compiled state is shared between encoders
+COMPILED_CACHE_VERSION = 1 # bump when EncoderState or what it holds changes shape
+# Powershell run after the writes of an apply plan to activate them, by activation level. Each step covers the ones
+# below it: restarting HTTP.sys restarts the IIS services depending on it, which restarts every worker process
+ACTIVATION_SCRIPTS = {
+    ACTIVATION_APP_POOL_RECYCLE: 'Get-ChildItem IIS:\\AppPools | Where-Object { $_.State -eq "Started" } | '
+                                 'ForEach-Object { Restart-WebAppPool -Name $_.Name }\n',
+    ACTIVATION_IIS_RESET: 'iisreset /restart\n',
+    ACTIVATION_HTTP_RESTART: 'Restart-Service -Name HTTP -Force\nStart-Service -Name WAS, W3SVC\n',
+}
+# Recycles only the (distinct) app pools of the given sites
+SITE_APP_POOL_RECYCLE_SCRIPT = '{sites} | ForEach-Object {{ (Get-Website -Name $_).applicationPool }} | ' \
+                               'Select-Object -Unique | ForEach-Object {{ Restart-WebAppPool -Name $_ }}\n'
+ConditionalDescribe = namedtuple('ConditionalDescribe', 'values fingerprint unchanged')
+CONDITIONAL_DESCRIBE_CACHE_SIZE = 1024 # decoded values kept by fingerprint for conditional describes to refer to
+_FINGERPRINT_RE = re.compile(r'[0-9A-Fa-f]*')
+CONDITIONAL_DESCRIBE = '''$describeJson = $describe | ConvertTo-Json -Compress -Depth {depth}
+$describeFingerprint = [BitConverter]::ToString([Security.Cryptography.SHA256]::Create().ComputeHash([Text.Encoding]::UTF8.GetBytes($describeJson))).Replace("-", "")
+if ($describeFingerprint -eq "{fingerprint}") {{
+	@{{ "Unchanged" = $describeFingerprint }} | ConvertTo-Json -Compress
+}} else {{
+	$describe["Fingerprint"] = $describeFingerprint
+	$describe | ConvertTo-Json -Compress -Depth {depth}
+}}
+'''
+PARALLEL_DESCRIBE_MERGE = '''$describeResult = @{ "WebConfig" = @{} }
+foreach ($describeJob in $describeJobs) {
+	$describePart = @($describeJob[0].EndInvoke($describeJob[1]))[0].psobject.BaseObject
+	foreach ($describeKey in $describePart.Keys) {
+		if ($describeKey -eq "WebConfig") {
+			foreach ($describePath in $describePart["WebConfig"].Keys) {
+				if (-not $describeResult["WebConfig"].ContainsKey($describePath)) { $describeResult["WebConfig"][$describePath] = @{} }
+				foreach ($describeFilter in $describePart["WebConfig"][$describePath].Keys) {
+					$describeResult["WebConfig"][$describePath][$describeFilter] = $describePart["WebConfig"][$describePath][$describeFilter]
+				}
+			}
+		} else {
+			$describeResult[$describeKey] = $describePart[$describeKey]
+		}
+	}
+	$describeJob[0].Dispose()
+}
+$describePool.Close()
+'''
+
+
+_shared_encoder_states = LruCache(ENCODER_STATE_CACHE_SIZE)
+
+
+@functools.lru_cache(maxsize=1)
+def _module_version():
+    """
+    :return bytes: identifies this module's code, as of its file, and the python running it
+    """
+    stat = os.stat(__file__)
+    return '{}:{}:{}:{}:{}'.format(COMPILED_CACHE_VERSION, stat.st_mtime_ns, stat.st_size,
+                                   sys.implementation.cache_tag, pickle.HIGHEST_PROTOCOL).encode('utf-8')
+
+
+def compiled_state_path(cache_dir, fingerprint, encoder_class):
+    """
+    :return str: path of the compiled encoder state file of a config fingerprint (see config_fingerprint), encoder
+        class and the current module version in cache_dir
+    """
+    class_name = '{}.{}'.format(encoder_class.__module__, encoder_class.__qualname__).encode('utf-8')
+    key = hashlib.sha256(fingerprint + class_name + _module_version()).hexdigest()[:32]
+    return os.path.join(cache_dir, 'dotnet-encoder-{}.pickle'.format(key))
+
+
+def load_compiled_state(cache_dir, fingerprint, encoder_class):
+    """
+    :return EncoderState: state saved by save_compiled_state, None when missing or unreadable
+    """
+    try:
+        with open(compiled_state_path(cache_dir, fingerprint, encoder_class), 'rb') as f:
+            state = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception: # pylint: disable=broad-except
+        # Corrupt or stale (eg. settings no longer registered) cache, compiled again and overwritten
+        return None
+    return state if isinstance(state, EncoderState) else None
+
+
+def save_compiled_state(cache_dir, fingerprint, encoder_class, state):
+    """
+    Best effort write of the compiled state of an encoder config to cache_dir, atomically replacing any previous one.
+
+    :return bool: whether the state was saved
+    """
+    path = compiled_state_path(cache_dir, fingerprint, encoder_class)
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(temp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        return True
+    except (OSError, pickle.PicklingError, TypeError, AttributeError):
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return False
 
-class WebConfigEnableKernelCacheSetting(WebConfigBooleanSetting):
-    name = 'WebConfigEnableKernelCache'
-    name_override = 'enableKernelCache'
-    filter = 'system.webServer/caching'
-    system_default = 1
 
-# TODO if needed
-# class WebConfigMaxResponseSizeSetting(WebConfigRangeSetting):
-#     name = 'WebConfigMaxResponseSize'
-#     name_override = 'maxResponseSize'
-#     filter = 'system.webServer/caching'
-#     default = 262144
-#     unit = 'bytes'
+def _unique(items):
+    return list(OrderedDict.fromkeys(items))
+
+
+def _site_name(path):
+    """
+    :return str: name of the site an IIS configuration path belongs to, None for server wide paths
+    """
+    if not path.startswith(DEFAULT_WEBCONFIG_PATH + '/'):
+        return None
+    return path[len(DEFAULT_WEBCONFIG_PATH) + 1:].split('/', 1)[0]
 
 
-# Encoder Class
 class Encoder(BaseEncoder):
+    FUSED_SEPARATOR = '# encode_many candidate {index}\n'
+
     # config is value dict of the 'encoder' key
     def __init__(self, config):
         super().__init__(config)
+        self.config_fingerprint = config_fingerprint(self.config)
+        # Settings and what is compiled from them are immutable, thus shared by the encoders of a same config (and
+        # class, subclasses may compile them differently). Each encoder gets its own copy of the containers holding
+        # them, so that altering those of one encoder doesn't alter the others
+        cls = type(self)
+        state_key = (cls, self.config_fingerprint, _registry_generation)
+        state = _shared_encoder_states.get(state_key)
+        if state is None:
+            cache_dir = self.config.get('compiled_cache_dir')
+            state = load_compiled_state(cache_dir, self.config_fingerprint, cls) if cache_dir else None
+            if state is None:
+                self._compile_settings()
+                self._compile_state()
+                state = self._state()
+                if cache_dir:
+                    self.encode_describe() # so that later processes don't render it either
+                    save_compiled_state(cache_dir, self.config_fingerprint, cls, state)
+            _shared_encoder_states.put(state_key, state)
+        self.encode_plan, self.describe_selection, self.describe_queries = state[1:4]
+        self.settings = dict(state.settings)
+        self.describe_scripts = dict(state.describe_scripts)
+        self._shared_describe_scripts = state.describe_scripts
+        self._shared_state = True
+        self.instrumentation = None
+
+        # Decoded describe payloads by payload hash, see decode_multi
+        decode_cache_size = self.config.get('decode_cache_size', 0)
+        self.decode_cache = LruCache(decode_cache_size, ttl=self.config.get('decode_cache_ttl')) \
+            if decode_cache_size else None
+        # Encoded scripts by canonical values (and options), see encode_script
+        encode_cache_size = self.config.get('encode_cache_size', 0)
+        self.encode_cache = LruCache(encode_cache_size) if encode_cache_size else None
+        self.describe_results = None # decoded values by conditional describe fingerprint, created on first use
+
+    def _compile_settings(self):
         self.settings = {} # Dict of { setting_name => instantiated_setting_class }
 
         requested_settings = self.config.get('settings', {})
         for name, enc_set_config in requested_settings.items():
-            try:
-                setting_class = globals()['{}Setting'.format(name)]
-            except KeyError:
+            # Hierarchical (per-site) WebConfig settings are named <path>::<setting name>
+            path, _, setting_name = name.rpartition(SETTING_PATH_DELIMITER)
+            setting_class = get_setting_class(setting_name)
+            if setting_class is None:
                 raise EncoderConfigException('Setting "{}" is not supported in dotnet encoder.'.format(name))
-            self.settings[name] = setting_class(enc_set_config)
+            if not path:
+                self.settings[name] = setting_class(enc_set_config)
+            elif issubclass(setting_class, WebConfigRangeSetting):
+                self.settings[name] = setting_class(enc_set_config, path=path)
+            else:
+                raise EncoderConfigException('Setting "{}" does not support a path, only web config settings can be '
+                                             'configured per path in dotnet encoder.'.format(name))
+
+    def _compile_state(self):
+        self.encode_plan = self._compile_encode_plan()
+        self.describe_selection = self._compile_describe_selection()
+        self.describe_queries = self._compile_describe_queries()
+        self.describe_scripts = {} # { (slim, parallel) => describe script }, see encode_describe
+        self._shared_describe_scripts = self.describe_scripts
+
+    def _state(self):
+        return EncoderState(self.settings, self.encode_plan, self.describe_selection, self.describe_queries,
+                            self.describe_scripts)
+
+    def _unshare_state(self):
+        """
+        Gives this encoder its own copy of the settings (and of what is compiled from them) so that they can be
+        altered, eg. instrumented, without affecting the other encoders of the same config.
+        """
+        if not self._shared_state:
+            return
+        self.settings = {name: copy.copy(setting) for name, setting in self.settings.items()}
+        self._compile_state()
+        self._shared_state = False
+
+    def enable_instrumentation(self, callback=None, instrumentation=None):
+        """
+        Starts recording timings and byte counts of this encoder and its settings, see Instrumentation.
+
+        :param callback: optional callback of a new Instrumentation
+        :param instrumentation: existing Instrumentation to record into (eg. shared by several encoders)
+        :return Instrumentation: the instrumentation recorded into
+        """
+        self.disable_instrumentation()
+        self._unshare_state()
+        if instrumentation is None:
+            instrumentation = Instrumentation(callback=callback)
+        setting_classes = {}
+        for setting in self.settings.values():
+            cls = setting.__class__
+            if cls not in setting_classes:
+                setting_classes[cls] = _instrumented_class(cls, INSTRUMENTED_SETTING_METHODS, instrumentation)
+            setting.__class__ = setting_classes[cls]
+
+        cls = self.__class__
+        instrumented = _instrumented_class(cls, INSTRUMENTED_ENCODER_METHODS, instrumentation)
+        instrumented.encode_multi = _counted_bytes(instrumented.encode_multi, 'out', instrumentation)
+        instrumented.encode_describe = _counted_bytes(instrumented.encode_describe, 'out', instrumentation)
+        instrumented.decode_multi = _counted_bytes(instrumented.decode_multi, 'in', instrumentation)
+        self.__class__ = instrumented
+        self.instrumentation = instrumentation
+        return instrumentation
+
+    def disable_instrumentation(self):
+        if self.instrumentation is None:
+            return
+        for setting in self.settings.values():
+            setting.__class__ = setting.__class__.instrumented_class
+        self.__class__ = self.__class__.instrumented_class
+        self.instrumentation = None
 
-    # TODO: implement hierarchical settings; this function will need optional path arguments
     def describe(self):
         settings = {}
-        for setting in self.settings.values():
-            settings.update((setting.describe(),))
+        for name, setting in self.settings.items():
+            # Keyed by configured name so that per path settings of the same class don't collide
+            settings[name] = setting.describe()[1]
         return settings
 
-    def _encode_multi(self, values):
-        encoded = ''
-        values_to_encode = values.copy()
+    def _compile_encode_plan(self):
+        """
+        Builds the immutable encode plan used by every _encode_multi call: settings partitioned (WebConfig first)
+        and ordered, along with the constant parts of the output script.
+        """
+        webconfig = tuple((name, setting, True) for name, setting in self.settings.items()
+                          if isinstance(setting, WebConfigRangeSetting))
+        other = tuple((name, setting, False) for name, setting in self.settings.items()
+                      if not isinstance(setting, WebConfigRangeSetting))
+        return EncodePlan(
+            entries=webconfig + other,
+            names=frozenset(self.settings),
+            before=self.config.get('before', ''),
+            after=self.config.get('after', ''),
+        )
+
+    def _iter_encoded(self, values, cache=None, current=None):
+        """
+        Validates and encodes values in encode plan order.
 
-        encoded += self.config.get('before', '')
+        :param values: dict of { setting_name => primitive value }, None values are skipped
+        :param cache: optional dict of { (setting_name, value type, value) => encoded value } shared between calls
+        :param current: optional decoded dict of { setting_name => primitive value } currently in effect,
+            settings already at the value to encode are skipped
+        :return generator: (setting_name, setting, is webconfig setting, encoded value) of each setting to write
+        """
+        plan = self.encode_plan
+        if not plan.names.issuperset(values):
+            raise EncoderRuntimeException('We received settings to encode we do not support: {}'
+                                          ''.format(', '.join(name for name in values if name not in plan.names)))
 
-        webConfSettings = dict(filter(lambda s: isinstance(s[1], WebConfigRangeSetting), self.settings.items()))
-        webAdmImported = False
-        for name, setting in webConfSettings.items():
-            # TODO: implement hierarchical settings; check for delimeter here to split path from webconfig setting name, pass into encode_option below
-            set_val = values_to_encode.pop(name, None)
+        for name, setting, webconfig in plan.entries:
+            set_val = values.get(name)
             if set_val is None:
                 continue
-            if not webAdmImported:
-                encoded += 'Import-Module WebAdministration\n'
-                webAdmImported = True
-
-            #if [setting name contained delimeter]
-                # [split name into (path, name)]
-                # encoded += setting.encode_option(set_val, path)
-            # else:
-            encoded += setting.encode_option(set_val)
-
-        otherSettings = dict(filter(lambda s: not webConfSettings.get(s[0]), self.settings.items()))
-        for name, setting in otherSettings.items():
-            # TODO: implement hierarchical settings; check for delimeter here to split path from webconfig setting name, pass into encode_option below
-            set_val = values_to_encode.pop(name, None)
-            if set_val is None:
+
+            if cache is None:
+                encoded_value = setting.encode_value(set_val)
+            else:
+                # keyed along with the type of the value, as 1, 1.0 and True are equal but don't all validate
+                key = (name, type(set_val), set_val)
+                encoded_value = cache.get(key)
+                if encoded_value is None:
+                    encoded_value = cache[key] = setting.encode_value(set_val)
+            if current is not None and not setting.value_differs(encoded_value, current.get(name)):
                 continue
-            #if [setting name contained delimeter]
-                # [split name into (path, name)]
-                # encoded += setting.encode_option(set_val, path)
-            # else:
-            encoded += setting.encode_option(set_val)
+            yield name, setting, webconfig, encoded_value
 
-        encoded += self.config.get('after', '')
+    def _encode_settings(self, encoded, values, import_module=True, cache=None, current=None, changed=None):
+        """
+        Appends the lines setting values to the encoded list of script parts, see _iter_encoded for arguments.
 
-        if values_to_encode:
-            raise EncoderRuntimeException('We received settings to encode we do not support: {}'
-                                          ''.format(', '.join(values_to_encode.keys())))
+        :param encoded: list of script parts to append to
+        :param import_module: whether WebAdministration import should be emitted ahead of the first WebConfig line
+        :param changed: optional list to append the (setting_name, setting) of each written setting to
+        :return int: number of settings written
+        """
+        written = 0
+        for name, setting, webconfig, encoded_value in self._iter_encoded(values, cache, current):
+            if changed is not None:
+                changed.append((name, setting))
+            if webconfig and import_module:
+                encoded.append(WEBADMINISTRATION_IMPORT)
+                import_module = False
+            encoded.append(setting.value_prefix)
+            encoded.append(encoded_value)
+            encoded.append('\n')
+            written += 1
+        return written
+
+    def _encode_settings_coalesced(self, encoded, values, import_module=True, cache=None, current=None, changed=None):
+        """
+        Coalescing counterpart of _encode_settings: WebConfig settings sharing a path and filter are written by a
+        single Set-WebConfiguration call and, when more than one such call is needed, all of them are committed at
+        once within a Start/Stop-WebCommitDelay block. Registry values are still written one by one as
+        Set-ItemProperty has no multi value form.
+        """
+        sections = OrderedDict() # { (path, filter) => (setting, { attribute => encoded value }) }
+        registry = []
+        for name, setting, webconfig, encoded_value in self._iter_encoded(values, cache, current):
+            if changed is not None:
+                changed.append((name, setting))
+            if webconfig:
+                section = sections.setdefault((setting.path, setting.filter), (setting, OrderedDict()))
+                section[1][setting.name_override or setting.name] = encoded_value
+            else:
+                registry.append((setting, encoded_value))
+
+        if sections:
+            if import_module:
+                encoded.append(WEBADMINISTRATION_IMPORT)
+            if len(sections) > 1:
+                encoded.append(WEBCONFIG_COMMIT_DELAY_START)
+            for setting, attributes in sections.values():
+                encoded.append(setting.format_section(attributes))
+            if len(sections) > 1:
+                encoded.append(WEBCONFIG_COMMIT_DELAY_STOP)
+        for setting, encoded_value in registry:
+            encoded.append(setting.value_prefix)
+            encoded.append(encoded_value)
+            encoded.append('\n')
+        return sum(len(attributes) for _, attributes in sections.values()) + len(registry)
+
+    def _encode_multi(self, values, current=None, coalesce=False, activate=False, changed=None, cache=None):
+        plan = self.encode_plan
+        encoded = [plan.before]
+        written = self._encode_writes(encoded, values, True, current, coalesce, activate, changed, cache)
+        if current is not None and not written:
+            return '' # nothing changes, don't run before/after either
+        encoded.append(plan.after)
+        return ''.join(encoded)
+
+    def _encode_writes(self, encoded, values, import_module, current, coalesce, activate, changed, cache):
+        """
+        Appends the writes of values, followed by their activation step when activate is set, to the encoded list
+        of script parts, see _encode_settings and _encode_settings_coalesced for arguments.
 
-        return encoded
-    
-    def encode_multi(self, values, expected_type=None):
-        encoded = self._encode_multi(values)
+        :return int: number of settings written
+        """
+        if activate and changed is None:
+            changed = []
+        encode_settings = self._encode_settings_coalesced if coalesce else self._encode_settings
+        written = encode_settings(encoded, values, import_module=import_module, cache=cache, current=current,
+                                  changed=changed)
+        if activate and written:
+            encoded.append(self.format_activation(setting for _, setting in changed))
+        return written
+
+    def format_activation(self, settings):
+        """
+        Renders the single, cheapest powershell step activating the values written for settings: the one of the
+        highest activation level among them. App pool recycles are limited to the sites of per site settings
+        unless a server wide (or non web config) setting requires one.
+
+        :param settings: iterable of written settings
+        :return str: powershell script, empty when no setting needs activation
+        """
+        scripts = self.config.get('activation_scripts', {})
+        level, sites, webconfig = 0, set(), False
+        for setting in settings:
+            if setting.activation_level > level:
+                level = setting.activation_level
+            if isinstance(setting, WebConfigRangeSetting):
+                webconfig = True
+            if setting.activation == ACTIVATION_APP_POOL_RECYCLE:
+                sites.add(_site_name(setting.path) if isinstance(setting, WebConfigRangeSetting) else None)
+
+        activation = ACTIVATION_LEVELS[level]
+        if activation == ACTIVATION_NONE:
+            return ''
+        if activation in scripts:
+            return scripts[activation]
+        if activation != ACTIVATION_APP_POOL_RECYCLE:
+            return ACTIVATION_SCRIPTS[activation]
+
+        step = '' if webconfig else WEBADMINISTRATION_IMPORT
+        if None in sites:
+            return step + ACTIVATION_SCRIPTS[activation]
+        return step + SITE_APP_POOL_RECYCLE_SCRIPT.format(sites=format_ps1_list(sorted(sites)))
+
+    def plan_apply(self, values, current=None, coalesce=None):
+        """
+        Plans applying values: writes (see encode_multi) followed by the one activation step required by the
+        settings actually written, see format_activation.
+
+        :param values: dict of { setting_name => primitive value }, None values are skipped
+        :param current: optional state of the host, see encode_multi. Without it every setting is considered changed
+        :param coalesce: see encode_multi
+        :return ApplyPlan: script (str), activation (one of ACTIVATION_LEVELS), changed (setting names written)
+        """
+        if coalesce is None:
+            coalesce = self.config.get('coalesce_writes', False)
+        changed = []
+        script = self._encode_multi(values, self._resolve_current(current), coalesce, activate=True, changed=changed)
+        level = max((setting.activation_level for _, setting in changed), default=0)
+        return ApplyPlan(script, ACTIVATION_LEVELS[level], tuple(name for name, _ in changed))
+
+    def _resolve_current(self, current):
+        """
+        Normalizes the current argument of encode_multi into a decoded dict of { setting_name => primitive value }.
+        Accepts either an already decoded dict or raw describe data as accepted by decode_multi.
+        """
+        if current is None:
+            return None
+        if isinstance(current, dict) and self.encode_plan.names.issuperset(current):
+            return current
+        return self.decode_multi(current)
+
+    @staticmethod
+    def _format_encoded(encoded, expected_type):
         expected_type = str if expected_type is None else expected_type
         if expected_type in ('str', str):
             return encoded
@@ -381,60 +1984,1242 @@ class Encoder(BaseEncoder):
         raise EncoderConfigException('Unrecognized expected_type passed on encode in dotnet encoder: {}. '
                                      'Supported: "list", "str"'.format(q(expected_type)))
 
-    def _decode_multi(self, data):
+    def encode_multi(self, values, expected_type=None, current=None, coalesce=None, activate=None):
+        """
+        Encodes values into a powershell script applying them.
+
+        :param values: dict of { setting_name => primitive value }, None values are skipped
+        :param expected_type: "str" (default) or "list" of lines
+        :param current: optional state of the host, either decoded (output of decode_multi) or raw describe data.
+            When provided, only the settings whose value actually changes are written and an empty script is
+            returned when nothing changes.
+        :param coalesce: when True, WebConfig writes sharing a path and filter are coalesced into a single cmdlet
+            call and committed at once (see _encode_settings_coalesced). Defaults to the coalesce_writes key of the
+            encoder config (False when missing)
+        :param activate: when True, the script ends with the step activating the written values (app pool recycle,
+            IIS reset or HTTP.sys restart), see plan_apply. Defaults to the activate key of the encoder config (False
+            when missing)
+        :return: str or list, depending on expected_type
+        """
+        if coalesce is None:
+            coalesce = self.config.get('coalesce_writes', False)
+        if activate is None:
+            activate = self.config.get('activate', False)
+        current = self._resolve_current(current)
+        if self.encode_cache is None:
+            return self._format_encoded(self._encode_multi(values, current, coalesce, activate), expected_type)
+        return self._format_encoded(self._encode_cached(values, current, coalesce, activate).script, expected_type)
+
+    def encode_script(self, values, expected_type=None, current=None, coalesce=None, activate=None):
+        """
+        encode_multi counterpart returning the script along with its content hash, so that callers can dedupe
+        uploads of identical scripts and hosts can check the ones they already staged (eg. with Get-FileHash).
+        Scripts (and hashes) are memoized when the encode_cache_size key of the encoder config is set.
+
+        :return EncodedScript: script (str or list, see encode_multi) and sha256 hex digest of the script's utf-8 text
+        """
+        if coalesce is None:
+            coalesce = self.config.get('coalesce_writes', False)
+        if activate is None:
+            activate = self.config.get('activate', False)
+        encoded = self._encode_cached(values, self._resolve_current(current), coalesce, activate)
+        return EncodedScript(self._format_encoded(encoded.script, expected_type), encoded.digest)
+
+    @staticmethod
+    def _encode_key(values, current, coalesce, activate):
+        """
+        :return tuple: canonical, hashable form of encode arguments, None when some value is not hashable
+        """
+        # Values are keyed along with their type: 1, 1.0 and True are equal but don't all validate. Sorting items
+        # compares keys only, as they are unique
+        key = (tuple(sorted((name, type(value), value) for name, value in values.items())),
+               None if current is None else tuple(sorted((name, type(value), value) for name, value in current.items())),
+               bool(coalesce), bool(activate))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _encode_cached(self, values, current, coalesce, activate):
+        cache = self.encode_cache
+        key = None if cache is None else self._encode_key(values, current, coalesce, activate)
+        encoded = None if key is None else cache.get(key)
+        if encoded is None:
+            script = self._encode_multi(values, current, coalesce, activate)
+            encoded = EncodedScript(script, hashlib.sha256(script.encode('utf-8')).hexdigest())
+            if key is not None:
+                cache.put(key, encoded)
+        return encoded
+
+    def encode_cache_info(self):
+        """
+        :return dict: encode cache statistics (see LruCache.info), None when the cache is disabled
+        """
+        return None if self.encode_cache is None else self.encode_cache.info()
+
+    def invalidate_encode_cache(self):
+        if self.encode_cache is not None:
+            self.encode_cache.clear()
+
+    def encode_many(self, values_iter, expected_type=None, fused=False, separator=None, coalesce=None, activate=None):
+        """
+        Lazily encodes many candidate value dicts. Validation and encoding of each distinct (setting, value) pair
+        is done once per batch and reused by every candidate proposing it. When not fused, each script is the one
+        encode_multi returns for the same values and options, memoized in the encode cache when one is configured.
+
+        :param values_iter: iterable of value dicts as accepted by encode_multi
+        :param expected_type: type of each yielded script when not fused, see encode_multi
+        :param fused: when True, yields the parts of a single script sharing one preamble (before and
+            WebAdministration import) and one after, with a separator line ahead of each candidate's writes. The
+            encode cache, which holds whole scripts, is not used then
+        :param separator: separator line template for fused mode, formatted with the candidate index
+        :param coalesce: see encode_multi, applies to the writes of each candidate
+        :param activate: see encode_multi, when fused each candidate's writes are followed by their activation step
+        :return generator: one script per candidate, or the parts of the fused script
+        """
+        plan = self.encode_plan
+        cache = {}
+        if coalesce is None:
+            coalesce = self.config.get('coalesce_writes', False)
+        if activate is None:
+            activate = self.config.get('activate', False)
+        if not fused:
+            for values in values_iter:
+                if self.encode_cache is not None:
+                    script = self._encode_cached(values, None, coalesce, activate).script
+                else:
+                    if len(cache) > ENCODE_MANY_CACHE_SIZE:
+                        cache.clear()
+                    script = self._encode_multi(values, coalesce=coalesce, activate=activate, cache=cache)
+                yield self._format_encoded(script, expected_type)
+            return
+
+        if expected_type not in (None, 'str', str):
+            raise EncoderConfigException('Fused encode_many only supports expected_type "str", got {}'.format(q(expected_type)))
+        separator = self.FUSED_SEPARATOR if separator is None else separator
+        preamble = plan.before
+        if any(webconfig for _, _, webconfig in plan.entries):
+            preamble += WEBADMINISTRATION_IMPORT
+        yield preamble
+        for index, values in enumerate(values_iter):
+            if len(cache) > ENCODE_MANY_CACHE_SIZE:
+                cache.clear()
+            encoded = [separator.format(index=index)]
+            self._encode_writes(encoded, values, False, None, coalesce, activate, None, cache)
+            yield ''.join(encoded)
+        yield plan.after
+
+    def encode_batch(self, columns):
+        """
+        Validates, snaps to step and encodes whole arrays of candidate values per setting, see
+        DotnetRangeSetting.encode_values.
+
+        :param columns: dict of { setting_name => numpy array (or array like) of candidate values }
+        :return dict: { setting_name => numpy array of encoded values }
+        """
+        unsupported = [name for name in columns if name not in self.settings]
+        if unsupported:
+            raise EncoderRuntimeException('We received settings to encode we do not support: {}'
+                                          ''.format(', '.join(unsupported)))
+        return {name: self.settings[name].encode_values(values) for name, values in columns.items()}
+
+    def _decode_multi(self, data, previous=None):
         decoded = {}
+        if isinstance(data, str):
+            # Tokenize the script once, each setting then reads its value from the index
+            data = PowershellSettingIndex(data)
+        elif not isinstance(data, dict):
+            raise SettingRuntimeException('Describe data must be a json object, got json {}'.format(
+                q(data.__class__.__name__)))
+        elif data.get('Unchanged') is not None:
+            return self._unchanged_values(data['Unchanged'], previous)
         for name, setting in self.settings.items():
-            # TODO: change decode_option to return tuple to support heierarchical config
             decoded[name] = setting.decode_option(data)
-        
+
+        if isinstance(data, dict) and data.get('Fingerprint') is not None:
+            # Output of a conditional describe, kept for the next one to refer to
+            if self.describe_results is None:
+                self.describe_results = LruCache(self.config.get('conditional_describe_cache_size',
+                                                                 CONDITIONAL_DESCRIBE_CACHE_SIZE))
+            self.describe_results.put(data['Fingerprint'], decoded)
+            decoded = dict(decoded)
         return decoded
 
+    def _unchanged_values(self, fingerprint, previous):
+        if isinstance(previous, ConditionalDescribe):
+            if previous.fingerprint != fingerprint:
+                raise SettingRuntimeException('Describe output is unchanged since fingerprint {} but the previous '
+                                              'describe passed has fingerprint {}'.format(q(fingerprint),
+                                                                                          q(previous.fingerprint)))
+            previous = previous.values
+        if previous is not None:
+            return dict(previous)
+
+        # Nothing passed, falling back to the values decoded by this encoder along with the fingerprint
+        decoded = None if self.describe_results is None else self.describe_results.get(fingerprint)
+        if decoded is None:
+            raise SettingRuntimeException('Describe output is unchanged since fingerprint {} but no previous values '
+                                          'were passed and this encoder does not hold the ones decoded along with it, '
+                                          'pass them or describe again without fingerprint'.format(q(fingerprint)))
+        return dict(decoded)
+
+    def decode_conditional(self, data, previous=None):
+        """
+        Decodes the output of a conditional describe script (see encode_describe_conditional), or of any other
+        describe data accepted by decode_multi.
+
+        :param previous: values the host reported unchanged, see decode_multi
+        :return ConditionalDescribe: decoded values, fingerprint to pass to the next conditional describe (None
+            when data has none) and whether the host reported no change since the fingerprint passed
+        """
+        data = self._load_payload(data)
+        fingerprint = None
+        unchanged = False
+        if isinstance(data, dict):
+            unchanged = data.get('Unchanged') is not None
+            fingerprint = data.get('Unchanged') if unchanged else data.get('Fingerprint')
+        return ConditionalDescribe(self._decode_multi(data, previous), fingerprint, unchanged)
+
     # Operates on the output of powershell describe script generated by encode_describe of this encoder
-    def decode_multi(self, data):
+    def decode_multi(self, data, previous=None):
+        """
+        Decodes describe output (json) or an adjust script (powershell) back into setting values.
+
+        :param data: dict (loaded json), str, bytes-like object (bytes, bytearray, memoryview, mmap) whose encoding
+            is detected (see decode_text), path object (os.PathLike, see fspath) of a file holding it (memory
+            mapped rather than read in) or file-like object
+        :param previous: values last decoded for the host (dict or ConditionalDescribe of decode_conditional),
+            returned when data is a conditional describe reporting them unchanged. When None, the values this
+            encoder decoded along with the fingerprint are returned, if it still holds them
+        :return dict: { setting_name => primitive value }
+        """
+        path = fspath(data)
+        if path is not None:
+            return self._decode_file(path, previous)
+        cache = self.decode_cache
+        if cache is None or not isinstance(data, (str,) + BYTES_LIKE_TYPES):
+            return self._decode_payload(data, previous)
+
+        # Byte identical payloads (eg. host unchanged between samples) skip parsing and decoding altogether
+        key = self._payload_key(data)
+        decoded = cache.get(key)
+        if decoded is None:
+            decoded = self._decode_payload(data, previous)
+            cache.put(key, decoded)
+        return dict(decoded)
+
+    def _decode_file(self, path, previous):
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return self.decode_multi(b'') # empty files can't be mapped
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return self.decode_multi(mapped, previous)
+        finally:
+            mapped.close()
+
+    def _payload_key(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8', 'surrogatepass')
+        return self.config_fingerprint + hashlib.sha256(data).digest()[:16]
+
+    def decode_cache_info(self):
+        """
+        :return dict: decode cache statistics (see LruCache.info), None when the cache is disabled
+        """
+        return None if self.decode_cache is None else self.decode_cache.info()
+
+    def invalidate_decode_cache(self):
+        if self.decode_cache is not None:
+            self.decode_cache.clear()
+
+    def _decode_payload(self, data, previous=None):
+        return self._decode_multi(self._load_payload(data), previous)
+
+    def _load_payload(self, data):
+        """
+        :return: describe data as a dict (json) or str (powershell script)
+        """
+        if hasattr(data, 'read') and not isinstance(data, mmap.mmap):
+            data = data.read()
+        if isinstance(data, BYTES_LIKE_TYPES):
+            data = decode_text(data)
+
         if isinstance(data, str):
+            # Only json objects are decoded selectively, anything else is handed over to json.loads as before
+            start = _JSON_WS_RE.match(data).end()
             try:
-                data = json.loads(data)
+                if data[start:start + 1] == '{':
+                    data = select_json(data, self.describe_selection)
+                else:
+                    data = json.loads(data)
             except ValueError:
                 pass    # Assuming data is a string representing a PS1 script
         else:
             if not isinstance(data, dict):
                 raise EncoderRuntimeException('Unrecognized data type passed on decode in dotnet encoder: {}. '
-                                        'Supported: "dict", "str"'.format(q(data.__class__.__name__)))
+                                        'Supported: "dict", "str", bytes-like, path or file-like object'.format(q(data.__class__.__name__)))
+        return data
 
-        return self._decode_multi(data)
-
-    # TODO: hierarchical support; add paths param 
-    def encode_describe(self):
-        reg_paths_done = set()
-        describe_ps_script = 'Import-Module WebAdministration\n'
-        
-        describe_ps_script += '@{\n'
-        describe_ps_script += '\t"WebConfig" = @{\n'
-        # TODO: iterate paths if multiple and assign path here
-        path = 'MACHINE/WEBROOT/APPHOST'
-        describe_ps_script += '\t\t"{}" = @{{\n'.format(path)
-        filters_done = set() # encode_describe only needs to run once per unique webconfig filter per path
+    def _compile_describe_selection(self):
+        """
+        Builds the selection tree (see select_json) of the describe data keys read by the settings of this encoder:
+        registry path -> name and WebConfig -> path -> filter -> name.
+        """
+        selection = {}
+        for setting in self.settings.values():
+            if isinstance(setting, WebConfigRangeSetting):
+                filters = selection.setdefault('WebConfig', {}).setdefault(setting.path, {})
+                filters.setdefault(setting.filter, {})[setting.name_override or setting.name] = None
+            elif isinstance(setting, RegistryRangeSetting):
+                selection.setdefault(setting.path, {})[setting.name] = None
+        # Keys of conditional describe outputs
+        selection['Fingerprint'] = selection['Unchanged'] = None
+        return selection
+
+    def _compile_describe_queries(self):
+        """
+        Groups settings into the queries of the describe script: one per unique (path, filter) for WebConfig settings,
+        ordered by path, and one per unique registry path, along with the properties each of them needs to return.
+        """
+        webconfig_paths = OrderedDict()
         for setting in filter(lambda s: isinstance(s, WebConfigRangeSetting), self.settings.values()):
-                
-            if setting.filter in filters_done:
-                continue
+            filters = webconfig_paths.setdefault(setting.path, OrderedDict())
+            filters.setdefault(setting.filter, (setting, []))[1].append(setting.name_override or setting.name)
+        reg_paths = OrderedDict()
+        for setting in filter(lambda s: isinstance(s, RegistryRangeSetting), self.settings.values()):
+            reg_paths.setdefault(setting.path, (setting, []))[1].append(setting.name)
+
+        queries = []
+        for path, filters in webconfig_paths.items():
+            for filter_, (setting, properties) in filters.items():
+                queries.append(DescribeQuery(True, path, filter_, setting, tuple(_unique(properties))))
+        for path, (setting, properties) in reg_paths.items():
+            queries.append(DescribeQuery(False, path, None, setting, tuple(_unique(properties))))
+        return tuple(queries)
+
+    @staticmethod
+    def _render_describe_table(queries, slim, indent='', hashtable='@{'):
+        """
+        Renders the powershell hashtable literal (as a list of lines) running queries, shaped as expected by
+        decode_multi: WebConfig -> path -> filter and registry path at the top level.
 
-            describe_ps_script += '\t\t\t"{}" = {}\n'.format(setting.filter, setting.encode_describe(path))
-            filters_done.add(setting.filter)
-        # close path object brace
-        describe_ps_script += '\t\t}\n'
+        :param hashtable: opening of the hashtable literals, eg. [ordered]@{ for a stable key order
+        """
+        lines = [indent + hashtable + '\n', indent + '\t"WebConfig" = {}\n'.format(hashtable)]
+        path = None
+        for query in filter(lambda q: q.webconfig, queries):
+            if query.path != path:
+                if path is not None:
+                    # close path object brace
+                    lines.append(indent + '\t\t}\n')
+                path = query.path
+                lines.append(indent + '\t\t"{}" = {}\n'.format(path, hashtable))
+            lines.append(indent + '\t\t\t"{}" = {}\n'.format(
+                query.filter, query.setting.encode_describe(path, properties=query.properties if slim else None)))
+        if path is not None:
+            lines.append(indent + '\t\t}\n')
         # close WebConfig object brace
-        describe_ps_script += '\t}\n'
+        lines.append(indent + '\t}\n')
 
-        
-        for setting in filter(lambda s: isinstance(s, RegistryRangeSetting), self.settings.values()):
-            # Registry settings only need their encode_describe called once per unique registry path
-            if(setting.path in reg_paths_done):
+        for query in filter(lambda q: not q.webconfig, queries):
+            lines.append(indent + '\t{}\n'.format(query.setting.encode_describe(properties=query.properties if slim else None)))
+        lines.append(indent + '}')
+        return lines
+
+    @staticmethod
+    def _convert_to_json(slim):
+        if slim:
+            # Depth covers WebConfig -> path -> filter -> property, the default (2) would stringify filter objects
+            return ' | ConvertTo-Json -Compress -Depth {}\n'.format(SLIM_DESCRIBE_JSON_DEPTH)
+        return ' | ConvertTo-Json\n'
+
+    def _shard_describe_queries(self, shards):
+        if not isinstance(shards, int) or shards < 1:
+            raise EncoderConfigException('Number of describe shards must be a positive integer, got {}'.format(q(shards)))
+        # Round robin so that the queries of each kind (and each path) get spread evenly
+        sharded = [self.describe_queries[i::shards] for i in range(shards)]
+        return [queries for queries in sharded if queries]
+
+    def encode_describe(self, slim=None, parallel=None):
+        """
+        Generates powershell script describing the current value of the settings of this encoder as json.
+
+        :param slim: when True, described objects are projected onto the properties the settings actually read and
+            json is compressed. Defaults to the slim_describe key of the encoder config (False when missing)
+        :param parallel: when > 1, queries are sharded over that many runspaces of a runspace pool run concurrently,
+            their results being merged into the same json shape. Defaults to the describe_parallel key of the encoder
+            config (sequential when missing)
+        :return str: powershell script
+        """
+        if slim is None:
+            slim = self.config.get('slim_describe', False)
+        if parallel is None:
+            parallel = self.config.get('describe_parallel', 1)
+        # The script only depends on settings, it is rendered once
+        key = (bool(slim), parallel)
+        script = self.describe_scripts.get(key)
+        if script is None:
+            # Rendered scripts (immutable str) are shared with the encoders of the same state
+            script = self._shared_describe_scripts.get(key)
+            if script is None:
+                script = self._shared_describe_scripts[key] = self._render_describe(slim, parallel)
+            self.describe_scripts[key] = script
+        return script
+
+    def _render_describe(self, slim, parallel):
+        if parallel > 1 and len(self.describe_queries) > 1:
+            return self._encode_describe_parallel(slim, parallel)
+
+        describe_ps_script = [WEBADMINISTRATION_IMPORT]
+        describe_ps_script.extend(self._render_describe_table(self.describe_queries, slim))
+        describe_ps_script.append(self._convert_to_json(slim))
+        return ''.join(describe_ps_script)
+
+    def encode_describe_conditional(self, fingerprint=None):
+        """
+        Generates a conditional describe script: it fingerprints the (slim) json of the described values and only
+        returns it, along with its fingerprint, when the fingerprint differs from the given one. Otherwise it returns
+        {"Unchanged": fingerprint}, which decode_multi turns back into the values decoded along with that
+        fingerprint.
+
+        :param fingerprint: fingerprint of the describe output last decoded for the host (see decode_conditional),
+            None when unknown
+        :return str: powershell script
+        """
+        if fingerprint is None:
+            fingerprint = ''
+        if not isinstance(fingerprint, str) or not _FINGERPRINT_RE.fullmatch(fingerprint):
+            raise EncoderRuntimeException('Invalid describe fingerprint {}, expected an hex digest'.format(q(fingerprint)))
+        describe_ps_script = [WEBADMINISTRATION_IMPORT, '$describe = ']
+        # Ordered tables, json must be byte identical from one run to the next for the same values
+        describe_ps_script.extend(self._render_describe_table(self.describe_queries, True, hashtable='[ordered]@{'))
+        describe_ps_script.append('\n')
+        describe_ps_script.append(CONDITIONAL_DESCRIBE.format(fingerprint=fingerprint, depth=SLIM_DESCRIBE_JSON_DEPTH))
+        return ''.join(describe_ps_script)
+
+    def _encode_describe_parallel(self, slim, parallel):
+        shards = self._shard_describe_queries(parallel)
+        describe_ps_script = [
+            '$describePool = [runspacefactory]::CreateRunspacePool(1, {})\n'.format(len(shards)),
+            '$describePool.Open()\n',
+            '$describeJobs = @()\n',
+        ]
+        for queries in shards:
+            describe_ps_script.append('$describeShell = [powershell]::Create()\n')
+            describe_ps_script.append('$describeShell.RunspacePool = $describePool\n')
+            describe_ps_script.append('[void]$describeShell.AddScript({\n')
+            describe_ps_script.append('\t' + WEBADMINISTRATION_IMPORT)
+            describe_ps_script.extend(self._render_describe_table(queries, slim, indent='\t'))
+            describe_ps_script.append('\n})\n')
+            describe_ps_script.append('$describeJobs += ,@($describeShell, $describeShell.BeginInvoke())\n')
+        # Merge shard tables into a single one, WebConfig paths being merged filter by filter
+        describe_ps_script.append(PARALLEL_DESCRIBE_MERGE)
+        describe_ps_script.append('$describeResult' + self._convert_to_json(slim))
+        return ''.join(describe_ps_script)
+
+    def encode_describe_shards(self, shards, slim=None):
+        """
+        Splits the describe script into (up to) shards independent scripts the caller can run concurrently. Their
+        outputs are combined by merge_describe.
+
+        :param shards: number of scripts to split queries over
+        :param slim: see encode_describe
+        :return list: powershell scripts
+        """
+        if slim is None:
+            slim = self.config.get('slim_describe', False)
+        scripts = []
+        for queries in self._shard_describe_queries(shards):
+            describe_ps_script = [WEBADMINISTRATION_IMPORT]
+            describe_ps_script.extend(self._render_describe_table(queries, slim))
+            describe_ps_script.append(self._convert_to_json(slim))
+            scripts.append(''.join(describe_ps_script))
+        return scripts
+
+    def merge_describe(self, parts):
+        """
+        Merges the outputs of encode_describe_shards scripts into a single describe dict accepted by decode_multi.
+
+        :param parts: iterable of describe outputs (json str/bytes, file-like objects or already loaded dicts)
+        :return dict: merged describe data
+        """
+        merged = {'WebConfig': {}}
+        for part in parts:
+            if not isinstance(part, dict):
+                try:
+                    part = select_json(part, self.describe_selection)
+                except ValueError as e:
+                    raise EncoderRuntimeException('Unable to decode describe shard output as json: {}'.format(str(e)))
+            for key, value in part.items():
+                if key == 'WebConfig' and isinstance(value, dict):
+                    for path, filters in value.items():
+                        if isinstance(filters, dict):
+                            merged['WebConfig'].setdefault(path, {}).update(filters)
+                        else:
+                            merged['WebConfig'][path] = filters
+                else:
+                    merged[key] = value
+        return merged
+
+
+# Fleet Class
+FleetResult = namedtuple('FleetResult', 'results errors') # dicts of { host => result } and { host => exception }
+
+def _run_fleet_chunk(encoder, method, items, kwargs):
+    if isinstance(encoder, tuple):
+        # (encoder class, config) in process pool workers, encoders of the same config share their compiled state
+        # (see Encoder.__init__) so that building one per chunk is cheap
+        encoder_class, config = encoder
+        encoder = encoder_class(config)
+    call = getattr(encoder, method)
+    done = []
+    for host, arg in items:
+        try:
+            done.append((host, call(arg, **kwargs), None))
+        except Exception as e: # pylint: disable=broad-except
+            # One host failing (eg. SettingRuntimeException on out of date describe data) must not abort the others
+            done.append((host, None, e))
+    return done
+
+
+class FleetEncoder:
+    """
+    Fans encode/decode work for many hosts sharing one encoder config out over a thread or process pool.
+    The pool is created on first use and kept until close() (or the end of a with block) so that it is reused
+    across cycles.
+    """
+    EXECUTORS = ('thread', 'process')
+
+    def __init__(self, config, executor='thread', max_workers=None, chunk_size=None, encoder_class=None):
+        """
+        :param config: encoder config (value dict of the 'encoder' key)
+        :param executor: "thread" or "process"
+        :param max_workers: pool size, defaults to the number of cpus for processes and to that number plus 4 (at
+            most 32) for threads, as concurrent.futures does
+        :param chunk_size: number of hosts handed to a worker at once, defaults to spreading hosts evenly
+            over 4 chunks per worker
+        :param encoder_class: Encoder class to instantiate, defaults to the dotnet Encoder
+        """
+        if executor not in self.EXECUTORS:
+            raise EncoderConfigException('Unrecognized executor passed to dotnet fleet encoder: {}. '
+                                         'Supported: {}'.format(q(executor), ', '.join(map(q, self.EXECUTORS))))
+        self.config = config
+        self.executor = executor
+        if max_workers is None:
+            cpus = os.cpu_count() or 1
+            max_workers = cpus if executor == 'process' else min(32, cpus + 4)
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.encoder_class = encoder_class or Encoder
+        # Built here even for process pools so that config errors surface in the caller rather than in workers
+        self.encoder = self.encoder_class(config)
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+            if self.executor == 'process':
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    def _map(self, method, host_args, kwargs):
+        items = list(host_args.items())
+        if not items:
+            return FleetResult({}, {})
+        pool = self._get_pool()
+        chunk_size = self.chunk_size
+        if not chunk_size:
+            chunk_size = max(1, -(-len(items) // (self.max_workers * 4)))
+        # Worker processes build their own encoder, threads share this one
+        encoder = (self.encoder_class, self.config) if self.executor == 'process' else self.encoder
+        futures = [pool.submit(_run_fleet_chunk, encoder, method, items[i:i + chunk_size], kwargs)
+                   for i in range(0, len(items), chunk_size)]
+
+        results = {}
+        errors = {}
+        for future in futures:
+            for host, result, error in future.result():
+                if error is None:
+                    results[host] = result
+                else:
+                    errors[host] = error
+        return FleetResult(results, errors)
+
+    def encode_multi(self, host_values, expected_type=None, **kwargs):
+        """
+        :param host_values: dict of { host => values dict } as accepted by Encoder.encode_multi
+        :return FleetResult: encoded scripts and errors by host
+        """
+        kwargs['expected_type'] = expected_type
+        return self._map('encode_multi', host_values, kwargs)
+
+    def decode_multi(self, host_payloads):
+        """
+        :param host_payloads: dict of { host => describe data } as accepted by Encoder.decode_multi
+        :return FleetResult: decoded settings dicts and errors by host
+        """
+        return self._map('decode_multi', host_payloads, {})
+
+
+# Async pipeline
+class ScriptExecutor:
+    """
+    Runs powershell scripts on hosts, asynchronously. Implementations only need to provide run().
+    """
+    async def run(self, host, script):
+        """
+        :param host: host to run script on
+        :param script: powershell script text
+        :return: script output (str or bytes, as accepted by Encoder.decode_multi)
+        """
+        raise NotImplementedError()
+
+    async def close(self):
+        pass
+
+
+class SubprocessScriptExecutor(ScriptExecutor):
+    """
+    Runs scripts by piping them to the stdin of a local command, eg. powershell itself or a remoting wrapper.
+    """
+    DEFAULT_COMMAND = ('powershell', '-NoProfile', '-NonInteractive', '-Command', '-')
+
+    def __init__(self, command=None):
+        """
+        :param command: argv of the command to run, each argument being formatted with the host (eg.
+            ('ssh', '{host}', 'powershell', '-Command', '-')). Defaults to running a local powershell
+        """
+        self.command = tuple(command or self.DEFAULT_COMMAND)
+
+    async def run(self, host, script):
+        import asyncio
+        process = await asyncio.create_subprocess_exec(
+            *(argument.format(host=host) for argument in self.command),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await process.communicate(script.encode('utf-8'))
+        except asyncio.CancelledError:
+            # Timed out (or cancelled), don't leave the script running behind our back, nor a zombie process
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            await asyncio.shield(process.wait())
+            raise
+        if process.returncode != 0:
+            raise EncoderRuntimeException('Script failed on host {} with exit code {}: {}'.format(
+                q(host), process.returncode, stderr.decode('utf-8', 'replace').strip()))
+        return stdout
+
+
+class FakeScriptExecutor(ScriptExecutor):
+    """
+    Stand-in executor for tests and dry runs: responder computes the output of each script, after latency seconds.
+    Every call is recorded in calls as (host, script).
+    """
+    def __init__(self, responder, latency=0):
+        """
+        :param responder: callable(host, script) returning the script output
+        :param latency: seconds each run takes, or callable(host, script) returning them
+        """
+        self.responder = responder
+        self.latency = latency
+        self.calls = []
+        self.running = self.max_running = 0
+
+    async def run(self, host, script):
+        import asyncio
+        self.calls.append((host, script))
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            latency = self.latency(host, script) if callable(self.latency) else self.latency
+            if latency:
+                await asyncio.sleep(latency)
+            return self.responder(host, script)
+        finally:
+            self.running -= 1
+
+
+class AsyncPipeline:
+    """
+    Adjusts (encode, execute, describe, decode) or describes many hosts sharing one encoder config concurrently.
+    Each host goes through its stages on its own, so that the stages of different hosts overlap, while at most
+    concurrency hosts are in progress (thus running a script) at once.
+    """
+    def __init__(self, config, executor, concurrency=16, timeout=None, encoder_class=None, conditional=False):
+        """
+        :param config: encoder config (value dict of the 'encoder' key)
+        :param executor: ScriptExecutor running the scripts
+        :param concurrency: maximum number of hosts in progress at once
+        :param timeout: seconds after which a host in progress fails (time waiting for other hosts to make room
+            excluded), never when None
+        :param encoder_class: Encoder class to instantiate, defaults to the dotnet Encoder
+        :param conditional: whether to describe hosts with conditional describe scripts (see
+            Encoder.encode_describe_conditional), hosts then only return their settings when they changed
+        """
+        if not isinstance(concurrency, int) or concurrency < 1:
+            raise EncoderConfigException('Async pipeline concurrency must be a positive integer, got {}'.format(
+                q(concurrency)))
+        self.encoder = (encoder_class or Encoder)(config)
+        self.executor = executor
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.describe_script = self.encoder.encode_describe()
+        self.conditional = conditional
+        self.described = {} # { host => ConditionalDescribe of its last conditional describe output }
+
+    async def _describe(self, host):
+        if not self.conditional:
+            return self.encoder.decode_multi(await self.executor.run(host, self.describe_script))
+        previous = self.described.get(host)
+        script = self.encoder.encode_describe_conditional(None if previous is None else previous.fingerprint)
+        described = self.encoder.decode_conditional(await self.executor.run(host, script), previous)
+        self.described[host] = described
+        return described.values
+
+    async def _adjust_host(self, host, values, kwargs):
+        script = self.encoder.encode_multi(values, **kwargs)
+        if script:
+            await self.executor.run(host, script)
+        return await self._describe(host)
+
+    async def _describe_host(self, host, _arg, _kwargs):
+        return await self._describe(host)
+
+    async def _run_host(self, step, semaphore, host, arg, kwargs):
+        import asyncio
+        try:
+            # A host keeps its slot through all of its stages, so that its describe directly follows its adjust,
+            # and its timeout only starts once it got the slot: time queued behind other hosts doesn't count
+            async with semaphore:
+                if self.timeout is None:
+                    return host, await step(host, arg, kwargs), None
+                return host, await asyncio.wait_for(step(host, arg, kwargs), self.timeout), None
+        except asyncio.TimeoutError:
+            return host, None, EncoderRuntimeException('Timed out after {}s on host {}'.format(self.timeout, q(host)))
+        except Exception as e: # pylint: disable=broad-except
+            # One host failing must not abort the others
+            return host, None, e
+
+    async def _run(self, step, host_args, kwargs):
+        import asyncio
+        semaphore = asyncio.Semaphore(self.concurrency)
+        done = await asyncio.gather(*(self._run_host(step, semaphore, host, arg, kwargs)
+                                      for host, arg in host_args.items()))
+        results = {}
+        errors = {}
+        for host, result, error in done:
+            if error is None:
+                results[host] = result
+            else:
+                errors[host] = error
+        return FleetResult(results, errors)
+
+    async def adjust(self, host_values, **kwargs):
+        """
+        :param host_values: dict of { host => values dict } as accepted by Encoder.encode_multi
+        :param kwargs: encode_multi arguments (current, coalesce, activate)
+        :return FleetResult: settings decoded from each host's describe output after adjusting it, and errors by host
+        """
+        return await self._run(self._adjust_host, host_values, kwargs)
+
+    async def describe(self, hosts):
+        """
+        :param hosts: iterable of hosts
+        :return FleetResult: decoded settings and errors by host
+        """
+        return await self._run(self._describe_host, dict.fromkeys(hosts), {})
+
+    async def close(self):
+        await self.executor.close()
+
+
+# Snapshot store
+SNAPSHOT_MAGIC = b'DNSNAP1\n'
+SNAPSHOT_MISSING = -(1 << 63) # int64 column value standing for a setting absent from a snapshot
+SNAPSHOT_DESCRIBED = 0
+SNAPSHOT_ADJUSTED = 1
+_SNAPSHOT_HEADER = struct.Struct('<I') # length of the json header following the magic
+_SNAPSHOT_ALIGNMENT = 8
+
+
+class SnapshotStore:
+    """
+    Append only, columnar history of the settings of many hosts: a float64 timestamp column, a uint32 host id
+    column (see hosts), a uint8 kind column (described state or adjusted values) and one int64 column per setting.
+    Rows must be recorded in timestamp order, so that time range queries are binary searches.
+
+    Stores persist to a single file whose columns are memory mapped back by load(), without being read in.
+    """
+    def __init__(self, settings):
+        """
+        :param settings: names of the settings recorded, eg. the keys of Encoder.describe()
+        """
+        self.settings = tuple(sorted(settings))
+        self.hosts = [] # host id => host
+        self.host_ids = {} # host => host id
+        self.timestamps = array.array('d')
+        self.host_column = array.array('I')
+        self.kinds = array.array('B')
+        self.columns = {name: array.array('q') for name in self.settings}
+        self._rows = None # { (host id, kind) => array of row indices }, built on first query
+        self._mmap = None
+
+    @classmethod
+    def for_encoder(cls, encoder):
+        return cls(encoder.describe())
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def _make_writable(self):
+        if isinstance(self.timestamps, array.array):
+            return
+        # Loaded store, copy mapped columns into arrays on the first write
+        views = self._views()
+        self.timestamps = array.array('d', self.timestamps)
+        self.host_column = array.array('I', self.host_column)
+        self.kinds = array.array('B', self.kinds)
+        self.columns = {name: array.array('q', column) for name, column in self.columns.items()}
+        self._release(views)
+
+    def _views(self):
+        return [self.timestamps, self.host_column, self.kinds] + list(self.columns.values())
+
+    def _release(self, views):
+        for view in views:
+            if isinstance(view, memoryview):
+                view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _host_rows(self):
+        if self._rows is None:
+            rows = {}
+            for row, (host_id, kind) in enumerate(zip(self.host_column, self.kinds)):
+                rows.setdefault((host_id, kind), array.array('I')).append(row)
+            self._rows = rows
+        return self._rows
+
+    def record(self, host, values, timestamp=None, adjusted=False):
+        """
+        :param host: host the values belong to (any hashable, json serializable for save())
+        :param values: dict of { setting_name => int value } as returned by decode_multi (or passed to encode_multi
+            when adjusted), settings missing or None are recorded as missing
+        :param timestamp: seconds since epoch, defaults to now
+        :param adjusted: whether values are the ones the host was adjusted to rather than its described state
+        """
+        timestamp = time.time() if timestamp is None else float(timestamp)
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            raise EncoderRuntimeException('Snapshots must be recorded in time order, got {} after {}'.format(
+                timestamp, self.timestamps[-1]))
+        unknown = [name for name in values if name not in self.columns]
+        if unknown:
+            raise EncoderRuntimeException('Snapshot of host {} has settings the store does not record: {}'.format(
+                q(host), ', '.join(unknown)))
+        self._make_writable()
+
+        host_id = self.host_ids.get(host)
+        if host_id is None:
+            host_id = self.host_ids[host] = len(self.hosts)
+            self.hosts.append(host)
+        row = len(self.timestamps)
+        kind = SNAPSHOT_ADJUSTED if adjusted else SNAPSHOT_DESCRIBED
+        self.timestamps.append(timestamp)
+        self.host_column.append(host_id)
+        self.kinds.append(kind)
+        for name, column in self.columns.items():
+            value = values.get(name)
+            column.append(SNAPSHOT_MISSING if value is None else int(value))
+        if self._rows is not None:
+            self._rows.setdefault((host_id, kind), array.array('I')).append(row)
+
+    def _row_values(self, row):
+        values = {}
+        for name, column in self.columns.items():
+            value = column[row]
+            values[name] = None if value == SNAPSHOT_MISSING else value
+        return values
+
+    def _last_row(self, host_id, kind, before_row):
+        """
+        :return int: index of the last row of host and kind among the rows before before_row, None when none
+        """
+        rows = self._host_rows().get((host_id, kind))
+        if not rows:
+            return None
+        index = bisect.bisect_left(rows, before_row)
+        return rows[index - 1] if index else None
+
+    def _cutoff(self, at):
+        return len(self.timestamps) if at is None else bisect.bisect_right(self.timestamps, at)
+
+    def _host_id_list(self, hosts):
+        if hosts is None:
+            return range(len(self.hosts))
+        return [self.host_ids[host] for host in hosts if host in self.host_ids]
+
+    def snapshot(self, host, at=None, adjusted=False):
+        """
+        :param at: timestamp, defaults to the latest
+        :param adjusted: whether to return the values host was last adjusted to rather than its described state
+        :return dict: { setting_name => value (None when missing) } of host as of at, None when unknown by then
+        """
+        host_id = self.host_ids.get(host)
+        if host_id is None:
+            return None
+        row = self._last_row(host_id, SNAPSHOT_ADJUSTED if adjusted else SNAPSHOT_DESCRIBED, self._cutoff(at))
+        return None if row is None else self._row_values(row)
+
+    def history(self, host, since=None, until=None):
+        """
+        :return generator: (timestamp, adjusted, values) of each row of host recorded between since (excluded)
+            and until (included)
+        """
+        host_id = self.host_ids.get(host)
+        if host_id is None:
+            return
+        start = 0 if since is None else self._cutoff(since)
+        stop = self._cutoff(until)
+        for row in range(start, stop):
+            if self.host_column[row] == host_id:
+                yield self.timestamps[row], self.kinds[row] == SNAPSHOT_ADJUSTED, self._row_values(row)
+
+    @staticmethod
+    def _diff(before, after):
+        changes = {}
+        for name, value in after.items():
+            old = before.get(name) if before is not None else None
+            if old != value:
+                changes[name] = (old, value)
+        return changes
+
+    def changes_since(self, since, until=None, hosts=None):
+        """
+        Compares the described state of hosts as of since with their state as of until.
+
+        :param since: timestamp
+        :param until: timestamp, defaults to the latest
+        :param hosts: hosts to compare, defaults to every host
+        :return dict: { host => { setting_name => (value as of since, value as of until) } } of the settings that
+            changed, hosts first described after since have every setting changed from None
+        """
+        since_cutoff = self._cutoff(since)
+        until_cutoff = self._cutoff(until)
+        changes = {}
+        for host_id in self._host_id_list(hosts):
+            after = self._last_row(host_id, SNAPSHOT_DESCRIBED, until_cutoff)
+            if after is None or after < since_cutoff:
+                continue # not described since
+            before = self._last_row(host_id, SNAPSHOT_DESCRIBED, since_cutoff)
+            diff = self._diff(None if before is None else self._row_values(before), self._row_values(after))
+            if diff:
+                changes[self.hosts[host_id]] = diff
+        return changes
+
+    def drift(self, hosts=None):
+        """
+        Compares the values hosts were last adjusted to with their latest described state, when described since.
+
+        :param hosts: hosts to check, defaults to every host
+        :return dict: { host => { setting_name => (adjusted value, described value) } } of the drifted settings
+        """
+        end = len(self.timestamps)
+        drifted = {}
+        for host_id in self._host_id_list(hosts):
+            adjusted = self._last_row(host_id, SNAPSHOT_ADJUSTED, end)
+            described = self._last_row(host_id, SNAPSHOT_DESCRIBED, end)
+            if adjusted is None or described is None or described < adjusted:
                 continue
-                
-            describe_ps_script += '\t{}\n'.format(setting.encode_describe())
-            reg_paths_done.add(setting.path)
+            adjusted_values = self._row_values(adjusted)
+            described_values = self._row_values(described)
+            diff = {name: (value, described_values[name]) for name, value in adjusted_values.items()
+                    if value is not None and described_values[name] != value}
+            if diff:
+                drifted[self.hosts[host_id]] = diff
+        return drifted
+
+    def save(self, path):
+        """
+        Writes the store to path: magic, json header (settings, hosts, row count, column layout) then each column
+        as raw little endian bytes, aligned to 8 bytes. The file is written aside then atomically replaces path, so
+        that a loaded store can be saved over the file it is memory mapped from.
+        """
+        columns = [('timestamps', self.timestamps, 'd'), ('hosts', self.host_column, 'I'), ('kinds', self.kinds, 'B')]
+        columns.extend((name, self.columns[name], 'q') for name in self.settings)
+        header = json.dumps({
+            'settings': list(self.settings),
+            'hosts': self.hosts,
+            'rows': len(self.timestamps),
+            'columns': [[name, typecode] for name, _, typecode in columns],
+        }).encode('utf-8')
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(SNAPSHOT_MAGIC)
+                f.write(_SNAPSHOT_HEADER.pack(len(header)))
+                f.write(header)
+                for _, column, typecode in columns:
+                    f.write(b'\0' * (-f.tell() % _SNAPSHOT_ALIGNMENT))
+                    if not isinstance(column, array.array):
+                        column = array.array(typecode, column)
+                    if sys.byteorder != 'little':
+                        column = array.array(typecode, column)
+                        column.byteswap()
+                    column.tofile(f)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
 
-        describe_ps_script += '} | ConvertTo-Json\n'
-        return describe_ps_script
+    @classmethod
+    def load(cls, path, use_mmap=True):
+        """
+        :param use_mmap: when True, columns are views of a read only memory map of the file (copied into arrays on
+            the first record). Otherwise they are read into arrays
+        :return SnapshotStore: store saved to path
+        """
+        with open(path, 'rb') as f:
+            if use_mmap and sys.byteorder == 'little' and os.fstat(f.fileno()).st_size:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+        try:
+            header, layout = cls._read_layout(data)
+        except (ValueError, KeyError, TypeError, struct.error) as e:
+            if isinstance(data, mmap.mmap):
+                data.close()
+            raise EncoderRuntimeException('Invalid dotnet encoder snapshot store file {}: {}'.format(q(path), str(e)))
+
+        views = {}
+        buffer = memoryview(data)
+        for name, typecode, offset, size in layout:
+            view = buffer[offset:offset + size].cast(typecode)
+            if isinstance(data, bytes):
+                view = array.array(typecode, view)
+                if sys.byteorder != 'little':
+                    view.byteswap()
+            views[name] = view
+
+        store = cls(header['settings'])
+        store.hosts = header['hosts']
+        store.host_ids = {host: host_id for host_id, host in enumerate(store.hosts)}
+        store.timestamps = views.pop('timestamps')
+        store.host_column = views.pop('hosts')
+        store.kinds = views.pop('kinds')
+        store.columns = {name: views[name] for name in store.settings}
+        if isinstance(data, mmap.mmap):
+            store._mmap = data
+        return store
 
+    @staticmethod
+    def _read_layout(data):
+        """
+        Validates the header and column layout of saved store data.
+
+        :return tuple: json header, list of (column name, typecode, offset, size)
+        """
+        if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError('not a dotnet encoder snapshot store file')
+        offset = len(SNAPSHOT_MAGIC)
+        header_size, = _SNAPSHOT_HEADER.unpack_from(data, offset)
+        offset += _SNAPSHOT_HEADER.size
+        header = json.loads(bytes(data[offset:offset + header_size]).decode('utf-8'))
+        offset += header_size
+
+        layout = []
+        rows = header['rows']
+        for name, typecode in header['columns']:
+            offset += -offset % _SNAPSHOT_ALIGNMENT
+            size = rows * array.array(typecode).itemsize
+            if offset + size > len(data):
+                raise ValueError('column {} is truncated'.format(q(name)))
+            layout.append((name, typecode, offset, size))
+            offset += size
+        return header, layout
+
+    def close(self):
+        """
+        Releases the memory map of a loaded store, which must not be used after (unless recorded to since).
+        """
+        self._release(self._views())
+
+
+# Command line
+_cli_state = None # (encoder, command, options) of the command line process, or of one of its workers
+
+
+def _init_cli(config, command, options):
+    global _cli_state # pylint: disable=global-statement
+    _cli_state = (Encoder(config), command, options)
+
+
+def _process_cli_record(line):
+    """
+    Processes one ndjson record with the encoder of _init_cli.
+
+    :param line: json object text: {"host", "values"[, "current"]} to encode, {"host", "payload" or "path"} to
+        decode, {"host"} to describe
+    :return tuple: (json output line, whether it is an error record), None for blank lines
+    """
+    encoder, command, options = _cli_state
+    if not line.strip():
+        return None
+    output = {'host': None}
+    try:
+        record = json.loads(line)
+        if not isinstance(record, dict):
+            raise ValueError('record must be a json object')
+        output['host'] = record.get('host')
+        if command == 'encode':
+            output['script'] = encoder.encode_multi(record['values'], current=record.get('current'),
+                                                    coalesce=options.get('coalesce'), activate=options.get('activate'))
+        elif command == 'decode':
+            if 'payload' in record:
+                output['values'] = encoder.decode_multi(record['payload'])
+            else:
+                import pathlib
+                output['values'] = encoder.decode_multi(pathlib.Path(record['path']))
+        else:
+            output['script'] = encoder.encode_describe(slim=options.get('slim'), parallel=options.get('parallel'))
+    except KeyError as e:
+        output['error'] = 'Missing key {} in {} record'.format(str(e), command)
+    except Exception as e: # pylint: disable=broad-except
+        # One record failing must not abort the stream
+        output['error'] = '{}: {}'.format(e.__class__.__name__, str(e))
+    return json.dumps(output), 'error' in output
+
+
+def _iter_cli_lines(inputs):
+    for path in inputs:
+        if path == '-':
+            yield from sys.stdin
+        else:
+            try:
+                with open(path) as f:
+                    yield from f
+            except OSError as e:
+                raise EncoderRuntimeException('Unable to read input {}: {}'.format(q(path), str(e)))
+
+
+def _load_cli_config(path, section=None):
+    """
+    :param path: yaml (or .json) file holding the encoder config
+    :param section: dotted path of the encoder config in the file, eg. ec2win.web.encoder
+    """
+    try:
+        with open(path) as f:
+            if path.endswith('.json'):
+                config = json.load(f)
+            else:
+                import yaml
+                config = yaml.safe_load(f)
+        for key in section.split('.') if section else ():
+            config = config[key]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise EncoderConfigException('Unable to load encoder config {} from {}: {}'.format(
+            q(section or ''), q(path), str(e)))
+    if not isinstance(config, dict):
+        raise EncoderConfigException('Encoder config {} of {} is not a mapping'.format(q(section or ''), q(path)))
+    return config
+
+
+def _write_cli_output(processed):
+    if processed is None:
+        return False
+    sys.stdout.write(processed[0])
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+    return processed[1]
+
+
+def main(argv=None):
+    """
+    Streams ndjson records from files (or stdin) through encode_multi, decode_multi or encode_describe, writing one
+    json output record per input record to stdout, in order:
+
+        python -m encoders.dotnet --config config.yaml --section ec2win.web.encoder decode captured.ndjson
+
+    :return int: exit status, 1 when some records failed (see their "error" key), 2 when the config or an input
+        could not be read
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m encoders.dotnet',
+                                     description='Stream ndjson records through the dotnet encoder')
+    parser.add_argument('--config', required=True, help='yaml (or .json) file holding the encoder config')
+    parser.add_argument('--section', help='dotted path of the encoder config in the config file, '
+                                          'eg. ec2win.web.encoder (default: the whole file)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of worker processes to fan records out to (default: none)')
+    parser.add_argument('--chunk-size', type=int, default=64, help='records handed to a worker at once')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    encode = commands.add_parser('encode', help='{"host", "values"[, "current"]} records to adjust scripts')
+    encode.add_argument('--coalesce', action='store_true', default=None)
+    encode.add_argument('--activate', action='store_true', default=None)
+    decode = commands.add_parser('decode', help='{"host", "payload" or "path"} records to setting values')
+    describe = commands.add_parser('describe', help='describe script, once per {"host"} record when inputs are given')
+    describe.add_argument('--slim', action='store_true', default=None)
+    describe.add_argument('--parallel', type=int)
+    for command in (encode, decode):
+        command.add_argument('inputs', nargs='*', default=['-'], help='ndjson files, - for stdin (default)')
+    describe.add_argument('inputs', nargs='*', default=[], help='ndjson files, - for stdin')
+    args = parser.parse_args(argv)
+
+    options = {name: getattr(args, name, None) for name in ('coalesce', 'activate', 'slim', 'parallel')}
+    try:
+        config = _load_cli_config(args.config, args.section)
+        _init_cli(config, args.command, options)
+    except (EncoderConfigException, SettingConfigException) as e:
+        sys.stderr.write('{}\n'.format(e))
+        return 2
+
+    lines = _iter_cli_lines(args.inputs) if args.inputs or args.command != 'describe' else iter(['{}'])
+    failed = False
+    try:
+        if args.workers > 0:
+            import itertools
+            import multiprocessing
+            window = args.workers * args.chunk_size * 4 # bounds the records in flight, Pool.imap would read them all
+            with multiprocessing.Pool(args.workers, initializer=_init_cli,
+                                      initargs=(config, args.command, options)) as pool:
+                while True:
+                    batch = list(itertools.islice(lines, window))
+                    if not batch:
+                        break
+                    for processed in pool.imap(_process_cli_record, batch, args.chunk_size):
+                        failed = _write_cli_output(processed) or failed
+        else:
+            for line in lines:
+                failed = _write_cli_output(_process_cli_record(line)) or failed
+    except EncoderRuntimeException as e: # only raised by _iter_cli_lines, records fail on their own
+        sys.stderr.write('{}\n'.format(e))
+        return 2
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    # Run the imported module rather than this __main__ copy of it, so that what workers and caches pickle
+    # refers to encoders.dotnet
+    from encoders.dotnet import main as dotnet_main
+    sys.exit(dotnet_main())
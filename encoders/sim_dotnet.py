@@ -0,0 +1,541 @@
+"""
+Local, in-memory stand-in for the Windows hosts the dotnet encoder targets.
+
+IisSimulator interprets the powershell the encoder generates (describe scripts, adjust scripts with their commit
+delays and activation steps) against an in-memory registry and IIS configuration, and returns what powershell would
+print: describe json in the shape of the Get-ItemProperty and Get-WebConfiguration objects (see describe_data_json
+in test_dotnet.py). Every cmdlet run adds its simulated cost to the run, so that the full adjust loop (encode,
+apply, describe, decode) can be load tested on any machine and script shapes compared by their simulated time:
+
+    python -m encoders.sim_dotnet --sites 50 --hosts 20 --rounds 5
+    python -m encoders.sim_dotnet --sites 50 --hosts 20 --rounds 5 --coalesce --activate
+
+Only the subset of powershell making up these scripts is understood: unsupported commands raise
+EncoderRuntimeException, as would a script failing on a host. Parallel describes (see
+Encoder.encode_describe) are not supported.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import re
+import sys
+import time
+from collections import namedtuple, OrderedDict
+
+from encoders.base import EncoderRuntimeException, q
+from encoders.bench_dotnet import CACHING_EXTRA, REGISTRY_EXTRA, make_config, make_values
+from encoders.dotnet import AsyncPipeline, ScriptExecutor, PowershellAssignment, PowershellBlock, \
+    PowershellCommand, parse_ps1, iter_ps1_commands, ACTIVATION_APP_POOL_RECYCLE, ACTIVATION_IIS_RESET, \
+    ACTIVATION_HTTP_RESTART, CONDITIONAL_DESCRIBE, DEFAULT_WEBCONFIG_PATH, HTTP_PARAMETERS_PATH, \
+    IIS_CACHING_FILTER
+
+# Simulated seconds taken by each cmdlet run, along with the costs of the side effects of some of them
+SIMULATED_COSTS = {
+    'import-module': 0.3,
+    'get-itemproperty': 0.005,
+    'get-webconfiguration': 0.02,
+    'set-itemproperty': 0.005,
+    'set-webconfigurationproperty': 0.01,
+    'set-webconfiguration': 0.01,
+    'start-webcommitdelay': 0.001,
+    'stop-webcommitdelay': 0.001,
+    'select-object': 0.0005,
+    'convertto-json': 0.002,
+    'get-childitem': 0.01,
+    'start-service': 0.5,
+    'restart-service': 0.01,
+    'webconfig_commit': 0.05, # each save of applicationHost.config
+    'fingerprint': 0.001, # hashing the json of a conditional describe
+    ACTIVATION_APP_POOL_RECYCLE: 1.0, # per app pool
+    ACTIVATION_IIS_RESET: 8.0,
+    ACTIVATION_HTTP_RESTART: 10.0,
+}
+
+# Attributes (and child elements) of the configuration sections known to the simulator, as IIS ships them
+SECTION_DEFAULTS = {
+    IIS_CACHING_FILTER.lower(): OrderedDict((
+        ('enabled', True),
+        ('enableKernelCache', True),
+        ('maxCacheSize', CACHING_EXTRA['maxCacheSize']),
+        ('maxResponseSize', CACHING_EXTRA['maxResponseSize']),
+        ('profiles', CACHING_EXTRA['profiles']),
+    )),
+}
+DEFAULT_APP_POOL = 'DefaultAppPool'
+REGISTRY_DRIVE = 'HKLM:'
+REGISTRY_PROVIDER_ROOT = 'Microsoft.PowerShell.Core\\Registry::HKEY_LOCAL_MACHINE'
+
+SimulatedRun = namedtuple('SimulatedRun', 'output elapsed writes')
+
+_INT_RE = re.compile(r'^-?\d+$')
+_PS1_CONSTANTS = {'$true': True, '$false': False, '$null': None}
+_CONDITIONAL_DESCRIBE_HEAD = CONDITIONAL_DESCRIBE[:CONDITIONAL_DESCRIBE.index('{depth}')]
+_CONDITIONAL_FINGERPRINT_RE = re.compile(r'-eq "([0-9A-Fa-f]*)"')
+
+
+def _convert_value(value, default=None):
+    """
+    Converts a value written by a script to the type stored: that of default when known, else bool for True/False
+    and int for integers.
+    """
+    if not isinstance(value, str):
+        return value
+    if value.lower() in _PS1_CONSTANTS:
+        return _PS1_CONSTANTS[value.lower()]
+    if isinstance(default, bool) or (default is None and value.lower() in ('true', 'false')):
+        if value.lower() not in ('true', 'false'):
+            raise EncoderRuntimeException('Cannot convert value {} to System.Boolean'.format(q(value)))
+        return value.lower() == 'true'
+    if isinstance(default, int) or (default is None and _INT_RE.match(value)):
+        try:
+            return int(value)
+        except ValueError:
+            raise EncoderRuntimeException('Cannot convert value {} to System.Int32'.format(q(value)))
+    return value
+
+
+def _to_json(value, compress):
+    if compress:
+        return json.dumps(value, separators=(',', ':'))
+    return json.dumps(value, indent=4)
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+class IisSimulator:
+    """
+    One simulated host: registry keys, IIS configuration (with its inheritance from the server level down to sites)
+    and the app pools of its sites. State persists across execute() calls, as it would on a host.
+    """
+    def __init__(self, registry=None, webconfig=None, sites=None, costs=None):
+        """
+        :param registry: dict of { key path => { value name => value } } initially set, the HTTP.sys parameters key
+            always exists (empty by default)
+        :param webconfig: dict of { config path => { section filter => { attribute => value } } } initially set on
+            top of the section defaults, see SECTION_DEFAULTS
+        :param sites: dict of { site name => app pool name }. By default every site runs in its own app pool, named
+            after the site
+        :param costs: dict overriding entries of SIMULATED_COSTS
+        """
+        self.registry = {HTTP_PARAMETERS_PATH.lower(): (HTTP_PARAMETERS_PATH, OrderedDict())}
+        for path, values in (registry or {}).items():
+            self.registry.setdefault(path.lower(), (path, OrderedDict()))[1].update(values)
+        self.webconfig = {} # { (config path, section filter) => { attribute => value } }, lower cased keys
+        for path, sections in (webconfig or {}).items():
+            for filter_, attributes in sections.items():
+                self._section(path, filter_).update(attributes)
+        self.sites = sites
+        self.costs = dict(SIMULATED_COSTS, **(costs or {}))
+        self.activations = [] # (activation, app pool or None) of every activation step run
+        self.variables = {}
+        self._pending = None # web config writes held by Start-WebCommitDelay
+        self._elapsed = 0
+        self._writes = 0
+        self._cmdlets = {
+            'import-module': self._import_module,
+            'get-itemproperty': self._get_item_property,
+            'set-itemproperty': self._set_item_property,
+            'get-webconfiguration': self._get_webconfiguration,
+            'set-webconfigurationproperty': self._set_webconfiguration,
+            'set-webconfiguration': self._set_webconfiguration,
+            'start-webcommitdelay': self._start_commit_delay,
+            'stop-webcommitdelay': self._stop_commit_delay,
+            'select-object': self._select_object,
+            'convertto-json': self._convert_to_json,
+            'iisreset': self._iis_reset,
+            'restart-service': self._restart_service,
+            'start-service': self._start_service,
+        }
+
+    # State
+    @staticmethod
+    def _config_key(path, filter_):
+        return (path.rstrip('/').lower(), filter_.strip('/').lower())
+
+    def _section(self, path, filter_):
+        return self.webconfig.setdefault(self._config_key(path, filter_), OrderedDict())
+
+    def effective_section(self, path, filter_):
+        """
+        :return OrderedDict: attributes of the section in effect at path: its defaults overridden by the attributes
+            set at each level from the server (DEFAULT_WEBCONFIG_PATH) down to path
+        """
+        path, filter_ = self._config_key(path, filter_)
+        attributes = OrderedDict(SECTION_DEFAULTS.get(filter_, ()))
+        root = DEFAULT_WEBCONFIG_PATH.lower()
+        levels = [root]
+        if path != root:
+            if not path.startswith(root + '/'):
+                raise EncoderRuntimeException('Config path {} is not under {}'.format(q(path), q(root)))
+            for part in path[len(root) + 1:].split('/'):
+                levels.append('{}/{}'.format(levels[-1], part))
+        for level in levels:
+            attributes.update(self.webconfig.get((level, filter_), ()))
+        return attributes
+
+    def app_pool(self, site):
+        if self.sites is None:
+            return site
+        if site not in self.sites:
+            raise EncoderRuntimeException('Cannot find a site named {}'.format(q(site)))
+        return self.sites[site]
+
+    def app_pools(self):
+        """
+        :return list: names of every app pool, those of the sites known from the config by default
+        """
+        if self.sites is not None:
+            return sorted(set(self.sites.values()))
+        root = DEFAULT_WEBCONFIG_PATH.lower() + '/'
+        return sorted({DEFAULT_APP_POOL} | {path[len(root):].split('/')[0] for path, _ in self.webconfig
+                                           if path.startswith(root)})
+
+    # Execution
+    def execute(self, script):
+        """
+        Runs script against the state of the host.
+
+        :param script: powershell script text, as generated by the encoder
+        :return SimulatedRun: output (str) of the script, elapsed (simulated seconds), writes (settings written)
+        """
+        self._elapsed = 0
+        self._writes = 0
+        self.variables = {}
+        self._pending = None
+        head, conditional, tail = script.partition(_CONDITIONAL_DESCRIBE_HEAD)
+        output = []
+        for statement in parse_ps1(head):
+            output.extend(o for o in self._run_statement(statement) if isinstance(o, str))
+        if conditional:
+            output.append(self._conditional_describe(tail))
+        # NOTE: the writes of a commit delay never stopped are discarded along with the session, as by powershell
+        return SimulatedRun('\n'.join(output), self._elapsed, self._writes)
+
+    def _charge(self, cost):
+        self._elapsed += self.costs.get(cost, 0)
+
+    def _conditional_describe(self, tail):
+        # The hashing and comparison ending conditional describes (see CONDITIONAL_DESCRIBE) are emulated rather
+        # than interpreted: the describe table they work on was assigned to $describe by the script
+        describe = self.variables.get('$describe')
+        match = _CONDITIONAL_FINGERPRINT_RE.search(tail)
+        if describe is None or match is None:
+            raise EncoderRuntimeException('Unsupported conditional describe script')
+        self._charge('convertto-json')
+        self._charge('fingerprint')
+        fingerprint = hashlib.sha256(_to_json(describe, True).encode('utf-8')).hexdigest().upper()
+        if fingerprint == match.group(1).upper():
+            return _to_json({'Unchanged': fingerprint}, True)
+        self._charge('convertto-json')
+        return _to_json(OrderedDict(describe, Fingerprint=fingerprint), True)
+
+    def _run_statement(self, statement):
+        if any(c.name.lower() == 'restart-webapppool' for c in iter_ps1_commands(statement)):
+            return self._recycle(statement)
+        objects = None
+        for element in statement:
+            if isinstance(element, PowershellAssignment):
+                self.variables[element.target] = self._single(self._run_statement(element.value))
+                return []
+            objects = self._evaluate(element, objects)
+        return objects or []
+
+    def _evaluate(self, element, objects):
+        """
+        :param element: pipeline element (see parse_ps1)
+        :param objects: list of objects piped into element, None for the first element of a pipeline
+        :return list: objects output by element
+        """
+        if isinstance(element, PowershellCommand):
+            name = element.name.lower()
+            if name in self._cmdlets:
+                self._charge(name)
+                return self._cmdlets[name](element, objects or [])
+            if name in _PS1_CONSTANTS or (name.startswith('$') and name in self.variables):
+                if element.params or element.args:
+                    raise EncoderRuntimeException('Unsupported powershell expression {}'.format(q(element.name)))
+                return [_PS1_CONSTANTS[name] if name in _PS1_CONSTANTS else self.variables[name]]
+            if name == '[ordered]@' and len(element.args) == 1 and isinstance(element.args[0], PowershellBlock):
+                return [self._table(element.args[0].statements)]
+            raise EncoderRuntimeException('Unsupported powershell command {}'.format(q(element.name)))
+        if isinstance(element, OrderedDict):
+            return [OrderedDict((key, self._value(value)) for key, value in element.items())]
+        if isinstance(element, PowershellBlock) and element.kind == '(':
+            objects = []
+            for statement in element.statements:
+                objects.extend(self._run_statement(statement))
+            return objects
+        if isinstance(element, (str, list)):
+            return [_convert_value(value) for value in _as_list(element)]
+        raise EncoderRuntimeException('Unsupported powershell expression {}'.format(q(element)))
+
+    @staticmethod
+    def _single(objects):
+        if not objects:
+            return None
+        return objects[0] if len(objects) == 1 else objects
+
+    def _value(self, value):
+        # Hashtable values: pipelines (lists of elements) or single elements, bare words being plain values
+        if isinstance(value, list) and value and isinstance(value[0], (PowershellCommand, PowershellBlock, dict)):
+            return self._single(self._run_statement(value))
+        if isinstance(value, list):
+            return [_convert_value(v) for v in value]
+        return self._single(self._evaluate(value, None))
+
+    def _table(self, statements):
+        # [ordered]@{ key = value ... } parses as a command whose block holds one assignment per key
+        table = OrderedDict()
+        for statement in statements:
+            if len(statement) != 1 or not isinstance(statement[0], PowershellAssignment):
+                raise EncoderRuntimeException('Unsupported ordered hashtable entry {}'.format(q(statement)))
+            table[statement[0].target] = self._value(statement[0].value)
+        return table
+
+    # Cmdlets
+    def _import_module(self, command, objects):
+        return []
+
+    def _get_item_property(self, command, objects):
+        path = command.params.get('path') or (command.args[0] if command.args else None)
+        if not isinstance(path, str) or path.lower() not in self.registry:
+            raise EncoderRuntimeException('Cannot find path {} because it does not exist'.format(q(path)))
+        path, values = self.registry[path.lower()]
+        item = OrderedDict(values)
+        item.update(REGISTRY_EXTRA)
+        provider_path = REGISTRY_PROVIDER_ROOT + path[len(REGISTRY_DRIVE):]
+        item['PSPath'] = provider_path
+        item['PSParentPath'], _, item['PSChildName'] = provider_path.rpartition('\\')
+        return [item]
+
+    def _set_item_property(self, command, objects):
+        params = dict(zip(('path', 'name', 'value'), command.args))
+        params.update(command.params)
+        path, name = params.get('path'), params.get('name')
+        if not isinstance(path, str) or not isinstance(name, str) or 'value' not in params:
+            raise EncoderRuntimeException('Unsupported Set-ItemProperty arguments {}'.format(q(command.params)))
+        if path.lower() not in self.registry:
+            raise EncoderRuntimeException('Cannot find path {} because it does not exist'.format(q(path)))
+        self.registry[path.lower()][1][name] = _convert_value(params['value'])
+        self._writes += 1
+        return []
+
+    def _get_webconfiguration(self, command, objects):
+        path = command.params.get('pspath', DEFAULT_WEBCONFIG_PATH)
+        filter_ = command.params.get('filter')
+        if not isinstance(path, str) or not isinstance(filter_, str):
+            raise EncoderRuntimeException('Unsupported Get-WebConfiguration arguments {}'.format(q(command.params)))
+        section = OrderedDict([('value', CACHING_EXTRA['value'])])
+        section.update(self.effective_section(path, filter_))
+        section.update((('PSPath', path), ('Location', ''), ('ConfigurationPathType', CACHING_EXTRA[
+            'ConfigurationPathType']), ('ItemXPath', '/' + filter_.strip('/'))))
+        return [section]
+
+    def _set_webconfiguration(self, command, objects):
+        # Set-WebConfigurationProperty -Name attribute -Value value, or Set-WebConfiguration (or -Name .) setting
+        # several attributes at once from a hashtable
+        params = command.params
+        path = params.get('pspath', DEFAULT_WEBCONFIG_PATH)
+        location = params.get('location')
+        filter_ = params.get('filter')
+        name = params.get('name', '.')
+        value = params.get('value')
+        if not isinstance(path, str) or not isinstance(filter_, str) or 'value' not in params \
+                or (name == '.') != isinstance(value, dict):
+            raise EncoderRuntimeException('Unsupported {} arguments {}'.format(command.name, q(params)))
+        if isinstance(location, str) and location:
+            path = '{}/{}'.format(path.rstrip('/'), location.strip('/'))
+        attributes = value if name == '.' else {name: value}
+        self.effective_section(path, filter_) # fails on paths outside of the server config
+        defaults = SECTION_DEFAULTS.get(self._config_key(path, filter_)[1], {})
+        converted = OrderedDict((attribute, _convert_value(v, defaults.get(attribute)))
+                                for attribute, v in attributes.items())
+        self._writes += len(converted)
+        if self._pending is not None:
+            self._pending.append((path, filter_, converted))
+        else:
+            self._charge('webconfig_commit')
+            self._section(path, filter_).update(converted)
+        return []
+
+    def _start_commit_delay(self, command, objects):
+        self._pending = []
+        return []
+
+    def _stop_commit_delay(self, command, objects):
+        pending, self._pending = self._pending, None
+        if pending is None:
+            raise EncoderRuntimeException('Stop-WebCommitDelay without Start-WebCommitDelay')
+        if str(command.params.get('commit', '$true')).lower() == '$true' and pending:
+            self._charge('webconfig_commit')
+            for path, filter_, attributes in pending:
+                self._section(path, filter_).update(attributes)
+        return []
+
+    def _select_object(self, command, objects):
+        properties = command.params.get('property')
+        if properties is None:
+            if command.params.get('unique'):
+                return list(OrderedDict.fromkeys(objects))
+            return objects
+        properties = _as_list(properties)
+        return [OrderedDict((p, o.get(p)) for p in properties) for o in objects]
+
+    def _convert_to_json(self, command, objects):
+        # NOTE: ConvertTo-Json truncates objects nested deeper than -Depth, the encoder asks for the depth it needs
+        compress = bool(command.params.get('compress'))
+        return [_to_json(self._single(objects), compress)]
+
+    def _recycle(self, statement):
+        # App pool recycles iterate over pipelines of objects this simulator does not model (web sites, app pools),
+        # they are recognized by their source: app pools by name, site names or every app pool (Get-ChildItem)
+        source = statement[0]
+        if isinstance(source, PowershellCommand) and source.name.lower() == 'restart-webapppool':
+            pools = _as_list(source.params.get('name'))
+        elif isinstance(source, PowershellCommand) and source.name.lower() == 'get-childitem':
+            self._charge('get-childitem')
+            pools = self.app_pools()
+        elif isinstance(source, (str, list)):
+            pools = sorted({self.app_pool(site) for site in _as_list(source)})
+        else:
+            raise EncoderRuntimeException('Unsupported app pool recycle {}'.format(q(statement)))
+        for pool in pools:
+            self._charge(ACTIVATION_APP_POOL_RECYCLE)
+            self.activations.append((ACTIVATION_APP_POOL_RECYCLE, pool))
+        return []
+
+    def _iis_reset(self, command, objects):
+        self._charge(ACTIVATION_IIS_RESET)
+        self.activations.append((ACTIVATION_IIS_RESET, None))
+        return []
+
+    def _restart_service(self, command, objects):
+        names = [name.lower() for name in _as_list(command.params.get('name', command.args))]
+        if 'http' in names:
+            # restarting HTTP.sys restarts the IIS services depending on it
+            self._charge(ACTIVATION_HTTP_RESTART)
+            self.activations.append((ACTIVATION_HTTP_RESTART, None))
+        return []
+
+    def _start_service(self, command, objects):
+        return []
+
+
+class SimulatedScriptExecutor(ScriptExecutor):
+    """
+    Runs scripts on simulated hosts (see IisSimulator), created on first use. Its respond method can also serve as
+    the responder of a FakeScriptExecutor.
+    """
+    def __init__(self, simulator_factory=None, time_scale=0):
+        """
+        :param simulator_factory: callable(host) returning the IisSimulator of a new host, defaults to IisSimulator
+            with its default state
+        :param time_scale: real seconds slept per simulated second of each run, not sleeping at all by default
+        """
+        self.simulator_factory = simulator_factory
+        self.time_scale = time_scale
+        self.simulators = {}
+        self.runs = [] # (host, SimulatedRun) of every run
+
+    def simulator(self, host):
+        if host not in self.simulators:
+            self.simulators[host] = self.simulator_factory(host) if self.simulator_factory else IisSimulator()
+        return self.simulators[host]
+
+    def respond(self, host, script):
+        run = self.simulator(host).execute(script)
+        self.runs.append((host, run))
+        return run.output
+
+    async def run(self, host, script):
+        output = self.respond(host, script)
+        if self.time_scale:
+            await asyncio.sleep(self.runs[-1][1].elapsed * self.time_scale)
+        return output
+
+
+def run_simulation(sites=10, hosts=10, rounds=3, concurrency=16, options=None, conditional=False, costs=None):
+    """
+    Adjusts simulated hosts through an AsyncPipeline for rounds, each round proposing new values to every host.
+
+    :param sites: number of synthetic sites of the encoder config, see bench_dotnet.make_config
+    :param hosts: number of simulated hosts
+    :param options: encoder config options (eg. coalesce_writes, activate, slim_describe)
+    :param conditional: whether to describe hosts with conditional describe scripts
+    :param costs: dict overriding entries of SIMULATED_COSTS
+    :return dict: machine readable results, simulated times are in seconds per host and round
+    """
+    config = dict(make_config(sites), **(options or {}))
+    executor = SimulatedScriptExecutor(lambda host: IisSimulator(costs=costs))
+    pipeline = AsyncPipeline(config, executor, concurrency=concurrency, conditional=conditional)
+    names = ['host{}'.format(i) for i in range(hosts)]
+    errors = mismatches = 0
+    wall = 0
+    loop = asyncio.new_event_loop()
+    try:
+        for index in range(rounds):
+            host_values = {host: make_values(pipeline.encoder, seed=index + i) for i, host in enumerate(names)}
+            start = time.perf_counter()
+            results, failed = loop.run_until_complete(pipeline.adjust(host_values))
+            wall += time.perf_counter() - start
+            errors += len(failed)
+            mismatches += sum(1 for host, values in results.items() if values != host_values[host])
+        loop.run_until_complete(pipeline.close())
+    finally:
+        loop.close()
+
+    adjust = [run.elapsed for _, run in executor.runs if run.writes]
+    describe = [run.elapsed for _, run in executor.runs if not run.writes]
+    adjustments = hosts * rounds
+    return {
+        'meta': {
+            'sites': sites,
+            'settings': len(pipeline.encoder.settings),
+            'hosts': hosts,
+            'rounds': rounds,
+            'concurrency': concurrency,
+            'options': options or {},
+            'conditional': conditional,
+        },
+        'results': {
+            'errors': errors,
+            'mismatches': mismatches,
+            'wall_seconds': wall,
+            'adjustments_per_sec': adjustments / wall if wall else float('inf'),
+            'simulated_adjust_seconds': sum(adjust) / adjustments,
+            'simulated_describe_seconds': sum(describe) / adjustments,
+            'activations': sum(len(s.activations) for s in executor.simulators.values()),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the adjust loop of the dotnet encoder against simulated hosts')
+    parser.add_argument('--sites', type=int, default=10)
+    parser.add_argument('--hosts', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--coalesce', action='store_true', help='coalesce web config writes')
+    parser.add_argument('--activate', action='store_true', help='activate written values')
+    parser.add_argument('--slim', action='store_true', help='use slim describe scripts')
+    parser.add_argument('--conditional', action='store_true', help='use conditional describe scripts')
+    parser.add_argument('--output', help='file to write json results to (default: stdout)')
+    args = parser.parse_args(argv)
+
+    options = {'coalesce_writes': args.coalesce, 'activate': args.activate, 'slim_describe': args.slim}
+    results = run_simulation(sites=args.sites, hosts=args.hosts, rounds=args.rounds, concurrency=args.concurrency,
+                             options=options, conditional=args.conditional)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    return 1 if results['results']['errors'] or results['results']['mismatches'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
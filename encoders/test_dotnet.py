@@ -1,12 +1,13 @@
 import pytest
 
 import os
+import json
 import importlib
 import yaml
 
 import encoders.base as enc
 from encoders.base import q, EncoderConfigException, \
-    SettingConfigException, \
+    EncoderRuntimeException, SettingConfigException, \
     SettingRuntimeException
 
 config_path = os.environ.get('OPTUNE_CONFIG', './config.yaml')
@@ -196,3 +197,903 @@ def test_static_encode():
     encoded = enc.encode(enc_config, encode_data['application']['components']['web']['settings'])
     write_test_output_file('test_static_encode', encoded[0])
     assert True
+
+reordered_data_ps1 = r"""
+Import-Module WebAdministration
+Set-WebConfigurationProperty -Name 'enabled' -Value "True" -PSPath "MACHINE/WEBROOT/APPHOST" -Filter "system.webServer/caching"
+Set-WebConfigurationProperty -PSPath "MACHINE/WEBROOT/APPHOST" `
+    -Filter "system.webServer/caching" `
+    -Name enableKernelCache -Value:$false # trailing comment
+Set-ItemProperty -Value 1 -Name "UriEnableCache" -Path "HKLM:\System\CurrentControlSet\Services\Http\Parameters"; Set-ItemProperty "HKLM:\System\CurrentControlSet\Services\Http\Parameters" "UriScavengerPeriod" 250
+"""
+
+def test_decode_multi_ps1_parameter_order():
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    decoded = encoder.decode_multi(reordered_data_ps1)
+    assert decoded == {
+        'UriEnableCache': 1,
+        'UriScavengerPeriod': 250,
+        'WebConfigCacheEnabled': 1,
+        'WebConfigEnableKernelCache': 0,
+    }
+
+def test_decode_multi_ps1_roundtrip():
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    values = {'UriEnableCache': 0, 'UriScavengerPeriod': 210, 'WebConfigCacheEnabled': 0, 'WebConfigEnableKernelCache': 1}
+    assert encoder.decode_multi(encoder.encode_multi(values)) == values
+
+def test_decode_multi_ps1_duplicate():
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    script = reordered_data_ps1 + 'Set-ItemProperty -Path "HKLM:\\System\\CurrentControlSet\\Services\\Http\\Parameters" -Name "UriEnableCache" -Value 0\n'
+    with pytest.raises(SettingRuntimeException):
+        encoder.decode_multi(script)
+
+def test_decode_multi_ps1_statements():
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    registry = 'Set-ItemProperty -Path "HKLM:\\System\\CurrentControlSet\\Services\\Http\\Parameters" -Name "UriScavengerPeriod" '
+    # Only setting writes starting a statement are read, along with parameters they do not decode
+    script = '# {}-Value 210\nWrite-Host "{}-Value 220"\nif ($true) {{ {}-Value 230 -Type DWord -Force }}\n'.format(
+        registry, registry, registry)
+    assert encoder.decode_multi(script)['UriScavengerPeriod'] == 230
+    # Values that are not literals are only known once the script runs
+    for value in ('(230)', '230,240', '$period', '$(Get-Period)', '((230))', ''):
+        with pytest.raises(SettingRuntimeException):
+            encoder.decode_multi('{}-Value {}\n'.format(registry, value))
+    assert encoder.decode_multi(reordered_data_ps1.replace('-Value:$false', '-Value $TRUE'))['WebConfigEnableKernelCache'] == 1
+
+def test_parse_ps1_arrays():
+    from encoders.dotnet import parse_ps1, PowershellCommand
+    statements = parse_ps1('Get-ItemProperty -Path "HKLM:\\X" | Select-Object -Property "enabled","enableKernelCache"\n'
+                           '"SiteA","SiteB" | ForEach-Object { Restart-WebAppPool -Name $_ }\n'
+                           'Start-Service -Name WAS, W3SVC\n')
+    assert statements[0][1] == PowershellCommand('Select-Object', {'property': ['enabled', 'enableKernelCache']}, [])
+    assert statements[1][0] == ['SiteA', 'SiteB']
+    assert statements[2] == [PowershellCommand('Start-Service', {'name': ['WAS', 'W3SVC']}, [])]
+
+def test_encode_multi_unsupported():
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    values = {'UriEnableCache': 1, 'inst_type': 't2.micro'}
+    with pytest.raises(EncoderRuntimeException):
+        encoder.encode_multi(values)
+    assert values == {'UriEnableCache': 1, 'inst_type': 't2.micro'}
+    assert encoder.encode_multi({'UriEnableCache': 1, 'WebConfigCacheEnabled': None}) == \
+        'Set-ItemProperty -Path "HKLM:\\System\\CurrentControlSet\\Services\\Http\\Parameters" -Name "UriEnableCache" -Value 1\n'
+
+def test_encode_many():
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    candidates = [
+        {'UriEnableCache': 1, 'UriScavengerPeriod': 240, 'WebConfigCacheEnabled': 0, 'WebConfigEnableKernelCache': 1},
+        {'UriEnableCache': 0, 'UriScavengerPeriod': 250, 'WebConfigCacheEnabled': 1, 'WebConfigEnableKernelCache': 1},
+        {'UriScavengerPeriod': 240},
+    ]
+    encoded = encoder.encode_many(iter(candidates))
+    assert not isinstance(encoded, list)
+    assert list(encoded) == [encoder.encode_multi(values) for values in candidates]
+
+    fused = ''.join(encoder.encode_many(candidates, fused=True))
+    write_test_output_file('test_encode_many_fused', fused)
+    assert fused.count('Import-Module WebAdministration') == 1
+    assert fused.count('# encode_many candidate') == len(candidates)
+
+    # equal values of another type are validated on their own
+    assert list(encoder.encode_many([{'UriEnableCache': 1}, {'UriEnableCache': True}])) == \
+        [encoder.encode_multi({'UriEnableCache': 1}), encoder.encode_multi({'UriEnableCache': True})]
+    encoder.config['coalesce_writes'] = True
+    encoder.config['activate'] = True
+    assert list(encoder.encode_many(candidates)) == [encoder.encode_multi(values) for values in candidates]
+    assert list(encoder.encode_many(candidates, coalesce=False, activate=False)) == \
+        [encoder.encode_multi(values, coalesce=False, activate=False) for values in candidates]
+    fused = ''.join(encoder.encode_many(candidates, fused=True))
+    assert fused.count('Set-WebConfiguration ') == 2
+    assert fused.count('Restart-Service -Name HTTP') == len(candidates)
+
+def test_encode_multi_delta():
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    values = {'UriEnableCache': 1, 'UriScavengerPeriod': 240, 'WebConfigCacheEnabled': 0, 'WebConfigEnableKernelCache': 1}
+    # describe_data_json: UriEnableCache 1, UriScavengerPeriod system default (120), caching disabled, kernel cache on
+    encoded = encoder.encode_multi(values, current=describe_data_json)
+    write_test_output_file('test_encode_multi_delta', encoded)
+    assert encoded == 'Set-ItemProperty -Path "HKLM:\\System\\CurrentControlSet\\Services\\Http\\Parameters" -Name "UriScavengerPeriod" -Value 240\n'
+    assert encoder.encode_multi(values, current=encoder.decode_multi(encoder.encode_multi(values))) == ''
+    assert encoder.encode_multi(values, current={}) == encoder.encode_multi(values)
+
+def test_plan_apply():
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    values = {'UriEnableCache': 1, 'UriScavengerPeriod': 240, 'WebConfigCacheEnabled': 0, 'WebConfigEnableKernelCache': 1}
+
+    plan = encoder.plan_apply(values)
+    write_test_output_file('test_plan_apply', plan.script)
+    assert plan.activation == 'http_restart'
+    assert set(plan.changed) == set(values)
+    assert plan.script.endswith('Restart-Service -Name HTTP -Force\nStart-Service -Name WAS, W3SVC\n')
+    assert plan.script.count('Restart') == 1
+    assert encoder.decode_multi(plan.script) == values
+    assert encoder.encode_multi(values, activate=True) == plan.script
+    assert encoder_klass(dict(enc_config, activate=True)).encode_multi(values) == plan.script
+
+    # describe_data_json: UriScavengerPeriod at its system default (120), caching disabled
+    plan = encoder.plan_apply(dict(values, UriScavengerPeriod=None, WebConfigCacheEnabled=1), current=describe_data_json)
+    assert plan.changed == ('WebConfigCacheEnabled',)
+    assert plan.activation == 'app_pool_recycle'
+    assert plan.script.endswith('Get-ChildItem IIS:\\AppPools | Where-Object { $_.State -eq "Started" } | '
+                                'ForEach-Object { Restart-WebAppPool -Name $_.Name }\n')
+
+    plan = encoder.plan_apply(dict(values, UriScavengerPeriod=None), current=describe_data_json)
+    assert plan == ('', 'none', ())
+
+    settings = dict(enc_config['settings'], UriScavengerPeriod=dict(enc_config['settings']['UriScavengerPeriod'], activation='none'))
+    encoder = encoder_klass(dict(enc_config, settings=settings, activation_scripts={'app_pool_recycle': 'Recycle\n'}))
+    plan = encoder.plan_apply({'UriScavengerPeriod': 240, 'WebConfigEnableKernelCache': 0})
+    assert plan.activation == 'app_pool_recycle'
+    assert plan.script.endswith('-Value 240\nRecycle\n')
+
+    settings['UriScavengerPeriod']['activation'] = 'reboot'
+    with pytest.raises(SettingConfigException):
+        encoder_klass(dict(enc_config, settings=settings))
+
+def test_plan_apply_multi_site():
+    encoder = load_encoder('dotnet')(multi_site_config)
+    plan = encoder.plan_apply({
+        'MACHINE/WEBROOT/APPHOST/SiteB::WebConfigEnableKernelCache': 1,
+        'MACHINE/WEBROOT/APPHOST/SiteA::WebConfigCacheEnabled': 1,
+    })
+    write_test_output_file('test_plan_apply_multi_site', plan.script)
+    assert plan.script.endswith('"SiteA","SiteB" | ForEach-Object { (Get-Website -Name $_).applicationPool } | '
+                                'Select-Object -Unique | ForEach-Object { Restart-WebAppPool -Name $_ }\n')
+
+def test_setting_catalog(monkeypatch):
+    import encoders.dotnet as dotnet
+    monkeypatch.setattr(dotnet, 'SETTING_REGISTRY', dict(dotnet.SETTING_REGISTRY))
+    monkeypatch.setattr(dotnet, '_entry_points_loaded', False)
+
+    encoder = load_encoder('dotnet')({'name': 'dotnet', 'settings': {'WebConfigMaxResponseSize': {'default': 262144}}})
+    assert encoder.decode_multi(describe_data_json) == {'WebConfigMaxResponseSize': 262144}
+    assert encoder.encode_multi({'WebConfigMaxResponseSize': 1024}) == 'Import-Module WebAdministration\n' \
+        'Set-WebConfigurationProperty -Filter "system.webServer/caching" -PSPath "MACHINE/WEBROOT/APPHOST" -Name "maxResponseSize" -Value 1024\n'
+    assert dotnet.WebConfigMaxResponseSizeSetting.__name__ == 'WebConfigMaxResponseSizeSetting'
+
+    class EntryPoint:
+        name = 'test'
+        def load(self):
+            return lambda: [{'name': 'UriMaxUriBytes', 'kind': 'registry', 'path': dotnet.HTTP_PARAMETERS_PATH,
+                             'system_default': 16384, 'min': 4096, 'max': 16777216, 'activation': 'http_restart'}]
+    loaded = []
+    def iter_entry_points(group):
+        loaded.append(group)
+        return [EntryPoint()]
+    monkeypatch.setattr(dotnet, '_iter_entry_points', iter_entry_points)
+
+    encoder = load_encoder('dotnet')({'name': 'dotnet', 'settings': {'UriEnableCache': {}}})
+    assert loaded == [] # built in settings don't load entry points
+    encoder = load_encoder('dotnet')({'name': 'dotnet', 'settings': {'UriMaxUriBytes': {}, 'UriEnableCache': {}}})
+    assert loaded == ['encoders.dotnet.settings']
+    assert encoder.plan_apply({'UriMaxUriBytes': 8192}).script == \
+        'Set-ItemProperty -Path "HKLM:\\System\\CurrentControlSet\\Services\\Http\\Parameters" -Name "UriMaxUriBytes" -Value 8192\n' \
+        'Restart-Service -Name HTTP -Force\nStart-Service -Name WAS, W3SVC\n'
+    with pytest.raises(EncoderConfigException):
+        load_encoder('dotnet')({'name': 'dotnet', 'settings': {'UriMissing': {}}})
+    assert loaded == ['encoders.dotnet.settings']
+
+    with pytest.raises(SettingConfigException):
+        dotnet.register_settings([{'name': 'UriEnableCache', 'kind': 'registry', 'path': 'HKLM:\\X', 'system_default': 0}])
+    with pytest.raises(SettingConfigException):
+        dotnet.register_settings([{'name': 'X', 'kind': 'webconfig', 'system_default': 0}])
+    with pytest.raises(SettingConfigException):
+        dotnet.register_settings([{'name': 'X', 'kind': 'registry', 'path': 'HKLM:\\X', 'system_default': 0, 'typo': 1}])
+
+multi_site_config = {
+    'name': 'dotnet',
+    'settings': {
+        'UriEnableCache': {'default': 1},
+        'WebConfigCacheEnabled': {'default': 1},
+        'MACHINE/WEBROOT/APPHOST/SiteA::WebConfigCacheEnabled': {'default': 0},
+        'MACHINE/WEBROOT/APPHOST/SiteA::WebConfigEnableKernelCache': {'default': 1},
+        'MACHINE/WEBROOT/APPHOST/SiteB::WebConfigEnableKernelCache': {'default': 0},
+    }
+}
+
+multi_site_data_json = r"""{
+    "WebConfig": {
+        "MACHINE/WEBROOT/APPHOST": {"system.webServer/caching": {"enabled": true, "enableKernelCache": true}},
+        "MACHINE/WEBROOT/APPHOST/SiteA": {"system.webServer/caching": {"enabled": false, "enableKernelCache": true}},
+        "MACHINE/WEBROOT/APPHOST/SiteB": {"system.webServer/caching": {"enabled": true, "enableKernelCache": false}}
+    },
+    "HKLM:\\System\\CurrentControlSet\\Services\\Http\\Parameters": {"UriEnableCache": 0}
+}"""
+
+def test_multi_site():
+    encoder = load_encoder('dotnet')(multi_site_config)
+    assert set(encoder.describe()) == set(multi_site_config['settings'])
+
+    describe = encoder.encode_describe()
+    write_test_output_file('test_multi_site_encode_describe', describe)
+    assert describe.count('Get-WebConfiguration') == 3
+    assert describe.count('"MACHINE/WEBROOT/APPHOST/SiteA" = @{') == 1
+
+    expected = {
+        'UriEnableCache': 0,
+        'WebConfigCacheEnabled': 1,
+        'MACHINE/WEBROOT/APPHOST/SiteA::WebConfigCacheEnabled': 0,
+        'MACHINE/WEBROOT/APPHOST/SiteA::WebConfigEnableKernelCache': 1,
+        'MACHINE/WEBROOT/APPHOST/SiteB::WebConfigEnableKernelCache': 0,
+    }
+    assert encoder.decode_multi(multi_site_data_json) == expected
+
+    encoded = encoder.encode_multi(expected)
+    write_test_output_file('test_multi_site_encode_multi', encoded)
+    assert 'Set-WebConfigurationProperty -Filter "system.webServer/caching" -PSPath "MACHINE/WEBROOT/APPHOST/SiteB" -Name "enableKernelCache" -Value False\n' in encoded
+    assert encoder.decode_multi(encoded) == expected
+
+def test_multi_site_registry_path_rejected():
+    config = {'name': 'dotnet', 'settings': {'MACHINE/WEBROOT/APPHOST/SiteA::UriEnableCache': {}}}
+    with pytest.raises(EncoderConfigException):
+        load_encoder('dotnet')(config)
+
+def test_multi_site_null_json():
+    encoder = load_encoder('dotnet')(multi_site_config)
+    data = json.loads(multi_site_data_json)
+    # a null attribute has its system default in effect
+    data['WebConfig']['MACHINE/WEBROOT/APPHOST/SiteB']['system.webServer/caching']['enableKernelCache'] = None
+    assert encoder.decode_multi(data)['MACHINE/WEBROOT/APPHOST/SiteB::WebConfigEnableKernelCache'] == 1
+
+    data['WebConfig']['MACHINE/WEBROOT/APPHOST/SiteB']['system.webServer/caching'] = None
+    with pytest.raises(SettingRuntimeException):
+        encoder.decode_multi(data)
+    data['WebConfig']['MACHINE/WEBROOT/APPHOST/SiteB'] = None
+    with pytest.raises(SettingRuntimeException):
+        encoder.decode_multi(data)
+    data['WebConfig']['MACHINE/WEBROOT/APPHOST/SiteB'] = ['system.webServer/caching']
+    with pytest.raises(SettingRuntimeException):
+        encoder.decode_multi(data)
+
+def test_legal_values():
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    values = encoder.settings['UriScavengerPeriod'].legal_values()
+    assert (len(values), values[0], values[-1], values[10]) == (101, 200, 300, 210)
+    assert 250 in values and 301 not in values and 250.5 not in values
+    assert list(values[::50]) == [200, 250, 300]
+    assert len(values[5:5]) == 0
+    assert values.index(205) == 5
+    assert len(load_encoder('dotnet')({'name': 'dotnet', 'settings': {'UriScavengerPeriod': {'min': 10}}})
+               .settings['UriScavengerPeriod'].legal_values()) == 0xFFFFFFFF - 10 + 1
+
+def test_encode_batch():
+    numpy = pytest.importorskip('numpy')
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    encoded = encoder.encode_batch({
+        'UriScavengerPeriod': numpy.array([200, 210.4, 299.6]),
+        'WebConfigCacheEnabled': [0, 1, 1],
+    })
+    assert list(encoded['UriScavengerPeriod']) == ['200', '210', '300']
+    assert list(encoded['WebConfigCacheEnabled']) == ['False', 'True', 'True']
+    with pytest.raises(SettingRuntimeException):
+        encoder.encode_batch({'UriScavengerPeriod': [250, 400]})
+    assert list(encoder.settings['UriScavengerPeriod'].legal_values().to_array(0, 3)) == [200, 201, 202]
+
+def test_encode_multi_coalesced():
+    encoder = load_encoder('dotnet')(multi_site_config)
+    values = {
+        'UriEnableCache': 0,
+        'WebConfigCacheEnabled': 1,
+        'MACHINE/WEBROOT/APPHOST/SiteA::WebConfigCacheEnabled': 0,
+        'MACHINE/WEBROOT/APPHOST/SiteA::WebConfigEnableKernelCache': 1,
+        'MACHINE/WEBROOT/APPHOST/SiteB::WebConfigEnableKernelCache': 0,
+    }
+    encoded = encoder.encode_multi(values, coalesce=True)
+    write_test_output_file('test_encode_multi_coalesced', encoded)
+    assert encoded.count('Set-WebConfiguration ') == 3
+    assert 'Set-WebConfiguration -Filter "system.webServer/caching" -PSPath "MACHINE/WEBROOT/APPHOST/SiteA" ' \
+           '-Value @{"enabled"="False"; "enableKernelCache"="True"}\n' in encoded
+    assert encoded.count('Start-WebCommitDelay') == encoded.count('Stop-WebCommitDelay -Commit $true') == 1
+    assert encoder.decode_multi(encoded) == values
+
+    single = encoder.encode_multi({'WebConfigCacheEnabled': 1, 'UriEnableCache': 1}, coalesce=True)
+    assert 'WebCommitDelay' not in single
+    assert encoder.decode_multi(single)['UriEnableCache'] == 1
+
+def test_encode_describe_sharded():
+    encoder = load_encoder('dotnet')(multi_site_config)
+    assert encoder.encode_describe(parallel=1) == encoder.encode_describe()
+
+    describe = encoder.encode_describe(parallel=2)
+    write_test_output_file('test_encode_describe_parallel', describe)
+    assert describe.startswith('$describePool = [runspacefactory]::CreateRunspacePool(1, 2)\n')
+    assert describe.count('.AddScript({') == 2
+    assert describe.count('Get-WebConfiguration') == 3
+    assert describe.endswith('$describeResult | ConvertTo-Json\n')
+
+    shards = encoder.encode_describe_shards(8)
+    assert len(shards) == 4
+    assert sum(shard.count('Get-WebConfiguration') for shard in shards) == 3
+    assert all(shard.endswith('} | ConvertTo-Json\n') for shard in shards)
+
+    data = json.loads(multi_site_data_json)
+    reg_path = 'HKLM:\\System\\CurrentControlSet\\Services\\Http\\Parameters'
+    parts = [
+        json.dumps({'WebConfig': {path: filters}}) for path, filters in data['WebConfig'].items()
+    ] + [json.dumps({'WebConfig': {}, reg_path: data[reg_path]}).encode('utf-8')]
+    merged = encoder.merge_describe(parts)
+    assert set(merged['WebConfig']) == set(data['WebConfig'])
+    assert encoder.decode_multi(merged) == encoder.decode_multi(multi_site_data_json)
+
+    with pytest.raises(EncoderConfigException):
+        encoder.encode_describe_shards(0)
+
+slim_describe_data_json = r"""{"WebConfig":{"MACHINE/WEBROOT/APPHOST":{"system.webServer/caching":{"enabled":false,"enableKernelCache":true}}},"HKLM:\\System\\CurrentControlSet\\Services\\Http\\Parameters":{"UriEnableCache":1,"UriScavengerPeriod":null}}"""
+
+def test_encode_describe_slim():
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    describe = encoder.encode_describe(slim=True)
+    write_test_output_file('test_encode_describe_slim', describe)
+    assert '| Select-Object -Property "enabled","enableKernelCache")' in describe
+    assert '| Select-Object -Property "UriEnableCache","UriScavengerPeriod")' in describe
+    assert describe.endswith('} | ConvertTo-Json -Compress -Depth 4\n')
+    assert encoder.encode_describe() != describe
+    assert encoder_klass(dict(enc_config, slim_describe=True)).encode_describe() == describe
+
+def test_decode_multi_slim_json():
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    assert encoder.decode_multi(slim_describe_data_json) == encoder.decode_multi(describe_data_json)
+
+def test_decode_multi_buffers(tmpdir):
+    import mmap
+    import pathlib
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    expected = encoder.decode_multi(describe_data_json)
+    script = encoder.encode_multi(dict(expected, UriScavengerPeriod=None)) # system default, out of the configured range
+
+    for payload in (describe_data_json, script):
+        for encoding in ('utf-16', 'utf-16-le', 'utf-8-sig', 'utf-32'):
+            encoded = payload.encode(encoding)
+            assert encoder.decode_multi(encoded) == expected
+            assert encoder.decode_multi(memoryview(bytearray(encoded))) == expected
+
+        path = tmpdir.join('describe.txt')
+        path.write_binary(payload.encode('utf-16'))
+        assert encoder.decode_multi(pathlib.Path(str(path))) == expected
+        assert encoder.decode_multi(type('DescribePath', (), {'__fspath__': lambda self: str(path)})()) == expected
+        with open(str(path), 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            assert encoder.decode_multi(mapped) == expected
+            assert encoder_klass(dict(enc_config, decode_cache_size=2)).decode_multi(mapped) == expected
+        finally:
+            mapped.close()
+
+def test_detect_text_encoding():
+    from encoders.dotnet import decode_text
+    for encoding in ('utf-8', 'utf-8-sig', 'utf-16', 'utf-16-le', 'utf-16-be', 'utf-32', 'utf-32-le', 'utf-32-be'):
+        assert decode_text('{"a": 1}'.encode(encoding)) == '{"a": 1}'
+        assert decode_text(memoryview('[]'.encode(encoding))) == '[]'
+    assert decode_text(b'') == '' and decode_text(b'1') == '1'
+
+def test_select_json():
+    from encoders.dotnet import select_json
+    data = '{"a": {"x": [1, {"}": "]"}], "b": 2, "c": null}, "s\\"k": "v{", "d": {"e": 3}, "n": null}'
+    assert select_json(data, {'a': {'b': None, 'c': None}, 'd': None, 'n': {'z': None}}) == \
+        {'a': {'b': 2, 'c': None}, 'd': {'e': 3}, 'n': None}
+    with pytest.raises(ValueError):
+        select_json('{"a": 1', {'a': None})
+
+def test_decode_multi_json_selective_inputs():
+    import io
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    expected = encoder.decode_multi(describe_data_json)
+    assert encoder.decode_multi(describe_data_json.encode('utf-8')) == expected
+    assert encoder.decode_multi(describe_data_json.encode('utf-16')) == expected
+    assert encoder.decode_multi(io.StringIO(describe_data_json)) == expected
+    assert encoder.describe_selection['WebConfig'] == {
+        'MACHINE/WEBROOT/APPHOST': {'system.webServer/caching': {'enabled': None, 'enableKernelCache': None}}}
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_fleet_decode_multi(executor):
+    from encoders.dotnet import FleetEncoder
+    enc_config = load_config()
+    broken_json = describe_data_json.replace('"enableKernelCache"', '"somethingElse"')
+    payloads = {'host{}'.format(i): describe_data_json if i % 5 else broken_json for i in range(20)}
+    with FleetEncoder(enc_config, executor=executor, max_workers=2) as fleet:
+        decoded = fleet.decode_multi(payloads)
+        encoded = fleet.encode_multi({'host0': {'UriScavengerPeriod': 240}, 'host1': {'UriScavengerPeriod': 1}})
+    expected = fleet.encoder.decode_multi(describe_data_json)
+    assert sorted(decoded.errors) == ['host0', 'host10', 'host15', 'host5']
+    assert all(isinstance(e, SettingRuntimeException) for e in decoded.errors.values())
+    assert decoded.results == {host: expected for host in payloads if host not in decoded.errors}
+    assert list(encoded.results) == ['host0'] and list(encoded.errors) == ['host1']
+    assert FleetEncoder(enc_config, executor=executor).max_workers >= 1
+
+def test_async_pipeline(monkeypatch):
+    import asyncio
+    import sys
+    from encoders import bench_dotnet as bench
+    from encoders.dotnet import AsyncPipeline, FakeScriptExecutor, SubprocessScriptExecutor
+
+    encoder = load_encoder('dotnet')(multi_site_config)
+    applied = {}
+    def responder(host, script):
+        if script.startswith('Import-Module WebAdministration\n@{'):
+            if host == 'broken':
+                return '{"WebConfig": {}}'
+            return bench.make_describe_json(encoder, applied[host], slim=True)
+        applied[host] = encoder.decode_multi(script)
+        return ''
+    executor = FakeScriptExecutor(responder, latency=lambda host, script: 1 if host == 'slow' else 0.01)
+    pipeline = AsyncPipeline(multi_site_config, executor, concurrency=3, timeout=0.5)
+
+    hosts = {'host{}'.format(i): bench.make_values(encoder, seed=i) for i in range(8)}
+    hosts['slow'] = hosts['broken'] = hosts['host0']
+    hosts['invalid'] = {'UriEnableCache': 2}
+    loop = asyncio.new_event_loop()
+    try:
+        results, errors = loop.run_until_complete(pipeline.adjust(hosts))
+        assert results == {host: values for host, values in hosts.items() if host.startswith('host')}
+        assert set(errors) == {'slow', 'broken', 'invalid'}
+        assert 'Timed out' in str(errors['slow'])
+        assert isinstance(errors['broken'], SettingRuntimeException)
+        assert executor.max_running == 3
+        assert not any(host == 'invalid' for host, _ in executor.calls)
+
+        del executor.calls[:]
+        results, errors = loop.run_until_complete(pipeline.describe(['host1', 'host2']))
+        assert results == {'host1': hosts['host1'], 'host2': hosts['host2']} and not errors
+        assert executor.calls == [('host1', pipeline.describe_script), ('host2', pipeline.describe_script)]
+
+        # Time queued behind other hosts doesn't count against the timeout, hosts describe right after adjusting
+        executor = FakeScriptExecutor(responder, latency=0.1)
+        pipeline = AsyncPipeline(multi_site_config, executor, concurrency=2, timeout=0.5)
+        queued = {'host{}'.format(i): hosts['host{}'.format(i)] for i in range(8)} # 0.8s for the last one to finish
+        results, errors = loop.run_until_complete(pipeline.adjust(queued))
+        assert results == queued and not errors
+        assert [host for host, _ in executor.calls[:4]] == ['host0', 'host1', 'host0', 'host1']
+
+        executor = SubprocessScriptExecutor((sys.executable, '-c', 'import sys; sys.stdout.write(sys.stdin.read())'))
+        assert loop.run_until_complete(executor.run('localhost', pipeline.describe_script)) == \
+            pipeline.describe_script.encode('utf-8')
+        with pytest.raises(EncoderRuntimeException):
+            loop.run_until_complete(SubprocessScriptExecutor((sys.executable, '-c', 'import sys; sys.exit(1)')).run('localhost', ''))
+
+        # Timed out scripts are killed and reaped
+        processes = []
+        create_subprocess_exec = asyncio.create_subprocess_exec
+        async def recording_create_subprocess_exec(*args, **kwargs):
+            processes.append(await create_subprocess_exec(*args, **kwargs))
+            return processes[-1]
+        monkeypatch.setattr(asyncio, 'create_subprocess_exec', recording_create_subprocess_exec)
+        executor = SubprocessScriptExecutor((sys.executable, '-c', 'import time; time.sleep(30)'))
+        with pytest.raises(asyncio.TimeoutError):
+            loop.run_until_complete(asyncio.wait_for(executor.run('localhost', ''), 0.5))
+        assert processes[0].returncode is not None
+    finally:
+        loop.close()
+
+def test_snapshot_store(tmpdir):
+    from encoders.dotnet import SnapshotStore
+    encoder = load_encoder('dotnet')(multi_site_config)
+    store = SnapshotStore.for_encoder(encoder)
+    described = encoder.decode_multi(multi_site_data_json)
+    adjusted = dict(described, UriEnableCache=1)
+
+    store.record('web1', described, timestamp=10)
+    store.record('web2', described, timestamp=10)
+    store.record('web1', adjusted, timestamp=20, adjusted=True)
+    store.record('web1', adjusted, timestamp=21)
+    store.record('web2', dict(described, WebConfigCacheEnabled=0), timestamp=30)
+    store.record('web1', described, timestamp=40) # reverted behind our back
+    with pytest.raises(EncoderRuntimeException):
+        store.record('web1', described, timestamp=39)
+    with pytest.raises(EncoderRuntimeException):
+        store.record('web1', {'Unknown': 1}, timestamp=50)
+
+    def check(store):
+        assert len(store) == 6
+        assert store.snapshot('web1', at=25) == adjusted
+        assert store.snapshot('web1', at=25, adjusted=True) == adjusted
+        assert store.snapshot('web1', at=5) is None
+        assert store.snapshot('web1') == described
+        assert store.changes_since(15, until=35) == {
+            'web1': {'UriEnableCache': (0, 1)},
+            'web2': {'WebConfigCacheEnabled': (1, 0)},
+        }
+        assert store.changes_since(15) == {'web2': {'WebConfigCacheEnabled': (1, 0)}}
+        assert store.changes_since(35, hosts=['web2', 'web3']) == {}
+        assert store.drift() == {'web1': {'UriEnableCache': (1, 0)}}
+        assert [timestamp for timestamp, _, _ in store.history('web1', since=10)] == [20, 21, 40]
+
+    check(store)
+    path = str(tmpdir.join('snapshots.bin'))
+    store.save(path)
+    for use_mmap in (True, False):
+        loaded = SnapshotStore.load(path, use_mmap=use_mmap)
+        check(loaded)
+        loaded.record('web2', described, timestamp=50)
+        assert loaded.changes_since(40) == {'web2': {'WebConfigCacheEnabled': (0, 1)}}
+        loaded.close()
+
+    # Saved back over the file it is memory mapped from, then used on
+    loaded = SnapshotStore.load(path)
+    loaded.save(path)
+    check(loaded)
+    check(SnapshotStore.load(path, use_mmap=False))
+    loaded.close()
+    assert os.listdir(str(tmpdir)) == ['snapshots.bin']
+
+    with open(path, 'wb') as f:
+        f.write(b'garbage')
+    with pytest.raises(EncoderRuntimeException):
+        SnapshotStore.load(path)
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_cli(tmpdir, capsys, workers):
+    from encoders.dotnet import main
+    config_path = tmpdir.join('config.json')
+    config_path.write(json.dumps({'web': {'encoder': multi_site_config}}))
+    encoder = load_encoder('dotnet')(multi_site_config)
+    values = encoder.decode_multi(multi_site_data_json)
+    describe_path = tmpdir.join('describe.json')
+    describe_path.write_binary(multi_site_data_json.encode('utf-16'))
+
+    records = tmpdir.join('records.ndjson')
+    records.write('\n'.join([
+        json.dumps({'host': 'web1', 'payload': multi_site_data_json}),
+        json.dumps({'host': 'web2', 'path': str(describe_path)}),
+        '',
+        json.dumps({'host': 'web3', 'payload': '{"WebConfig": {}}'}),
+        json.dumps({'host': 'web4'}),
+    ]) + '\n')
+    base_argv = ['--config', str(config_path), '--section', 'web.encoder', '--workers', str(workers), '--chunk-size', '1']
+    assert main(base_argv + ['decode', str(records)]) == 1
+    output = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [record['host'] for record in output] == ['web1', 'web2', 'web3', 'web4']
+    assert output[0] == {'host': 'web1', 'values': values}
+    assert output[1] == {'host': 'web2', 'values': values}
+    assert output[2]['error'].startswith('SettingRuntimeException')
+    assert output[3]['error'] == "Missing key 'path' in decode record"
+
+    records.write(json.dumps({'host': 'web1', 'values': values, 'current': multi_site_data_json}) + '\n')
+    assert main(base_argv + ['encode', '--activate', str(records)]) == 0
+    output = json.loads(capsys.readouterr().out)
+    assert output == {'host': 'web1', 'script': ''}
+
+    assert main(base_argv + ['describe', '--slim']) == 0
+    assert json.loads(capsys.readouterr().out) == {'host': None, 'script': encoder.encode_describe(slim=True)}
+
+    assert main(['--config', str(config_path), '--section', 'missing', 'describe']) == 2
+    capsys.readouterr()
+    missing = str(tmpdir.join('missing.ndjson'))
+    assert main(base_argv + ['decode', missing]) == 2
+    captured = capsys.readouterr()
+    assert captured.out == ''
+    assert captured.err.startswith('Unable to read input') and missing in captured.err
+    assert captured.err.count('\n') == 1
+
+def test_conditional_describe():
+    import asyncio
+    import hashlib
+    import re
+    from encoders import bench_dotnet as bench
+    from encoders.dotnet import AsyncPipeline, FakeScriptExecutor
+
+    encoder = load_encoder('dotnet')(multi_site_config)
+    script = encoder.encode_describe_conditional('AB01')
+    write_test_output_file('test_encode_describe_conditional', script)
+    assert script.startswith('Import-Module WebAdministration\n$describe = [ordered]@{\n\t"WebConfig" = [ordered]@{\n')
+    assert '| Select-Object -Property "enabled","enableKernelCache")' in script
+    assert 'if ($describeFingerprint -eq "AB01") {' in script
+    assert 'if ($describeFingerprint -eq "") {' in encoder.encode_describe_conditional()
+    for fingerprint in ('"; Remove-Item C:\\ -Recurse; "', 'AB01\n'):
+        with pytest.raises(EncoderRuntimeException):
+            encoder.encode_describe_conditional(fingerprint)
+
+    # Emulates the script on hosts holding values
+    host_values = {'web1': encoder.decode_multi(multi_site_data_json), 'web2': bench.make_values(encoder, seed=1)}
+    def responder(host, script):
+        data = json.loads(bench.make_describe_json(encoder, host_values[host], slim=True))
+        fingerprint = hashlib.sha256(json.dumps(data, separators=(',', ':')).encode('utf-8')).hexdigest().upper()
+        if re.search(r'-eq "(\w*)"', script).group(1) == fingerprint:
+            return json.dumps({'Unchanged': fingerprint})
+        return json.dumps(dict(data, Fingerprint=fingerprint))
+
+    described = encoder.decode_conditional(responder('web1', script))
+    assert described.values == host_values['web1'] and not described.unchanged
+    unchanged = responder('web1', encoder.encode_describe_conditional(described.fingerprint))
+    assert len(unchanged) < 100
+    assert encoder.decode_conditional(unchanged) == (host_values['web1'], described.fingerprint, True)
+    assert encoder.decode_multi(unchanged) == host_values['web1']
+    # Encoders that did not decode the values along with the fingerprint need them passed
+    fresh = load_encoder('dotnet')(multi_site_config)
+    with pytest.raises(SettingRuntimeException):
+        fresh.decode_multi(unchanged)
+    assert fresh.decode_multi(unchanged, previous=host_values['web1']) == host_values['web1']
+    assert fresh.decode_conditional(unchanged, described) == (host_values['web1'], described.fingerprint, True)
+    with pytest.raises(SettingRuntimeException):
+        fresh.decode_conditional(unchanged, described._replace(fingerprint='AB01'))
+    for data in ('[1,2]', '42', 'null'):
+        with pytest.raises(SettingRuntimeException):
+            encoder.decode_multi(data)
+
+    executor = FakeScriptExecutor(responder)
+    pipeline = AsyncPipeline(multi_site_config, executor, conditional=True)
+    loop = asyncio.new_event_loop()
+    try:
+        for _ in range(2):
+            results, errors = loop.run_until_complete(pipeline.describe(['web1', 'web2']))
+            assert results == host_values and not errors
+    finally:
+        loop.close()
+    assert set(pipeline.described) == {'web1', 'web2'}
+    assert all(pipeline.described[host].fingerprint in script for host, script in executor.calls[2:])
+
+def test_bench_smoke():
+    import encoders.bench_dotnet as bench
+    results = bench.run_benchmarks(sites=3, iterations=2)
+    write_test_output_file('test_bench_smoke', results)
+    assert results['meta']['settings'] == 4 + 3 * 2
+    assert set(results['results']) >= {'encode_multi', 'encode_describe', 'decode_multi_json', 'decode_multi_ps1',
+                                       'decode_multi_ps1_log', 'decode_multi_ps1_log_scan'}
+    assert bench.compare(results, results) == []
+    slower = {'results': {'encode_multi': dict(results['results']['encode_multi'], p50=0)}}
+    assert [r[:2] for r in bench.compare(results, slower)] == [('encode_multi', 'p50')]
+
+    encoder = bench.Encoder(bench.make_config(3))
+    values = bench.make_values(encoder)
+    assert encoder.decode_multi(bench.make_describe_json(encoder, values)) == values
+    assert encoder.decode_multi(bench.make_describe_json(encoder, values, slim=True)) == values
+    adjust_log = bench.make_adjust_log(encoder, values, 200)
+    assert adjust_log.count('\n') == 200
+    assert encoder.decode_multi(adjust_log) == bench.scan_decode_ps1(encoder, adjust_log) == values
+
+def test_iis_simulator():
+    from encoders.dotnet import ACTIVATION_APP_POOL_RECYCLE, HTTP_PARAMETERS_PATH, IIS_CACHING_FILTER
+    from encoders.sim_dotnet import IisSimulator
+
+    encoder = load_encoder('dotnet')(multi_site_config)
+    simulator = IisSimulator(registry={HTTP_PARAMETERS_PATH: {'UriEnableCache': 0}},
+                             webconfig={'MACHINE/WEBROOT/APPHOST/SiteB': {IIS_CACHING_FILTER: {'enableKernelCache': False}}},
+                             sites={'SiteA': 'PoolA', 'SiteB': 'PoolA'})
+    described = simulator.execute(encoder.encode_describe())
+    assert set(json.loads(described.output)) == set(json.loads(describe_data_json))
+    expected = encoder.decode_multi(multi_site_data_json)
+    expected['MACHINE/WEBROOT/APPHOST/SiteA::WebConfigCacheEnabled'] = 1
+    assert encoder.decode_multi(described.output) == expected
+    assert described.writes == 0 and described.elapsed > 0
+
+    values = dict(expected, **{'MACHINE/WEBROOT/APPHOST/SiteA::WebConfigCacheEnabled': 0,
+                               'MACHINE/WEBROOT/APPHOST/SiteB::WebConfigEnableKernelCache': 1})
+    applied = [IisSimulator(sites={'SiteA': 'PoolA', 'SiteB': 'PoolA'}).execute(encoder.encode_multi(values, coalesce=c))
+               for c in (False, True)]
+    assert applied[1].elapsed < applied[0].elapsed and applied[0].writes == applied[1].writes == 5
+    simulator.execute(encoder.plan_apply(values, current=expected).script)
+    assert simulator.activations == [(ACTIVATION_APP_POOL_RECYCLE, 'PoolA')]
+    for slim in (False, True):
+        assert encoder.decode_multi(simulator.execute(encoder.encode_describe(slim=slim)).output) == values
+    conditional = encoder.decode_conditional(simulator.execute(encoder.encode_describe_conditional()).output)
+    assert conditional.values == values
+    unchanged = simulator.execute(encoder.encode_describe_conditional(conditional.fingerprint)).output
+    assert encoder.decode_conditional(unchanged) == (values, conditional.fingerprint, True)
+
+    # Commit delays only apply their writes once stopped
+    simulator.execute('Start-WebCommitDelay\n' + encoder.encode_multi({'WebConfigCacheEnabled': 0}))
+    assert simulator.effective_section('MACHINE/WEBROOT/APPHOST', IIS_CACHING_FILTER)['enabled']
+    with pytest.raises(EncoderRuntimeException):
+        simulator.execute('Remove-Item -Path "HKLM:\\System" -Recurse')
+    with pytest.raises(EncoderRuntimeException):
+        simulator.execute(encoder.encode_multi({'MACHINE/WEBROOT/APPHOST/SiteA::WebConfigCacheEnabled': 1},
+                                               activate=True).replace('"SiteA"', '"SiteC"'))
+
+def test_sim_smoke():
+    from encoders import sim_dotnet as sim
+    results = sim.run_simulation(sites=2, hosts=3, rounds=2)
+    write_test_output_file('test_sim_smoke', results['meta'])
+    assert results['results']['errors'] == results['results']['mismatches'] == 0
+    coalesced = sim.run_simulation(sites=2, hosts=3, rounds=2, options={'coalesce_writes': True, 'activate': True},
+                                   conditional=True)
+    assert coalesced['results']['errors'] == coalesced['results']['mismatches'] == 0
+    assert coalesced['results']['activations'] == 3 * 2
+    assert sim.main(['--sites', '1', '--hosts', '2', '--rounds', '1', '--slim', '--output', os.devnull]) == 0
+
+def test_shared_encoder_state():
+    from encoders.dotnet import IntToBoolValueEncoder
+    assert IntToBoolValueEncoder() is IntToBoolValueEncoder()
+    with pytest.raises(AttributeError):
+        IntToBoolValueEncoder().state = 1
+
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder, other = encoder_klass(enc_config), encoder_klass(dict(enc_config))
+    assert encoder.settings['UriEnableCache'] is other.settings['UriEnableCache']
+    assert encoder.encode_plan is other.encode_plan
+    encoder.encode_describe()
+    assert other.encode_describe() is encoder.encode_describe()
+
+    # Containers are copies, subclasses compile their own state
+    del encoder.settings['UriEnableCache']
+    encoder.describe_scripts.clear()
+    assert 'UriEnableCache' in other.settings and other.describe_scripts
+    class PrefixedEncoder(encoder_klass):
+        def _compile_encode_plan(self):
+            return super()._compile_encode_plan()._replace(before='# prefixed\n')
+    assert PrefixedEncoder(enc_config).encode_multi({'UriEnableCache': 0}).startswith('# prefixed\n')
+    assert not other.encode_multi({'UriEnableCache': 0}).startswith('# prefixed\n')
+    encoder = encoder_klass(enc_config)
+    assert 'value_prefix' not in vars(encoder.settings['UriEnableCache'])
+    assert encoder_klass(dict(enc_config, after='Write-Output done\n')).settings is not encoder.settings
+
+    encoder.enable_instrumentation()
+    assert encoder.settings is not other.settings
+    assert other.settings['UriEnableCache'].__class__.__name__ == 'UriEnableCacheSetting'
+    assert not hasattr(other.settings['UriEnableCache'].__class__, 'instrumented_class')
+    assert encoder.encode_multi({'UriEnableCache': 0}) == other.encode_multi({'UriEnableCache': 0})
+
+def test_compiled_cache(tmpdir, monkeypatch):
+    import encoders.dotnet as dotnet
+    enc_config = dict(load_config(), compiled_cache_dir=str(tmpdir.join('cache')))
+    encoder_klass = load_encoder(enc_config['name'])
+    values = {'UriEnableCache': 0, 'UriScavengerPeriod': 250, 'WebConfigCacheEnabled': 1, 'WebConfigEnableKernelCache': 0}
+
+    monkeypatch.setattr(dotnet, '_shared_encoder_states', dotnet.LruCache(dotnet.ENCODER_STATE_CACHE_SIZE))
+    compiled = encoder_klass(enc_config)
+    path = dotnet.compiled_state_path(enc_config['compiled_cache_dir'], compiled.config_fingerprint, encoder_klass)
+    assert os.path.exists(path)
+
+    # Later (cold) starts load the state instead of compiling settings
+    def fail(self):
+        raise AssertionError('settings compiled again')
+    monkeypatch.setattr(dotnet, '_shared_encoder_states', dotnet.LruCache(dotnet.ENCODER_STATE_CACHE_SIZE))
+    monkeypatch.setattr(encoder_klass, '_compile_settings', fail)
+    loaded = encoder_klass(enc_config)
+    assert loaded.settings is not compiled.settings
+    assert loaded.describe_scripts == compiled.describe_scripts and loaded.describe_scripts
+    assert loaded.encode_describe() == compiled.encode_describe()
+    assert loaded.encode_multi(values) == compiled.encode_multi(values)
+    assert loaded.decode_multi(describe_data_json) == compiled.decode_multi(describe_data_json)
+    assert loaded.describe() == compiled.describe()
+
+    # Unreadable cache is compiled again and overwritten
+    monkeypatch.undo()
+    monkeypatch.setattr(dotnet, '_shared_encoder_states', dotnet.LruCache(dotnet.ENCODER_STATE_CACHE_SIZE))
+    with open(path, 'wb') as f:
+        f.write(b'garbage')
+    assert encoder_klass(enc_config).encode_multi(values) == compiled.encode_multi(values)
+    assert dotnet.load_compiled_state(enc_config['compiled_cache_dir'], compiled.config_fingerprint, encoder_klass) is not None
+
+def test_instrumentation(tmpdir):
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    events = []
+    instrumentation = encoder.enable_instrumentation(callback=lambda *event: events.append(event))
+    encoded = encoder.encode_multi({'UriScavengerPeriod': 240, 'WebConfigCacheEnabled': 1})
+    encoder.decode_multi(describe_data_json)
+    encoder.decode_multi(describe_data_ps1)
+    encoder.encode_describe()
+    snapshot = instrumentation.snapshot()
+    write_test_output_file('test_instrumentation', snapshot)
+
+    timings = snapshot['timings']
+    assert timings['encode_option'] == {
+        'UriScavengerPeriodSetting': timings['encode_option']['UriScavengerPeriodSetting'],
+        'WebConfigCacheEnabledSetting': timings['encode_option']['WebConfigCacheEnabledSetting'],
+    }
+    assert timings['validate_value']['UriScavengerPeriodSetting']['count'] == 1
+    assert timings['decode_option_json']['UriEnableCacheSetting']['count'] == 1
+    assert timings['decode_option_ps1']['WebConfigEnableKernelCacheSetting']['count'] == 1
+    assert timings['encode_describe']['Encoder']['count'] == 1
+    assert sum(timings['decode_multi']['Encoder']['histogram'].values()) == 2
+    assert snapshot['bytes']['out']['encode_multi'] == {'count': 1, 'total': len(encoded)}
+    assert snapshot['bytes']['in']['decode_multi']['total'] == len(describe_data_json) + len(describe_data_ps1)
+    assert ('bytes_out', 'encode_multi', 'Encoder', len(encoded)) in events
+    # Sizes are in bytes: utf-8 for text, whatever the buffer holds otherwise
+    encoder.decode_multi(describe_data_json.replace('"Location":  ""', '"Location":  "\u00e9t\u00e9"'))
+    encoder.decode_multi(memoryview(describe_data_json.encode('utf-16')))
+    assert instrumentation.snapshot()['bytes']['in']['decode_multi']['total'] == \
+        len(describe_data_json) + len(describe_data_ps1) + (len(describe_data_json) + len('\u00e9t\u00e9') + 2) + \
+        (2 + 2 * len(describe_data_json))
+    # Lists of lines count as the text they join to, paths as the size of their file (once)
+    import pathlib
+    encoder.encode_multi({'UriScavengerPeriod': 240, 'WebConfigCacheEnabled': 1}, expected_type='list')
+    assert instrumentation.snapshot()['bytes']['out']['encode_multi'] == {'count': 2, 'total': 2 * len(encoded)}
+    decoded_bytes = dict(instrumentation.snapshot()['bytes']['in']['decode_multi'])
+    describe_path = tmpdir.join('describe.json')
+    describe_path.write_binary(describe_data_json.encode('utf-16'))
+    encoder.decode_multi(pathlib.Path(str(describe_path)))
+    assert instrumentation.snapshot()['bytes']['in']['decode_multi'] == \
+        {'count': decoded_bytes['count'] + 1, 'total': decoded_bytes['total'] + 2 + 2 * len(describe_data_json)}
+
+    encoder.disable_instrumentation()
+    assert type(encoder) is encoder_klass
+    assert not any(hasattr(type(s), 'instrumented_class') for s in encoder.settings.values())
+    encoder.encode_multi({'UriScavengerPeriod': 240})
+    assert instrumentation.snapshot()['timings']['encode_multi']['Encoder']['count'] == 2
+
+def test_decode_cache():
+    enc_config = dict(load_config(), decode_cache_size=2)
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(enc_config)
+    first = encoder.decode_multi(describe_data_json)
+    first['UriEnableCache'] = 'mutated by caller'
+    assert encoder.decode_multi(describe_data_json) == encoder_klass(load_config()).decode_multi(describe_data_json)
+    encoder.decode_multi(describe_data_json.encode('utf-8'))
+    encoder.decode_multi(describe_data_ps1)
+    encoder.decode_multi(describe_data_json)
+    encoder.decode_multi(reordered_data_ps1)
+    # utf-8 bytes of a str payload hit its entry
+    assert encoder.decode_cache_info() == {'hits': 3, 'misses': 3, 'evictions': 1, 'expirations': 0,
+                                           'size': 2, 'maxsize': 2, 'ttl': None}
+    encoder.invalidate_decode_cache()
+    assert encoder.decode_cache_info()['size'] == 0
+    assert encoder_klass(load_config()).decode_cache_info() is None
+
+def test_encode_cache():
+    import hashlib
+    enc_config = load_config()
+    encoder_klass = load_encoder(enc_config['name'])
+    encoder = encoder_klass(dict(enc_config, encode_cache_size=2))
+    uncached = encoder_klass(enc_config)
+    values = {'UriEnableCache': 1, 'UriScavengerPeriod': 240, 'WebConfigCacheEnabled': 0, 'WebConfigEnableKernelCache': 1}
+
+    encoded = encoder.encode_script(values)
+    assert encoded.script == uncached.encode_multi(values)
+    assert encoded.digest == hashlib.sha256(encoded.script.encode('utf-8')).hexdigest()
+    assert uncached.encode_script(values) == encoded
+    # Same values in another order hit the cache
+    assert encoder.encode_multi(dict(reversed(list(values.items())))) == encoded.script
+    assert encoder.encode_multi(values, expected_type='list') == encoded.script.split('\n')
+    assert encoder.encode_cache_info()['hits'] == 2
+    with pytest.raises(EncoderRuntimeException):
+        encoder.encode_multi(dict(values, Missing=None))
+
+    assert encoder.encode_script(values, activate=True) == uncached.encode_script(values, activate=True)
+    assert encoder.encode_multi(values, current=describe_data_json) == uncached.encode_multi(values, current=describe_data_json)
+    assert encoder.encode_cache_info()['evictions'] == 1
+    encoder.invalidate_encode_cache()
+    assert encoder.encode_cache_info()['size'] == 0
+
+    # Values equal to cached ones but of another type miss the cache, they are validated as if uncached
+    def outcome(encoder, values):
+        try:
+            return encoder.encode_multi(values)
+        except SettingRuntimeException as e:
+            return type(e)
+    encoder.encode_multi(values)
+    for value in (True, 1.0):
+        assert encoder._encode_key(dict(values, UriEnableCache=value), None, False, False) != \
+            encoder._encode_key(values, None, False, False)
+        assert outcome(encoder, dict(values, UriEnableCache=value)) == outcome(uncached, dict(values, UriEnableCache=value))
+
+
+def test_lru_cache_ttl():
+    from encoders.dotnet import LruCache
+    now = [0.0]
+    cache = LruCache(10, ttl=5, clock=lambda: now[0])
+    cache.put('a', 1)
+    assert cache.get('a') == 1
+    now[0] = 5.0
+    assert cache.get('a') is None
+    assert cache.info()['expirations'] == 1